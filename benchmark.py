@@ -0,0 +1,458 @@
+# -*- coding: utf-8 -*-
+"""Benchmark extraction, rasterization and writing of MusicXML
+
+1. --in_dirを指定した場合
+   ディレクトリ内のMusicXMLを読み込み，抽出にかかる時間を計測する
+   bs4の場合はBeautifulSoupによる読み込みとextract_musicを分けて計測する
+   iterparseの場合は読み込みと抽出が一体なので合計のみ
+
+2. それ以外の場合
+   MuseScoreの出力と同じ構成の楽譜を生成し(generate_score)，次の各段階の
+   時間，スループット(notes/s, measures/s)，ピークメモリを計測する
+   extract_bs4       -- BeautifulSoupによる読み込み + extract_music
+   extract_iterparse -- extract_music_stream
+   windows           -- xml2npy.iter_melody_windows
+   write_score       -- WriteIdentification, WriteDefaults, WritePartList, WriteScore
+   finalize          -- xml2xml.finalize
+   各段階は別プロセスで実行し，ピークメモリはその段階での最大常駐メモリの増分とする
+   結果は--results のファイル (デフォルトはリポジトリの外のRESULTS_PATH) にJSON linesで追記し，
+   --compareで前回の結果と比較できる
+
+Usage
+    python benchmark.py --in_dir DIR [--parser {bs4,iterparse}] [--repeat N]
+    python benchmark.py [--measures M] [--parts P] [--harmony H] [--tuplets T] [--upbeat]
+                        [--stages STAGE ...] [--results FILE] [--compare]
+"""
+
+import os
+import sys
+import time
+import json
+import random
+import argparse
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+import Queue
+from contextlib import closing
+import xml.etree.ElementTree as ET
+
+import xml2vec as x2v
+import xml2npy
+import xml2xml
+from bs4 import BeautifulSoup
+
+
+# 計測する段階
+STAGES = ("extract_bs4", "extract_iterparse", "windows", "write_score", "finalize")
+
+
+def bench_extract(xml_file, parser="bs4", repeat=3):
+    """Time extraction of one MusicXML file
+
+    args:
+    xml_file -- MusicXMLのパス
+    parser   -- "bs4" または "iterparse"
+    repeat   -- 繰り返し回数 (最短の時間を採用する)
+
+    return: (読み込み時間[sec], 抽出時間[sec], 音符数[int], 小節数[int])"""
+
+    best_load = best_extract = float("inf")
+
+    for _ in range(repeat):
+
+        if parser == "bs4":
+            start = time.time()
+            with closing(x2v.open_score(xml_file)) as f:
+                soup = BeautifulSoup(f.read(), "lxml")
+            loaded = time.time()
+            piece_info, melody, _ = x2v.extract_music(soup)
+            end = time.time()
+        else:
+            start = loaded = time.time()
+            piece_info, melody, _ = x2v.load_music(xml_file, parser)
+            end = time.time()
+
+        best_load    = min(best_load, loaded - start)
+        best_extract = min(best_extract, end - loaded)
+
+    return best_load, best_extract, len(melody), piece_info.measure_num
+
+
+def generate_score(measures=64, parts=2, divisions=24, harmony=0.5, tuplets=0.1,
+                   upbeat=False, seed=0):
+    """Generate a synthetic MusicXML score
+
+    MIDIからMuseScore2で変換したMusicXMLと同じ構成の楽譜を生成する
+    (4/4拍子，P1の最初の小節にattributesとテンポ，他声部は<backup>の後に置く)
+
+    args:
+    measures  -- 小節数
+    parts     -- パート数
+    divisions -- 4分音符の長さ (3の倍数でないと連符は生成しない)
+    harmony   -- 各拍にコードを置く確率 (P1のみ)
+    tuplets   -- 各拍を1拍3連にする確率
+    upbeat    -- Trueなら1拍の弱起(implicit=yesの0小節目)を置く
+    seed      -- 乱数の種
+
+    return: MusicXML [str]"""
+
+    rng = random.Random(seed)
+    steps = ["C", "D", "E", "F", "G", "A", "B"]
+    kinds = [("major", ""), ("minor", "m"), ("dominant", "7"), ("minor-seventh", "m7")]
+    m_len = divisions * 4
+
+    score = ET.Element("score-partwise", {"version":"3.0"})
+    part_list = ET.SubElement(score, "part-list")
+    for p in range(1, parts + 1):
+        score_part = ET.SubElement(part_list, "score-part", {"id":"P%d" % p})
+        ET.SubElement(score_part, "part-name").text = "Part %d" % p
+
+    # 音符 <note>
+    def add_note(measure, duration, n_type, step=None, octave=4, voice=1,
+                 chord=False, dot=False, tuplet=False, whole_rest=False):
+        note = ET.SubElement(measure, "note")
+        if chord:
+            ET.SubElement(note, "chord")
+        if step is None:
+            ET.SubElement(note, "rest", {"measure":"yes"} if whole_rest else {})
+        else:
+            pitch = ET.SubElement(note, "pitch")
+            ET.SubElement(pitch, "step").text = step
+            ET.SubElement(pitch, "octave").text = str(octave)
+        ET.SubElement(note, "duration").text = str(duration)
+        ET.SubElement(note, "voice").text = str(voice)
+        if not whole_rest:
+            ET.SubElement(note, "type").text = n_type
+        if dot:
+            ET.SubElement(note, "dot")
+        if tuplet:
+            t_mod = ET.SubElement(note, "time-modification")
+            ET.SubElement(t_mod, "actual-notes").text = "3"
+            ET.SubElement(t_mod, "normal-notes").text = "2"
+
+    # コード <harmony>
+    def add_harmony(measure):
+        h = ET.SubElement(measure, "harmony", {"print-frame":"no"})
+        root = ET.SubElement(h, "root")
+        ET.SubElement(root, "root-step").text = rng.choice(steps)
+        kind, text = rng.choice(kinds)
+        ET.SubElement(h, "kind", {"text":text}).text = kind
+
+    # 1拍分の音符 (4分音符，8分音符2つ，1拍3連，休符のいずれか)
+    def add_beat(measure, voice=1):
+        r = rng.random()
+        if r < tuplets and divisions % 3 == 0:
+            for _ in range(3):
+                add_note(measure, divisions // 3, "eighth", rng.choice(steps),
+                         rng.randint(4, 5), voice, tuplet=True)
+        elif r < 0.5 and divisions % 2 == 0:
+            for _ in range(2):
+                add_note(measure, divisions // 2, "eighth", rng.choice(steps), rng.randint(4, 5), voice)
+        elif r < 0.9:
+            add_note(measure, divisions, "quarter", rng.choice(steps), rng.randint(4, 5), voice)
+            if rng.random() < 0.2: # 和音
+                add_note(measure, divisions, "quarter", rng.choice(steps), 3, voice, chord=True)
+        else:
+            add_note(measure, divisions, "quarter", voice=voice)
+
+    for p in range(1, parts + 1):
+        part = ET.SubElement(score, "part", {"id":"P%d" % p})
+
+        for m in range(0 if upbeat else 1, measures + 1):
+            if m == 0:
+                measure = ET.SubElement(part, "measure", {"number":"0", "implicit":"yes"})
+            else:
+                measure = ET.SubElement(part, "measure", {"number":str(m)})
+
+            # 最初の小節の属性とテンポ
+            if m == (0 if upbeat else 1):
+                attributes = ET.SubElement(measure, "attributes")
+                ET.SubElement(attributes, "divisions").text = str(divisions)
+                key = ET.SubElement(attributes, "key")
+                ET.SubElement(key, "fifths").text = str(rng.randint(-3, 3))
+                t = ET.SubElement(attributes, "time")
+                ET.SubElement(t, "beats").text = "4"
+                ET.SubElement(t, "beat-type").text = "4"
+                if p == 1:
+                    direction = ET.SubElement(measure, "direction", {"placement":"above"})
+                    metronome = ET.SubElement(ET.SubElement(direction, "direction-type"), "metronome")
+                    ET.SubElement(metronome, "beat-unit").text = "quarter"
+                    ET.SubElement(metronome, "per-minute").text = "120"
+                    ET.SubElement(direction, "sound", {"tempo":"120"})
+
+            # 弱起は1拍
+            if m == 0:
+                add_beat(measure)
+                continue
+
+            # 全休符の小節
+            if rng.random() < 0.05:
+                add_note(measure, m_len, "whole", whole_rest=True)
+                continue
+
+            for beat in range(4):
+                if p == 1 and rng.random() < harmony:
+                    add_harmony(measure)
+                add_beat(measure)
+
+            # 第2声部
+            if rng.random() < 0.2:
+                backup = ET.SubElement(measure, "backup")
+                ET.SubElement(backup, "duration").text = str(m_len)
+                add_note(measure, m_len, "whole", "C", 3, voice=2)
+
+    return x2v.WriteHeader() + "\n" + ET.tostring(score)
+
+
+def _run_stage(stage, xml_file, queue):
+    """Run one stage in a child process and put its results into queue
+
+    計測対象の段階に必要な入力はあらかじめ用意し，その後の時間とメモリの増分を計測する
+    失敗した場合は {"error":エラーメッセージ} をqueueに入れる (親プロセスが待ち続けないように)"""
+
+    try:
+        queue.put(_time_stage(stage, xml_file))
+    except Exception as e:
+        queue.put({"error":"%s: %s" % (type(e).__name__, e)})
+
+
+def _time_stage(stage, xml_file):
+
+    # 入力の用意
+    if stage != "extract_bs4" and stage != "extract_iterparse":
+        piece_info, melody, chords = x2v.load_music(xml_file, "iterparse")
+    if stage == "windows":
+        # xml2npyと同じく窓の単位 (4分音符 = 24) に正規化してから切り出す
+        piece_info, melody, chords = x2v.normalize_music((piece_info, melody, chords), 24)
+    if stage == "finalize":
+        score = _write_score(piece_info, melody, chords)
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+
+    if stage == "extract_bs4":
+        piece_info, melody, _ = x2v.load_music(xml_file, "bs4")
+    elif stage == "extract_iterparse":
+        piece_info, melody, _ = x2v.load_music(xml_file, "iterparse")
+    elif stage == "windows":
+        for window in xml2npy.iter_melody_windows(melody, piece_info):
+            pass
+    elif stage == "write_score":
+        score = _write_score(piece_info, melody, chords)
+    elif stage == "finalize":
+        xml2xml.finalize(score)
+
+    elapsed = time.time() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrssの単位はLinuxではKB
+    return {"seconds":elapsed, "peak_mb":(rss_after - rss_before) / 1024.0,
+            "notes":len(melody), "measures":piece_info.measure_num}
+
+
+# 子プロセスの結果を受け取る (結果を入れずに終了した場合はエラーとする)
+def _receive(proc, queue):
+    while True:
+        try:
+            return queue.get(timeout=1.0)
+        except Queue.Empty:
+            if not proc.is_alive() and queue.empty():
+                return {"error":"stage process exited with code %s" % proc.exitcode}
+
+
+def _write_score(piece_info, melody, chords):
+    score = ET.Element("score-partwise")
+    x2v.WriteIdentification(score)
+    x2v.WriteDefaults(score)
+    x2v.WritePartList(score)
+    x2v.WriteScore(score, piece_info, melody, chords)
+    return score
+
+
+def bench_stages(xml_file, stages=STAGES, repeat=3):
+    """Time each stage on xml_file
+
+    各段階を別プロセスでrepeat回実行し，最短の時間と最小のピークメモリを採用する
+    失敗した段階は {"error":エラーメッセージ} とし，残りの段階は続ける
+
+    return: {段階:{"seconds", "peak_mb", "notes", "measures", "notes_per_s", "measures_per_s"}, ...}"""
+
+    results = {}
+    for stage in stages:
+        best = None
+        for _ in range(repeat):
+            queue = multiprocessing.Queue()
+            proc  = multiprocessing.Process(target=_run_stage, args=(stage, xml_file, queue))
+            proc.start()
+            res = _receive(proc, queue)
+            proc.join()
+
+            if "error" in res:
+                best = res
+                break
+            if best is None:
+                best = res
+            else:
+                best["seconds"] = min(best["seconds"], res["seconds"])
+                best["peak_mb"] = min(best["peak_mb"], res["peak_mb"])
+
+        results[stage] = best
+        if "error" in best:
+            continue
+        seconds = max(best["seconds"], 1e-9)
+        best["notes_per_s"]    = best["notes"] / seconds
+        best["measures_per_s"] = best["measures"] / seconds
+
+    return results
+
+
+def current_commit():
+    """Return the current git commit hash ('' if unknown)"""
+
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+# 結果のデフォルトの保存先 ($XDG_CACHE_HOME/xml2vec/benchmark_results.jsonl)
+# 作業ディレクトリ (リポジトリ内など) を汚さないようにユーザーのキャッシュディレクトリに置く
+RESULTS_PATH = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+                            "xml2vec", "benchmark_results.jsonl")
+
+
+def load_results(path):
+    """Load stored results (list of dict)"""
+
+    if not os.path.exists(path):
+        return []
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def main():
+
+    # 引数取得
+    parser = argparse.ArgumentParser(description='Benchmark extraction, rasterization and writing of MusicXML')
+    parser.add_argument('--in_dir', '-d', default='',
+                        help='Directory of MusicXML files. If specified, only extraction is timed per file')
+    parser.add_argument('--parser', choices=x2v.PARSERS, default='bs4',
+                        help='Parser used in extraction with --in_dir (default=bs4)')
+    parser.add_argument('--repeat', '-r', type=int, default=3,
+                        help='Number of repetitions, the best one is reported (default=3)')
+    # 生成する楽譜
+    parser.add_argument('--measures', type=int, default=256,
+                        help='Number of measures of the generated score (default=256)')
+    parser.add_argument('--parts', type=int, default=2,
+                        help='Number of parts of the generated score (default=2)')
+    parser.add_argument('--divisions', type=int, default=24,
+                        help='Divisions of the generated score (default=24)')
+    parser.add_argument('--harmony', type=float, default=0.5,
+                        help='Probability of a chord on each beat (default=0.5)')
+    parser.add_argument('--tuplets', type=float, default=0.1,
+                        help='Probability of a triplet on each beat (default=0.1)')
+    parser.add_argument('--upbeat', action='store_true', default=False,
+                        help='Start the generated score with an upbeat')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed of the generated score (default=0)')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES),
+                        help='Stages to be timed (default=all)')
+    # 結果の保存と比較
+    parser.add_argument('--results', default=RESULTS_PATH,
+                        help='File where results are appended as JSON lines (default=%s)' % RESULTS_PATH)
+    parser.add_argument('--compare', action='store_true', default=False,
+                        help='Compare with the last stored result of the same configuration')
+    args = parser.parse_args()
+
+    if args.in_dir != '':
+        bench_dir(args)
+        return
+
+    config = {"measures":args.measures, "parts":args.parts, "divisions":args.divisions,
+              "harmony":args.harmony, "tuplets":args.tuplets, "upbeat":args.upbeat,
+              "seed":args.seed}
+
+    # 楽譜を生成して一時ファイルに保存
+    fd, xml_file = tempfile.mkstemp(suffix=".xml")
+    with os.fdopen(fd, "w") as f:
+        f.write(generate_score(**config))
+
+    try:
+        results = bench_stages(xml_file, args.stages, args.repeat)
+    finally:
+        os.remove(xml_file)
+
+    # 前回の結果
+    previous = None
+    if args.compare:
+        for record in load_results(args.results):
+            if record["config"] == config:
+                previous = record
+
+    print "config: %s" % json.dumps(config, sort_keys=True)
+    print "%-18s %10s %12s %12s %10s %10s" % ("stage", "time[s]", "notes/s", "measures/s",
+                                              "peak[MB]", "vs prev")
+    for stage in args.stages:
+        res = results[stage]
+        if "error" in res:
+            print "%-18s failed: %s" % (stage, res["error"])
+            continue
+        change = ""
+        if previous is not None and "seconds" in previous["results"].get(stage, {}):
+            prev = previous["results"][stage]["seconds"]
+            change = "%+.1f%%" % (100.0 * (res["seconds"] - prev) / max(prev, 1e-9))
+        print "%-18s %10.4f %12.1f %12.1f %10.1f %10s" % (stage, res["seconds"], res["notes_per_s"],
+                                                          res["measures_per_s"], res["peak_mb"], change)
+    if previous is not None:
+        print "compared with %s (%s)" % (previous["commit"] or "unknown commit", previous["date"])
+
+    # 結果を追記
+    record = {"commit":current_commit(), "date":time.strftime("%Y-%m-%d %H:%M:%S"),
+              "python":sys.version.split()[0], "config":config, "results":results}
+    results_dir = os.path.dirname(os.path.abspath(args.results))
+    if not os.path.isdir(results_dir):
+        os.makedirs(results_dir)
+    with open(args.results, "a") as f:
+        f.write(json.dumps(record, sort_keys=True) + "\n")
+
+    if any("error" in res for res in results.values()):
+        sys.exit(1)
+
+
+def bench_dir(args):
+    """Time extraction of each MusicXML file in args.in_dir"""
+
+    xmls = sorted(f for f in os.listdir(args.in_dir) if x2v.is_score_file(f))
+
+    total_load = total_extract = 0.0
+    total_notes = total_measures = 0
+
+    print "%-30s %10s %10s %8s %8s" % ("file", "load[s]", "extract[s]", "notes", "measures")
+    for xml in xmls:
+        load, extract, notes, measures = bench_extract(os.path.join(args.in_dir, xml),
+                                                       args.parser, args.repeat)
+        print "%-30s %10.4f %10.4f %8d %8d" % (xml, load, extract, notes, measures)
+
+        total_load     += load
+        total_extract  += extract
+        total_notes    += notes
+        total_measures += measures
+
+    # 合計
+    print "%-30s %10.4f %10.4f %8d %8d" % ("total", total_load, total_extract,
+                                          total_notes, total_measures)
+    total = total_load + total_extract
+    if total > 0:
+        print "throughput: %.1f notes/s, %.1f measures/s (load + extract)" \
+            % (total_notes / total, total_measures / total)
+    if total_extract > 0:
+        print "extract only: %.1f notes/s" % (total_notes / total_extract)
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""Convert piano-roll Numpy arrays back into MusicXML
+
+xml2npyの逆変換
+xml2npyで保存した窓 (.npy) やshard (--format shard, events)，モデルが出力した同じ形の配列を
+音符列に戻し (xml2npy.decode_rolls)，窓ごとにMusicXMLとして保存する
+shardの窓の拍子は索引 (shard_index.csv) から読む．.npyの配列には拍子の情報はないので--timeで指定する
+(調はハ長調，テンポは既定値)
+"""
+
+import os
+import sys
+import argparse
+import itertools
+
+import numpy as np
+
+import xml2vec as x2v
+import xml2npy as x2n
+
+
+def iter_windows(args):
+    """Decode windows given by command line arguments
+
+    yield: (保存するファイル名, (曲情報, 音符列, コード進行))"""
+
+    options = {'r':args.divisions, 'meter':args.time, 'threshold':args.threshold}
+
+    # shardの場合は索引から窓の名前と拍子を求める
+    if args.shard_dir != '':
+        index  = x2n.read_shard_index(args.shard_dir)
+        shards = sorted(set(shard for _, _, _, shard, _, _ in index))
+        for shard in shards:
+            for name, start, end, piece, melody in x2n.decode_shard(args.shard_dir, shard, index=index,
+                                                                    **options):
+                yield '{}_{}-{}.xml'.format(name, start, end), (piece, melody, {})
+        return
+
+    if args.in_dir != '':
+        root  = args.in_dir
+        files = sorted(f for f in os.listdir(root) if f.endswith('.npy'))
+    else:
+        root, fname = os.path.split(args.in_file)
+        files = [fname]
+
+    for f in files:
+        (piece, melody), = x2n.decode_rolls(np.load(os.path.join(root, f), mmap_mode='r'),
+                                            voices=args.voices, **options)
+        yield os.path.splitext(f)[0] + '.xml', (piece, melody, {})
+
+
+def parse_time(text):
+    """Parse --time such as '3/4' into (3, 4)"""
+
+    beats, beat_type = text.split('/')
+    return int(beats), int(beat_type)
+
+
+if __name__ == "__main__":
+
+    # 引数取得
+    parser = argparse.ArgumentParser(description='Convert piano-roll Numpy arrays into MusicXML')
+    parser.add_argument('--in_file', '-i', default='',
+                        help='Input .npy file of one window')
+    parser.add_argument('--in_dir', '-d', default='',
+                        help='Directory of .npy files of windows')
+    parser.add_argument('--shard_dir', '-s', default='',
+                        help="""Directory of shards and shard_index.csv written by xml2npy --format shard/events
+                        Output file name is NAME_START-END.xml""")
+    parser.add_argument('--out_dir', '-o', default='',
+                        help='Directory of output MusicXML files')
+    parser.add_argument('--divisions', type=int, default=24,
+                        help='Length of a quarter note in the arrays (default=24)')
+    parser.add_argument('--time', default='4/4',
+                        help="""Time signature of the arrays (default=4/4)
+                        Shards use the time signatures in shard_index.csv, this is used only for
+                        old indexes without them""")
+    parser.add_argument('--voices', action="store_true", default=False,
+                        help='The .npy arrays have voice channels (xml2npy --voices)')
+    parser.add_argument('--threshold', type=float, default=0.5,
+                        help='Elements greater than this value are notes (default=0.5)')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='Number of worker processes writing MusicXML (default=1)')
+    args = parser.parse_args()
+    if [args.in_file, args.in_dir, args.shard_dir].count('') != 2:
+        parser.error("one of IN_FILE, IN_DIR and SHARD_DIR must be specified")
+    try:
+        args.time = parse_time(args.time)
+    except ValueError:
+        parser.error("invalid --time: %s" % args.time)
+
+    # 窓ごとに音符列に戻してMusicXMLを書き込む (名前と楽譜を順に取り出して渡す)
+    names, musics = itertools.tee(iter_windows(args))
+    paths  = (os.path.join(args.out_dir, name) for name, _ in names)
+    musics = (music for _, music in musics)
+    count, failures = x2v.WriteScores(musics, paths, args.jobs)
+
+    print "%d MusicXML files are saved in %s" % (count, args.out_dir or '.')
+
+    # 書き込めなかった窓の一覧
+    if failures:
+        print "{} of {} windows failed:".format(len(failures), count + len(failures))
+        for path, error in failures:
+            print "  {}: {}".format(path, error)
+        sys.exit(1)
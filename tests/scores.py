@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""Small MusicXML scores written by hand for the tests
+
+テスト用の小さなMusicXMLを文字列で組み立てる
+リポジトリのモジュールを読み込めるようにsys.pathも設定する
+"""
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+# 音符 <note> (stepがNoneなら休符，unpitched=Trueなら打楽器の<unpitched>)
+def note(duration, step=None, octave=4, alter=0, n_type="quarter", voice=1, chord=False,
+         unpitched=False):
+    out = ["<note>"]
+    if chord:
+        out.append("<chord/>")
+    if step is None:
+        out.append("<rest/>")
+    elif unpitched:
+        out.append("<unpitched><display-step>%s</display-step>"
+                   "<display-octave>%d</display-octave></unpitched>" % (step, octave))
+    else:
+        out.append("<pitch><step>%s</step>" % step)
+        if alter:
+            out.append("<alter>%d</alter>" % alter)
+        out.append("<octave>%d</octave></pitch>" % octave)
+    out.append("<duration>%d</duration><voice>%d</voice><type>%s</type></note>"
+               % (duration, voice, n_type))
+    return "".join(out)
+
+
+# コード <harmony>
+def harmony(step, kind="major", text=""):
+    return ('<harmony><root><root-step>%s</root-step></root><kind text="%s">%s</kind></harmony>'
+            % (step, text, kind))
+
+
+# <backup>
+def backup(duration):
+    return "<backup><duration>%d</duration></backup>" % duration
+
+
+# <attributes> (Noneの要素は書かない)
+def attributes(divisions=None, fifths=None, beats=None, beat_type=None):
+    out = ["<attributes>"]
+    if divisions is not None:
+        out.append("<divisions>%d</divisions>" % divisions)
+    if fifths is not None:
+        out.append("<key><fifths>%d</fifths></key>" % fifths)
+    if beats is not None:
+        out.append("<time><beats>%d</beats><beat-type>%d</beat-type></time>" % (beats, beat_type))
+    out.append("</attributes>")
+    return "".join(out)
+
+
+# テンポ <direction>
+def tempo(bpm):
+    return ('<direction placement="above"><direction-type><metronome><beat-unit>quarter</beat-unit>'
+            '<per-minute>%d</per-minute></metronome></direction-type><sound tempo="%d"/></direction>'
+            % (bpm, bpm))
+
+
+def score(parts):
+    """Build a score-partwise document
+
+    parts -- [(パートID, パート名, [小節の中身[str], ...]), ...] (小節番号は1から)"""
+
+    out = ['<?xml version="1.0" encoding="UTF-8"?>\n<score-partwise version="3.0"><part-list>']
+    for part_id, name, _ in parts:
+        out.append('<score-part id="%s"><part-name>%s</part-name></score-part>' % (part_id, name))
+    out.append("</part-list>")
+    for part_id, _, measures in parts:
+        out.append('<part id="%s">' % part_id)
+        for number, contents in enumerate(measures, 1):
+            out.append('<measure number="%d">%s</measure>' % (number, contents))
+        out.append("</part>")
+    out.append("</score-partwise>\n")
+    return "".join(out)
+
+
+def melody_score(measures=4, divisions=4, beats=4, beat_type=4, fifths=0, chords=True):
+    """One-part score of quarter notes going up the C major scale (with a chord on each measure)"""
+
+    steps = ["C", "D", "E", "F", "G", "A", "B"]
+    beat  = divisions * 4 // beat_type
+    contents = []
+    for m in range(measures):
+        head = attributes(divisions, fifths, beats, beat_type) + tempo(100) if m == 0 else ""
+        if chords:
+            head += harmony(steps[(m * 3) % 7], "major" if m % 2 else "minor", "" if m % 2 else "m")
+        notes = [note(beat, steps[(m * beats + b) % 7], 4 + (m * beats + b) // 7 % 2,
+                      n_type="quarter" if beat_type == 4 else "eighth") for b in range(beats)]
+        contents.append(head + "".join(notes))
+    return score([("P1", "Melody", contents)])
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""Tests of the stage benchmark in benchmark.py"""
+
+import os
+import tempfile
+import unittest
+
+import scores
+import benchmark
+
+
+# 結果を返さずに終了する段階 (子プロセスで動く)
+def exit_stage(stage, xml_file):
+    os._exit(3)
+
+
+class BenchStagesTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.xml_file = tempfile.mkstemp(suffix=".xml")
+        with os.fdopen(fd, "w") as f:
+            # 4分音符 = 10 は窓の単位 (24) を割り切らない
+            f.write(benchmark.generate_score(measures=8, divisions=10))
+        self.time_stage = benchmark._time_stage
+
+    def tearDown(self):
+        benchmark._time_stage = self.time_stage
+        os.remove(self.xml_file)
+
+    def test_divisions(self):
+        results = benchmark.bench_stages(self.xml_file, ["windows"], 1)
+        self.assertNotIn("error", results["windows"])
+        self.assertEqual(results["windows"]["measures"], 8)
+
+    def test_failed_stage(self):
+        # 失敗した段階は待ち続けずにエラーとし，残りの段階は計測する
+        results = benchmark.bench_stages(self.xml_file + ".missing", ["windows", "extract_iterparse"], 2)
+        self.assertTrue(results["windows"]["error"].startswith("IOError"))
+        self.assertIn("error", results["extract_iterparse"])
+
+    def test_exited_stage(self):
+        benchmark._time_stage = exit_stage
+        results = benchmark.bench_stages(self.xml_file, ["windows"], 1)
+        self.assertEqual(results["windows"]["error"], "stage process exited with code 3")
+
+
+if __name__ == "__main__":
+    unittest.main()
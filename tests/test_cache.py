@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Tests of xml2vec.MusicCache"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import scores
+import xml2vec as x2v
+
+
+class MusicCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir   = tempfile.mkdtemp()
+        self.data  = scores.melody_score()
+        self.music = x2v.parse_music(self.data, "iterparse")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        cache = x2v.MusicCache(self.dir)
+        key   = cache.key(self.data)
+        self.assertIsNone(cache.get(key))
+        cache.put(key, self.music)
+        piece, melody, chords = cache.get(key)
+        self.assertEqual(piece.time, self.music[0].time)
+        self.assertEqual(melody.array.tolist(), self.music[1].array.tolist())
+        self.assertEqual(sorted(chords), sorted(self.music[2]))
+        # コードは語彙の共有のChordになる
+        for t, chord in chords.items():
+            self.assertIs(chord, x2v.intern_chord(self.music[2][t]))
+
+    def test_pack_chords(self):
+        # 番号はコード進行ごとに振り直すので，他の語彙 (他のプロセス) でも戻せる
+        progression, keys = x2v.CHORD_VOCAB.pack(self.music[2])
+        self.assertEqual(progression.dtype, x2v.PROGRESSION_DTYPE)
+        self.assertEqual(sorted(set(progression['id'].tolist())), range(len(keys)))
+        vocab  = x2v.ChordVocabulary()
+        chords = vocab.unpack(progression, keys)
+        self.assertEqual(dict((t, c.get_key()) for t, c in chords.items()),
+                         dict((t, c.get_key()) for t, c in self.music[2].items()))
+        self.assertEqual(len(vocab), len(keys))
+        self.assertEqual(x2v.CHORD_VOCAB.unpack(*x2v.CHORD_VOCAB.pack({})), {})
+
+    def test_broken_entry_is_miss(self):
+        cache = x2v.MusicCache(self.dir)
+        # pickleとしては読めても中身の形が違うもの，pickleとして読めないもの
+        for i, content in enumerate(["I1\n.", "\x80\x02cnope\nNope\nq\x00.", "garbage"]):
+            with open(cache.path("broken%d" % i), "wb") as f:
+                f.write(content)
+            self.assertIsNone(cache.get("broken%d" % i))
+
+    def test_trim_on_put(self):
+        cache = x2v.MusicCache(self.dir, max_bytes=1)
+        cache.put(cache.key(self.data), self.music)
+        cache.put(cache.key(self.data, "-other"), self.music)
+        # 上限を超えた分はputのたびに削除される
+        self.assertEqual(os.listdir(self.dir), [])
+
+        cache = x2v.MusicCache(self.dir, max_bytes=1 << 20)
+        for i in range(3):
+            cache.put(cache.key(self.data, str(i)), self.music)
+        self.assertEqual(len(os.listdir(self.dir)), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
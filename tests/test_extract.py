@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""Tests of the extraction of melodies and piece information"""
+
+import unittest
+
+import scores
+from scores import note, attributes, backup, harmony, tempo
+import xml2vec as x2v
+import benchmark
+
+
+# 旋律のパートP1と打楽器のパートP2 (<unpitched>) からなる楽譜
+def drum_score():
+    melody = [attributes(2, 0, 4, 4) + "".join(note(2, s) for s in "CDEF"),
+              "".join(note(2, s) for s in "GABC")]
+    drums  = [attributes(2, 0, 4, 4) + note(2, "F", 4, unpitched=True) + note(2) +
+              note(2, "C", 5, unpitched=True) + note(2, "C", 5, unpitched=True, chord=True) +
+              note(2, "F", 4, unpitched=True) + backup(6) + note(6, "G", 5, voice=2, unpitched=True),
+              note(8, "E", 4, n_type="whole", unpitched=True)]
+    return scores.score([("P1", "Melody", melody), ("P2", "Drums", drums)])
+
+
+class UnpitchedTest(unittest.TestCase):
+
+    def parts(self, parser, poly):
+        return x2v.parse_parts(drum_score(), parser, ["P2"], poly)[0]
+
+    def test_mono(self):
+        for parser in x2v.PARSERS:
+            piece, melody = self.parts(parser, False)["P2"]
+            # 打楽器の音符は表示位置の音程になり，休符は休符のまま
+            self.assertEqual(list(melody.array['step']), ["F", "R", "C", "F", "E"])
+            self.assertEqual(list(melody.array['midi']), [65, -1, 72, 65, 64])
+            self.assertEqual(list(melody.array['time']), [0, 2, 4, 6, 8])
+
+    def test_poly(self):
+        for parser in x2v.PARSERS:
+            piece, melody = self.parts(parser, True)["P2"]
+            self.assertEqual(sorted(zip(melody.array['time'], melody.array['midi'])),
+                             [(0, 65), (2, 79), (4, 72), (4, 72), (6, 65), (8, 64)])
+
+
+# 拍子，調，テンポが途中で変わり，和音と休符のある2パートの楽譜
+def changing_score():
+    melody = [attributes(4, 2, 2, 4) + tempo(90) + note(4, "D") + note(4),
+              harmony("D") + note(8, "F", alter=1, n_type="half") + note(8, "A", chord=True, n_type="half"),
+              attributes(fifths=-3, beats=3, beat_type=4) + tempo(140) + note(6, "E", alter=-1, n_type="quarter") +
+              note(2, "G", n_type="eighth") + harmony("C", "minor", "m") + note(4),
+              attributes(beats=6, beat_type=8) + "".join(note(2, s, n_type="eighth") for s in "CDEFGA")]
+    bass   = [attributes(4, 2, 2, 4) + note(8, "D", 2, n_type="half"),
+              note(8, "D", 2, n_type="half"),
+              attributes(fifths=-3, beats=3, beat_type=4) + note(12, "C", 2, n_type="half"),
+              attributes(beats=6, beat_type=8) + note(6, "F", 2) + backup(6) + note(6, "A", 2, voice=2)]
+    return scores.score([("P1", "Melody", melody), ("P2", "Bass", bass)])
+
+
+# 比較のために曲情報を辞書に，コードをキーにする
+def comparable(piece, melody):
+    return dict((k, v) for k, v in piece.__dict__.items() if not k.startswith("_")), melody.array.tolist()
+
+
+def chord_keys(chords):
+    return dict((t, chord.get_key()) for t, chord in chords.items())
+
+
+class EquivalenceTest(unittest.TestCase):
+    """BeautifulSoupとiterparseの抽出結果が同じであること"""
+
+    def documents(self):
+        yield changing_score()
+        yield scores.melody_score(5, 6, 3, 4, fifths=-2)
+        for seed, upbeat in [(0, False), (1, True), (2, True)]:
+            yield benchmark.generate_score(measures=12, parts=3, harmony=0.5, tuplets=0.3,
+                                           upbeat=upbeat, seed=seed)
+
+    def test_music(self):
+        for data in self.documents():
+            bs4, stream = [x2v.parse_music(data, parser) for parser in x2v.PARSERS]
+            self.assertEqual(comparable(*bs4[:2]), comparable(*stream[:2]))
+            self.assertEqual(chord_keys(bs4[2]), chord_keys(stream[2]))
+
+    def test_parts(self):
+        for data in self.documents():
+            for poly in (False, True):
+                (bs4, bs4_chords), (stream, stream_chords) = [x2v.parse_parts(data, parser, poly=poly)
+                                                              for parser in x2v.PARSERS]
+                self.assertEqual(list(bs4), list(stream))
+                for part in bs4:
+                    self.assertEqual(comparable(*bs4[part]), comparable(*stream[part]))
+                self.assertEqual(chord_keys(bs4_chords), chord_keys(stream_chords))
+
+
+if __name__ == "__main__":
+    unittest.main()
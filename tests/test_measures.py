@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""Tests of xml2vec.MeasureTable"""
+
+import unittest
+
+import xml2vec as x2v
+
+
+class MeasureTableTest(unittest.TestCase):
+
+    def test_changes(self):
+        info = x2v.PieceInfo()
+        info.measure_num = 4
+        info.set_time(3, 3, 4)
+        info.set_tempo(2, 60, "quarter", 60)
+        table = info.measures()
+        self.assertEqual(table.length.tolist(), [16, 16, 12, 12])
+        self.assertEqual(table.start.tolist(), [0, 16, 32, 44])
+        self.assertEqual(table.measure_at([0, 31, 44]).tolist(), [1, 2, 4])
+        self.assertEqual(table.seconds([16, 32]).tolist(), [2.0, 6.0])
+
+    def test_empty(self):
+        # 小節のない楽譜 (measure_num == 0) では空の表になる
+        table = x2v.PieceInfo().measures()
+        self.assertEqual(len(table), 0)
+        self.assertEqual(table.end, 0)
+        self.assertEqual(table.beats.shape, (0,))
+        self.assertEqual(table.index_at([0, 1]).tolist(), [-1, -1])
+        self.assertEqual(float(table.seconds(8)), 1.0)
+        with self.assertRaises(ValueError):
+            table.measure_at(0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""Tests of xml2vec.Melody"""
+
+import unittest
+
+import numpy as np
+
+import scores
+import xml2vec as x2v
+
+
+# (時刻, 長さ) の音符列 (間に隙間があってもよい)
+def make_melody(spans):
+    return x2v.Melody.from_records([(t, d, 60, "C", 0, 4, False, False) for t, d in spans])
+
+
+class IndexAtTest(unittest.TestCase):
+
+    def test_matches_linear_search(self):
+        spans  = [(0, 4), (4, 2), (8, 1), (9, 3), (15, 5)]
+        melody = make_melody(spans)
+        ticks  = np.arange(-3, 25)
+        expected = [next((i for i, (t, d) in enumerate(spans) if t <= tick < t + d), -1)
+                    for tick in ticks]
+        self.assertEqual(melody.index_at(ticks).tolist(), expected)
+        self.assertEqual(int(melody.index_at(9)), 3)
+        self.assertIsNone(melody.note_at(7))
+        self.assertEqual(melody.note_at(16).time, 15)
+
+    def test_long_piece(self):
+        # 時刻ごとの表を作らないので，時刻の値が大きくても小さな配列で済む
+        melody = make_melody([(0, 10 ** 9), (10 ** 9, 10 ** 9)])
+        self.assertEqual(melody.index_at([0, 10 ** 9 - 1, 10 ** 9, 2 * 10 ** 9]).tolist(), [0, 0, 1, -1])
+
+    def test_empty(self):
+        self.assertEqual(make_melody([]).index_at([0, 1]).tolist(), [-1, -1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""Tests of xml2vec.normalize_music"""
+
+import unittest
+
+import scores
+import xml2vec as x2v
+
+
+class NormalizeMusicTest(unittest.TestCase):
+
+    def setUp(self):
+        self.music = x2v.parse_music(scores.melody_score(4, 4, 3, 4, fifths=2), "iterparse")
+
+    def test_rescale(self):
+        piece, melody, _ = x2v.normalize_music(self.music, 24)
+        self.assertEqual(piece.divisions[1], 24)
+        self.assertEqual(piece.measures().length.tolist(), [72] * 4)
+        self.assertEqual(melody.array['duration'].tolist(), [24] * len(melody))
+
+    def test_piece_info_is_copied(self):
+        source = self.music[0]
+        piece  = x2v.normalize_music(self.music, 24)[0]
+        # 入れ子の辞書やリストを書き換えても元の曲情報は変わらない
+        piece.set_key(1, 3, -1)
+        piece.set_time(3, 6, 8)
+        piece.tempo[1][0] = 60
+        self.assertEqual(source.key[1], {1:2})
+        self.assertEqual(source.time, {1:[3, 4]})
+        self.assertEqual(source.tempo[1][0], 100)
+        self.assertEqual(source.measures().beats.tolist(), [3] * 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""Tests of reading compressed MusicXML with xml2vec.open_score"""
+
+import os
+import gzip
+import shutil
+import zipfile
+import tempfile
+import unittest
+
+import scores
+import xml2vec as x2v
+
+
+class OpenScoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir  = tempfile.mkdtemp()
+        self.data = scores.melody_score()
+        self.path = os.path.join(self.dir, "piece")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def check(self, path):
+        with open(path, "rb") as f:
+            stream = x2v.decompress_score(f)
+            self.assertEqual(stream.read(), self.data)
+            stream.close()
+            # 展開用のファイルオブジェクトを閉じると元のファイルも閉じる
+            self.assertTrue(f.closed)
+        self.assertTrue(x2v.is_score_file(path))
+        self.assertEqual(len(x2v.load_music(path, "iterparse")[1]), 16)
+
+    def test_gzip(self):
+        path = self.path + ".xml.gz"
+        with open(path, "wb") as raw:
+            gz = gzip.GzipFile(fileobj=raw, mode="wb")
+            gz.write(self.data)
+            gz.close()
+        self.check(path)
+
+    def test_mxl(self):
+        path = self.path + ".mxl"
+        archive = zipfile.ZipFile(path, "w")
+        archive.writestr("META-INF/container.xml",
+                         '<container><rootfiles><rootfile full-path="score.xml"/></rootfiles></container>')
+        archive.writestr("score.xml", self.data)
+        archive.close()
+        self.check(path)
+
+
+if __name__ == "__main__":
+    unittest.main()
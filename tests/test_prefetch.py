@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""Tests of parallel conversion with prefetching in xml2npy.main"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+import scores
+import xml2npy as x2n
+
+
+# 変換の代わりに，開始と終了の時刻を記録して一定時間待つ (ワーカーのプロセスで動く)
+def slow_convert(job):
+    root, xml, args, data, read_seconds = job
+    start = time.time()
+    time.sleep(0.3)
+    with open(os.path.join(args.out_dir, xml + ".span"), "w") as f:
+        f.write("%r %r" % (start, time.time()))
+    return xml, None, None, None, None, None
+
+
+class PrefetchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.in_dir  = tempfile.mkdtemp()
+        self.out_dir = tempfile.mkdtemp()
+        for i in range(8):
+            with open(os.path.join(self.in_dir, "%d.xml" % i), "w") as f:
+                f.write(scores.melody_score())
+        self.convert_file, x2n.convert_file = x2n.convert_file, slow_convert
+        self.argv = sys.argv
+
+    def tearDown(self):
+        x2n.convert_file = self.convert_file
+        sys.argv = self.argv
+        shutil.rmtree(self.in_dir)
+        shutil.rmtree(self.out_dir)
+
+    # 同時に変換していたファイルの数の最大値
+    def concurrency(self, jobs, prefetch):
+        sys.argv = ["xml2npy.py", "--in_dir", self.in_dir, "--out_dir", self.out_dir,
+                    "--jobs", str(jobs), "--prefetch", str(prefetch)]
+        x2n.main()
+        spans = []
+        for name in os.listdir(self.out_dir):
+            with open(os.path.join(self.out_dir, name)) as f:
+                spans.append(tuple(float(v) for v in f.read().split()))
+        self.assertEqual(len(spans), 8)
+        return max(sum(1 for s, e in spans if s <= start < e) for start, _ in spans)
+
+    def test_jobs_more_than_prefetch(self):
+        # 先読みの数より並列数が多くても，並列数だけ同時に変換する
+        self.assertEqual(self.concurrency(4, 1), 4)
+
+    def test_without_prefetch(self):
+        self.assertEqual(self.concurrency(4, 0), 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""Tests of shards written by xml2npy and their decoding"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import scores
+from scores import note, attributes
+import xml2vec as x2v
+import xml2npy as x2n
+
+
+# 4/4の2小節の後に3/4の4小節が続く楽譜
+def changing_score():
+    measures = []
+    for m in range(6):
+        beats = 4 if m < 2 else 3
+        head  = attributes(4, 0, 4, 4) if m == 0 else attributes(beats=3, beat_type=4) if m == 2 else ""
+        measures.append(head + "".join(note(4, "CDEFGAB"[(m + b) % 7]) for b in range(beats)))
+    return scores.score([("P1", "Melody", measures)])
+
+
+def extract(xml, r=24):
+    music = x2v.parse_music(xml, "iterparse")
+    return x2v.normalize_music(music, r)[:2]
+
+
+class ShardMeterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+        # 3/4と6/8の4小節の窓は同じ形なので同じshardに入る
+        self.pieces = [("waltz", extract(scores.melody_score(8, 4, 3, 4))),
+                       ("jig", extract(scores.melody_score(5, 4, 6, 8))),
+                       ("change", extract(changing_score()))]
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def write(self, writer, span):
+        shards = writer(self.out_dir, shard_size=64)
+        expected = {}
+        for name, (info, melody) in self.pieces:
+            for start, end, arr, meters in x2n.iter_melody_windows(melody, info, meters=None, span=span,
+                                                                  with_meters=True):
+                shards.add(name, start, end, x2n.to_piano_roll(arr), meters=meters)
+                expected[(name, start)] = (end, meters, arr)
+        shards.close()
+        return expected
+
+    def check(self, writer, span):
+        expected = self.write(writer, span)
+        index    = x2n.read_shard_index(self.out_dir)
+        self.assertEqual(len(index), len(expected))
+        decoded = []
+        for shard in sorted(set(row[3] for row in index)):
+            decoded.extend(x2n.decode_shard(self.out_dir, shard, index=index))
+        self.assertEqual(len(decoded), len(expected))
+
+        for name, start, end, piece, melody in decoded:
+            exp_end, meters, arr = expected[(name, start)]
+            self.assertEqual(end, exp_end)
+            table = piece.measures()
+            self.assertEqual(zip(table.beats.tolist(), table.beat_type.tolist()), meters)
+            # 音符列に戻した窓をもう一度配列にすると元の窓になる
+            (_, _, again), = x2n.iter_melody_windows(melody, piece, meters=None, span=True)
+            np.testing.assert_array_equal(again, arr)
+        return index
+
+    def test_dense_shard(self):
+        index = self.check(x2n.ShardWriter, span=False)
+        times = dict(((name, start), meters) for name, start, _, _, _, meters in index)
+        self.assertEqual(times[("waltz", 1)], [(3, 4)])
+        self.assertEqual(times[("jig", 1)], [(6, 8)])
+
+    def test_event_shard(self):
+        self.check(x2n.EventShardWriter, span=False)
+
+    def test_spanning_windows(self):
+        index = self.check(x2n.ShardWriter, span=True)
+        times = dict(((name, start), meters) for name, start, _, _, _, meters in index)
+        self.assertEqual(times[("change", 1)], [(4, 4), (4, 4), (3, 4), (3, 4)])
+
+    def test_old_index_uses_meter(self):
+        self.write(x2n.ShardWriter, span=False)
+        # 拍子の列がない索引では引数の拍子を使う
+        path = os.path.join(self.out_dir, x2n.SHARD_INDEX)
+        with open(path) as f:
+            lines = [line.rsplit(',', 1)[0] for line in f.read().splitlines()]
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        index = [row for row in x2n.read_shard_index(self.out_dir) if row[0] == "waltz"]
+        self.assertIsNone(index[0][5])
+        waltz = [row for row in x2n.decode_shard(self.out_dir, index[0][3], meter=(3, 4))
+                 if row[0] == "waltz"]
+        self.assertEqual(waltz[0][3].measure_num, 4)
+
+
+class EventsTest(unittest.TestCase):
+
+    def test_long_window(self):
+        # int16の範囲を超える位置のイベント
+        window = np.zeros((2, 60, 40000), dtype=np.int8)
+        window[0, 5, 100:35000] = 1
+        window[1, 30, 33000:] = 1
+        pitch, onset, offset = x2n.encode_events(window[0])
+        self.assertEqual((onset[0], offset[0]), (100, 35000))
+        rows   = [x2n.encode_events(w) for w in window]
+        events = dict(shape=np.array(window.shape[1:]),
+                      indptr=np.cumsum([0] + [len(row[0]) for row in rows]))
+        for i, key in enumerate(['pitch', 'onset', 'offset']):
+            events[key] = np.concatenate([row[i] for row in rows])
+        np.testing.assert_array_equal(x2n.densify_events(events, [1, 0]), window[::-1])
+
+
+class DecodeRollsTest(unittest.TestCase):
+
+    def test_voices(self):
+        window = np.zeros((2, 60, 96), dtype=np.int8)
+        window[0, 10, :48] = 1
+        window[1, 20, 48:] = 1
+        # 声部ごとのチャンネルがある1つの窓
+        (piece, melody), = x2n.decode_rolls(window, voices=True)
+        self.assertEqual(list(melody.array['midi']), [85, 75])
+        # 声部のない窓を並べたもの
+        self.assertEqual(len(x2n.decode_rolls(window)), 2)
+
+    def test_meter_mismatch(self):
+        with self.assertRaises(ValueError):
+            x2n.decode_rolls(np.zeros((60, 96)), meter=(5, 4))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""Tests of xml2vec.WriteScores"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import scores
+import xml2vec as x2v
+
+
+class WriteScoresTest(unittest.TestCase):
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+        self.good = x2v.parse_music(scores.melody_score(), "iterparse")
+        # 2拍3連でも1拍3連でもない連符は書き込めない
+        info, melody, chords = x2v.parse_music(scores.melody_score(), "iterparse")
+        melody.array['time_mod'][1] = True
+        self.bad = info, melody, chords
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def write(self, jobs):
+        paths = [os.path.join(self.out_dir, "%d.xml" % i) for i in range(3)]
+        count, failures = x2v.WriteScores([self.good, self.bad, self.good], paths, jobs, batch=2)
+        return paths, count, failures
+
+    def check(self, jobs):
+        paths, count, failures = self.write(jobs)
+        self.assertEqual(count, 2)
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(failures[0][0], paths[1])
+        self.assertTrue(failures[0][1].startswith("ValueError"))
+        # 失敗した楽譜のファイルは残らず，他の楽譜は書き込まれている
+        self.assertFalse(os.path.exists(paths[1]))
+        for path in (paths[0], paths[2]):
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), x2v.RenderScore(*self.good))
+
+    def test_error_is_returned(self):
+        self.check(jobs=1)
+
+    def test_error_is_returned_from_workers(self):
+        self.check(jobs=2)
+
+    def test_bad_note_raises(self):
+        with self.assertRaises(ValueError):
+            x2v.RenderScore(*self.bad)
+
+
+if __name__ == "__main__":
+    unittest.main()
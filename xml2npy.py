@@ -3,8 +3,11 @@
 
 MusicXMLを読み込んで，その第１パートのメロディをNumpy配列に変換して保存する
 指定した小節数ごとに切り取り，それを1ファイルとして.npy形式で保存する
+(--format shard, eventsの場合は多数の窓を1つのファイルにまとめて保存する)
 切り取る小節数はこのスクリプトでは4小節固定で，1つまでの全休符を許してカットする
-4/4拍子の曲のみに対応
+デフォルトでは4/4拍子の区間のみ対象 (--metersで他の拍子も対象にできる)
+--polyを指定すると，重なっている音，全ての声部を含むピアノロールにする
+(--voicesを指定すると声部ごとのチャンネルに分ける)
 
 2017/10/16
 """
@@ -14,24 +17,44 @@ import re
 import argparse
 import os
 import csv
+import json
+import time
+import itertools
+import multiprocessing
+import threading
+import Queue
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 
 import xml2vec as x2v
-from bs4 import BeautifulSoup
 
 
-def extract_melody(xml_file):
-    """Extract Melody from xml_file"""
-    
-    # MusicXMLを読み込む
-    print "loading %s ..." % xml_file
-    soup = BeautifulSoup(open(xml_file, "r").read(), "lxml")
+def extract_melody(xml_file, parser="bs4", cache=None, part=None, poly=False, data=None, chords=False):
+    """Extract Melody from xml_file
 
-    # 曲情報，メロディ，コードの抽出
-    print "extracting melody and chords from %s ..." % xml_file
-    piece_info, melody, _ = x2v.extract_music(soup)
+    parser -- "bs4"ならBeautifulSoupで全体を読み込んでから，
+              "iterparse"なら逐次的に読み込みながら抽出する
+    cache  -- xml2vec.MusicCache (指定するとキャッシュがあればパースを省略する)
+    part   -- 抽出するパートのIDまたはパート名 (Noneなら第1パート)
+    poly   -- Trueなら重なっている音，全ての声部を抽出する (xml2vec.load_partを参照)
+    data   -- 読み込み済みのxml_fileの内容 (Prefetcherで先読みした場合．Noneならxml_fileを読む)
+    chords -- Trueなら (曲情報, メロディ, コード進行) を返す"""
+    
+    # MusicXMLを読み込んで曲情報，メロディ，コードを抽出
+    print "loading and extracting melody and chords from %s ..." % xml_file
+    if data is not None:
+        if part is None and not poly:
+            piece_info, melody, progression = x2v.parse_music(data, parser, cache)
+        else:
+            piece_info, melody, progression = x2v.parse_part(data, part or "P1", parser, poly, cache)
+    elif part is None and not poly:
+        piece_info, melody, progression = x2v.load_music(xml_file, parser, cache)
+    else:
+        piece_info, melody, progression = x2v.load_part(xml_file, part or "P1", parser, poly, cache)
 
+    if chords:
+        return piece_info, melody, progression
     return piece_info, melody
 
 
@@ -46,174 +69,1148 @@ def save_as_array(melody_arr, name, out_dir):
     
     
     # 転置，上下反転でピアノロール風の配列として保存
-    melody_arr = np.flipud(melody_arr.T)
+    melody_arr = to_piano_roll(melody_arr)
     
     out_path  =  os.path.join(out_dir, name)
     np.save(out_path, melody_arr)
 
     print '{} is saved.'.format(out_path)
-    
-    
-def convert_melody_into_array(melody, piece_info, name, out_dir,
-                              r=24, pitch_extent=(36, 96), cut_num=4, rest_limit=1, yamaha=False):
-    """Convert Melody into Numpy array
+
+
+def to_piano_roll(melody_arr):
+    """Transpose a window into piano-roll orientation
+
+    (時間, 音高) -> (音高 (上が高音), 時間)
+    声部ごとのチャンネルがある場合は (時間, 音高, 声部) -> (声部, 音高 (上が高音), 時間)"""
+
+    return melody_arr.T[..., ::-1, :]
+
+
+# コードの特徴量 (時刻ごとに1行)
+# root   -- 根音のピッチクラスのone-hot (コードなしなら全て0)
+# kind   -- コードの種類の番号 (xml2vec.Chord.KINDS．コードなしなら0 (none))
+# bass   -- ベース音のピッチクラス (分数コードでなければ根音．コードなしなら-1)
+# degree, degree_alter, degree_type -- テンションの度数，変化記号，種類の番号 (xml2vec.Chord.DEGREE_TYPES)
+CHORD_DTYPE = np.dtype([('root', np.int8, (12,)), ('kind', np.int8), ('bass', np.int8),
+                        ('degree', np.int8), ('degree_alter', np.int8), ('degree_type', np.int8)])
+
+
+def encode_chords(chords, length, rate=1):
+    """Encode a chord progression into per-tick chord features
+
+    各時刻に，その時刻までに始まった最後のコードの特徴量を入れる (最初のコードより前はコードなし)
+
+    args:
+    chords -- コード進行 {時刻:xml2vec.Chord}
+    length -- 配列の長さ (rate倍した時刻で)
+    rate   -- コード進行の時刻を何倍した単位で配列にするか
+
+    return: (length,)の配列 [numpy.ndarray (CHORD_DTYPE)]"""
+
+    # (時刻, id) の配列にして，各時刻のコードのidを求める (最初のコードより前は-1，つまりコードなし)
+    progression = x2v.CHORD_VOCAB.encode(chords)
+    index = np.searchsorted(progression['time'].astype(np.int64) * rate, np.arange(length), 'right') - 1
+    ids   = np.append(progression['id'], -1)[index]
+    return chord_feature_table()[ids]
+
+
+# xml2vec.CHORD_VOCABのidごとのコードの特徴量 (最後の行はコードなし．語彙が増えたら作り直す)
+_chord_table = np.zeros(1, dtype=CHORD_DTYPE)
+_chord_table['bass'] = -1
+
+
+def chord_feature_table():
+    """Return chord features of every chord in xml2vec.CHORD_VOCAB
+
+    return: (len(CHORD_VOCAB) + 1,)の配列 [numpy.ndarray (CHORD_DTYPE)]
+            id番目の行がそのコードの特徴量，最後の行 (-1番目) がコードなし"""
+
+    global _chord_table
+    known = len(_chord_table) - 1
+    vocab = x2v.CHORD_VOCAB
+    if known == len(vocab):
+        return _chord_table
+
+    # 新しく登録されたコードの行を加える
+    table = np.zeros(len(vocab) + 1, dtype=CHORD_DTYPE)
+    table[:known] = _chord_table[:known]
+    table[-1]     = _chord_table[-1]
+    for i in range(known, len(vocab)):
+        chord = vocab.chord(i)
+        table['root'][i, chord.get_root_num()] = 1
+        table['kind'][i]         = chord.get_kind_num()
+        table['bass'][i]         = chord.get_bass_num()
+        table['degree'][i]       = chord.dr_step
+        table['degree_alter'][i] = chord.dr_alt
+        if chord.dr_type in x2v.Chord.DEGREE_TYPES:
+            table['degree_type'][i] = x2v.Chord.DEGREE_TYPES.index(chord.dr_type)
+    _chord_table = table
+    return table
+
+
+# 索引のファイル名
+SHARD_INDEX = 'shard_index.csv'
+
+
+class ShardWriter:
+    """Append melody windows into large shard files
+
+    窓ごとに1ファイルを保存する代わりに，窓をshard_size個ずつ
+    (shard_size, 音高, 時間)の1つの.npyファイル (shard_NNNNN.npy) にまとめて保存する
+    (声部ごとのチャンネルがある場合は (shard_size, 声部, 音高, 時間))
+    窓の形 (拍子によって長さが変わる) ごとに別のshardに書き込むので，1つのshardの窓は全て同じ形になる
+    各窓の (曲名, 開始小節, 終了小節, shard番号, 行, 拍子) は索引 shard_index.csv に書き込む
+    (拍子は窓の全小節で同じなら '3/4' のように1つ，拍子の変更をまたぐ窓なら小節ごとに '4/4,4/4,3/4,3/4'．
+    同じ形の窓でも拍子が違うことがある (3/4と6/8など) ので窓ごとに記録する)
+    保存したshardは np.load(path, mmap_mode='r') で読み込めばコピーなしで窓を取り出せる
+    (load_shard_index, open_shardを参照)
+    窓と同じ区間のコードの特徴量 (encode_chords) を渡した場合は，同じ行に
+    (shard_size, 時刻)の配列 (CHORD_DTYPE) として shard_NNNNN_chords.npy に保存する (open_chord_shardを参照)
+    """
+
+    SHARD_NAME   = 'shard_{:05d}.npy'
+    CHORD_NAME   = 'shard_{:05d}_chords.npy'
+    INDEX_HEADER = ['name', 'start', 'end', 'shard', 'row', 'time']
+
+    def __init__(self, out_dir, shard_size=4096):
+        self.out_dir    = out_dir
+        self.shard_size = shard_size
+        self.next_shard = 0  # 次に使うshard番号
+        self.shards     = {} # 書き込み中のshard {(窓の形, コードの形):[shard番号, 次の行, 中身], ...}
+
+        self.index_file = open(os.path.join(out_dir, SHARD_INDEX), 'w')
+        self.index      = csv.writer(self.index_file)
+        self.index.writerow(ShardWriter.INDEX_HEADER)
+
+    # 窓を1つ追加する
+    # melody_arr: save_as_arrayで保存されるのと同じ向き(音高, 時間)の配列
+    # chord_arr: 窓と同じ区間のコードの特徴量 (なければNone)
+    # meters: 窓の小節ごとの拍子 [(拍子の分子, 拍子の分母), ...] (iter_melody_windowsでwith_meters=True．
+    #         分からなければNone)
+    def add(self, name, start, end, melody_arr, chord_arr=None, meters=None):
+        shape = (melody_arr.shape, None if chord_arr is None else chord_arr.shape)
+        if shape not in self.shards:
+            self.shards[shape] = [self.next_shard, 0, self.new_data(melody_arr, chord_arr)]
+            self.next_shard += 1
+        shard = self.shards[shape]
+
+        self.store(shard[2], shard[1], melody_arr, chord_arr)
+        self.index.writerow([name, start, end, shard[0], shard[1], format_window_meters(meters)])
+        shard[1] += 1
+
+        if shard[1] == self.shard_size:
+            self.flush(shape)
+
+    # 最初の窓の形でshardの中身を確保する
+    def new_data(self, melody_arr, chord_arr=None):
+        data = {'windows':np.zeros((self.shard_size,) + melody_arr.shape, dtype=melody_arr.dtype)}
+        if chord_arr is not None:
+            data['chords'] = np.zeros((self.shard_size,) + chord_arr.shape, dtype=chord_arr.dtype)
+        return data
+
+    # shardの中身dataのrow行目に窓 (とコード) を格納する
+    def store(self, data, row, melody_arr, chord_arr=None):
+        data['windows'][row] = melody_arr
+        if chord_arr is not None:
+            data['chords'][row] = chord_arr
+
+    # shardの中身dataのうちrows行をout_pathに保存する
+    def save(self, out_path, data, rows):
+        np.save(out_path, data['windows'][:rows])
+        if 'chords' in data:
+            np.save(os.path.splitext(out_path)[0] + '_chords.npy', data['chords'][:rows])
+
+    # 窓の形がshapeのshardを保存する (次の窓からは新しいshardになる)
+    def flush(self, shape):
+        number, rows, data = self.shards.pop(shape)
+        out_path = os.path.join(self.out_dir, self.SHARD_NAME.format(number))
+        self.save(out_path, data, rows)
+        print '{} is saved. ({} windows)'.format(out_path, rows)
+
+    def close(self):
+        for shape in sorted(self.shards):
+            self.flush(shape)
+        self.index_file.close()
+
+
+class EventShardWriter(ShardWriter):
+    """Append melody windows into shard files as sparse note events
+
+    ShardWriterと同じだが，窓を密な配列ではなく
+    (音高の行, 開始位置, 終了位置)のイベント列として shard_NNNNN.npz に保存する
+    音が鳴っている要素はごく一部なので，密な配列に比べて非常に小さくなる
+    npzの中身 (CSR形式と同様):
+    shape  -- 窓の形 (音高, 時間) (声部ごとのチャンネルがある場合は (声部, 音高, 時間))
+    indptr -- i番目の窓のイベントは indptr[i]:indptr[i+1]
+    pitch, onset, offset -- 各イベントで window[pitch, onset:offset] = 1
+                            (声部ごとのチャンネルがある場合pitchは 声部 * 音高の数 + 音高)
+    chords -- コードの特徴量を渡した場合のみ．(窓の数, 時刻)の配列 (CHORD_DTYPE)
+    (load_event_shard, densify_eventsを参照)
+    """
+
+    SHARD_NAME = 'shard_{:05d}.npz'
+
+    def new_data(self, melody_arr, chord_arr=None):
+        data = {'shape':melody_arr.shape, 'events':[]}
+        if chord_arr is not None:
+            data['chords'] = np.zeros((self.shard_size,) + chord_arr.shape, dtype=chord_arr.dtype)
+        return data
+
+    def store(self, data, row, melody_arr, chord_arr=None):
+        data['events'].append(encode_events(melody_arr))
+        if chord_arr is not None:
+            data['chords'][row] = chord_arr
+
+    def save(self, out_path, data, rows):
+        pitch, onset, offset = [np.concatenate(e) for e in zip(*data['events'])]
+        counts = [len(e[0]) for e in data['events']]
+        indptr = np.concatenate(([0], np.cumsum(counts)))
+        arrays = {}
+        if 'chords' in data:
+            arrays['chords'] = data['chords'][:rows]
+        np.savez(out_path, shape=np.array(data['shape']), indptr=indptr,
+                 pitch=pitch, onset=onset, offset=offset, **arrays)
+
+
+def encode_events(melody_arr):
+    """Encode a window as note events
+
+    各行(音高)で1が連続する区間を1つのイベントとする
+    (声部ごとのチャンネルがある場合は (声部 * 音高, 時間) として扱う)
+
+    return: 音高の行 [numpy.ndarray (int16)], 開始位置, 終了位置 (終了位置の要素は含まない) [numpy.ndarray (int32)]
+            (位置は長い窓や細かいdivisionsでint16の範囲を超えるのでint32)"""
+
+    melody_arr = melody_arr.reshape(-1, melody_arr.shape[-1])
+
+    # 両端に0を補って差分をとると，立ち上がりが1，立ち下がりが-1になる
+    padded = np.zeros((melody_arr.shape[0], melody_arr.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = melody_arr
+    diff = np.diff(padded, axis=1)
+
+    pitch, onset = np.nonzero(diff == 1)
+    _, offset    = np.nonzero(diff == -1)
+
+    return pitch.astype(np.int16), onset.astype(np.int32), offset.astype(np.int32)
+
+
+def format_window_meters(meters):
+    """Format meters of the measures of a window for the shard index
+
+    全小節で同じなら '3/4'，違えば小節ごとに '4/4,4/4,3/4,3/4' (Noneなら空文字列)"""
+
+    if meters is None:
+        return ''
+    texts = ['{}/{}'.format(beats, beat_type) for beats, beat_type in meters]
+    return texts[0] if len(set(texts)) == 1 else ','.join(texts)
+
+
+def read_shard_index(out_dir):
+    """Read every row of the index of shards written by ShardWriter
+
+    return: 索引の行の順の [(曲名, 開始小節, 終了小節, shard番号, 行, 拍子), ...]
+            拍子は [(拍子の分子, 拍子の分母), ...] (全小節で同じなら1つ．拍子の列がない古い索引ではNone)"""
+
+    rows = []
+    with open(os.path.join(out_dir, SHARD_INDEX), 'r') as f:
+        for row in csv.DictReader(f):
+            meters = parse_meters(row['time']) if row.get('time') else None
+            rows.append((row['name'], int(row['start']), int(row['end']),
+                         int(row['shard']), int(row['row']), meters))
+    return rows
+
+
+def load_shard_index(out_dir):
+    """Load index of shards written by ShardWriter
+
+    return: {(曲名, 開始小節):(shard番号, 行), ...}"""
+
+    index = {}
+    for name, start, _, shard, row, _ in read_shard_index(out_dir):
+        index[(name, start)] = (shard, row)
+    return index
+
+
+def open_shard(out_dir, shard):
+    """Open a shard as a read-only memory map
+
+    return: (窓の数, 音高, 時間)の配列 [numpy.memmap]"""
+
+    return np.load(os.path.join(out_dir, ShardWriter.SHARD_NAME.format(shard)), mmap_mode='r')
+
+
+def open_chord_shard(out_dir, shard):
+    """Open chord features stored with a shard as a read-only memory map
+
+    return: (窓の数, 時刻)の配列 [numpy.memmap (CHORD_DTYPE)]
+            (イベント形式のshardではload_event_shardの返り値の'chords')"""
+
+    return np.load(os.path.join(out_dir, ShardWriter.CHORD_NAME.format(shard)), mmap_mode='r')
+
+
+def load_event_shard(out_dir, shard):
+    """Load a shard written by EventShardWriter
+
+    return: shape, indptr, pitch, onset, offset (コードの特徴量があればchords) をキーとする辞書"""
+
+    with np.load(os.path.join(out_dir, EventShardWriter.SHARD_NAME.format(shard))) as f:
+        return dict(f.items())
+
+
+def densify_events(events, rows):
+    """Build dense windows from an event shard
+
+    args:
+    events -- load_event_shardの返り値
+    rows   -- 取り出す窓の行番号のリスト
+
+    return: (len(rows), 音高, 時間)の配列 [numpy.ndarray (int8)]
+            (声部ごとのチャンネルがある場合は (len(rows), 声部, 音高, 時間))"""
+
+    rows   = np.asarray(rows, dtype=np.int64)
+    indptr = events['indptr']
+    shape  = tuple(events['shape'])
+    n_pitch, n_time = int(np.prod(shape[:-1])), shape[-1]
+
+    # 取り出す窓のイベントの番号と，それがbatchの何番目の窓か
+    counts = indptr[rows + 1] - indptr[rows]
+    ev     = run_indices(indptr[rows], counts)
+    batch  = np.repeat(np.arange(len(rows)), counts)
+
+    # 各イベントを平坦化した配列上の区間として書き込む
+    onset   = events['onset'][ev].astype(np.int64)
+    lengths = events['offset'][ev] - onset
+    starts  = (batch * n_pitch + events['pitch'][ev]) * n_time + onset
+
+    dense = np.zeros((len(rows),) + shape, dtype=np.int8)
+    dense.reshape(-1)[run_indices(starts, lengths)] = 1
+    return dense
+
+
+# MIDI note numberの音名 (ピッチクラスごと．黒鍵は#で表す)
+PC_STEPS  = np.array(list('CCDDEFFGGAAB'))
+PC_ALTERS = np.array([0, 1, 0, 1, 0, 0, 1, 0, 1, 0, 1, 0])
+
+
+def decode_rolls(rolls, r=24, pitch_extent=(36, 96), meter=(4, 4), threshold=0.5, min_ticks=None,
+                 yamaha=False, voices=False):
+    """Decode piano-roll windows back into PieceInfo and Melody
+
+    to_piano_roll (save_as_array, shard) の向きの配列を音符列に戻す
+    時間方向に同じ値が続く区間 (ラン) を1つの音符 (または休符) とする．全ての窓をまとめて一度に処理する
+    同時に複数の音が鳴っている場合は一番高い音をとる
+    0/1の配列では同じ高さの音の連打は区別できないので，1つの長い音になる
+    音符は小節線で分け (タイは付けない)，min_ticksより短い音符，休符は同じ小節の直前 (なければ直後) の音符に含める
+    (WriteNoteが64分音符より短い音符を書けないため)
+
+    args:
+    rolls        -- 1つの窓 (音高 (上が高音), 時間)，またはその窓を並べた (窓の数, 音高, 時間) の配列
+                    voices=Trueなら (声部, 音高, 時間) または (窓の数, 声部, 音高, 時間) (全声部を重ねて扱う)
+                    np.load(..., mmap_mode='r')の配列やモデルの出力する確率でもよい
+    r            -- 4分音符の長さ (iter_melody_windowsと同じ) (default=24)
+    pitch_extent -- 音域の下限と上限のMIDI Note number (iter_melody_windowsと同じ) (default=(36, 96))
+    meter        -- 全ての窓の拍子 (拍子の分子, 拍子の分母) (default=4/4)，または窓ごとの拍子のリスト
+                    (窓ごとの拍子は (拍子の分子, 拍子の分母) か，小節ごとの [(拍子の分子, 拍子の分母), ...]．
+                    read_shard_indexの拍子をそのまま渡せる)
+    threshold    -- この値より大きい要素を音があるとみなす (default=0.5)
+    min_ticks    -- 最も短い音符，休符の長さ (Noneなら64分音符の長さ)
+    yamaha       -- iter_melody_windowsでyamaha=Trueとした配列の場合にTrue
+    voices       -- 声部ごとのチャンネルがある配列 (xml2npy --voices) の場合にTrue
+
+    return: 窓ごとの (曲情報 [PieceInfo], 音符列 [xml2vec.Melody]) のリスト
+            xml2vec.WriteScore, WriteScoresなどにコード進行 {} とともに渡せる"""
+
+    rolls = np.asarray(rolls)
+    dims  = 3 if voices else 2
+    if rolls.ndim == dims:
+        rolls = rolls[np.newaxis]
+    if rolls.ndim != dims + 1:
+        raise ValueError("{}-D rolls with voices={}".format(rolls.ndim, voices))
+    sounding = rolls > threshold
+    if voices:
+        sounding = sounding.any(axis=1)
+
+    n, n_pitch, n_time = sounding.shape
+    if n_pitch != pitch_extent[1] - pitch_extent[0]:
+        raise ValueError("{} pitches do not match pitch_extent={}".format(n_pitch, pitch_extent))
+    if min_ticks is None:
+        min_ticks = -(-r // 16)
+
+    # 窓ごとの小節の拍子 (同じ拍子の並びの窓は小節の先頭の位置を使い回す)
+    windows = [meter] * n if _is_meter(meter) else list(meter)
+    if len(windows) != n:
+        raise ValueError("{} meters for {} windows".format(len(windows), n))
+    patterns = {}
+    kinds    = np.empty(n, dtype=np.int64)
+    for i, window in enumerate(windows):
+        kinds[i] = patterns.setdefault(_measure_meters(window, r, n_time), len(patterns))
+    measures = sorted(patterns, key=patterns.get)
+    bars = np.zeros((len(measures), n_time), dtype=np.bool_)
+    for k, m_meters in enumerate(measures):
+        m_lens = [r * 4 * beats // beat_type for beats, beat_type in m_meters]
+        bars[k, np.cumsum([0] + m_lens[:-1])] = True
+
+    # 各時刻の一番高い音 (上の行ほど高いので最初に音がある行) のMIDI note number．休符は-1
+    top  = np.argmax(sounding, axis=1)
+    midi = np.where(sounding.any(axis=1), pitch_extent[1] - 1 - top, -1).reshape(-1)
+
+    # 窓を時間方向に並べ，値の変わる位置と小節の先頭でランに分ける
+    # (窓の長さは小節の長さの倍数なので，窓の境界も小節の先頭になる)
+    bar   = bars[kinds].reshape(-1)
+    heads = np.flatnonzero(bar | np.concatenate(([True], midi[1:] != midi[:-1])))
+    lens  = np.diff(np.append(heads, len(midi)))
+    value = midi[heads]
+
+    # 短いランの値を同じ小節の直前 (なければ直後) の短くないランの値にして，同じ値が続くランをつなげ直す
+    short = lens < min_ticks
+    if short.any():
+        measure = np.cumsum(bar[heads]) - 1
+        first   = np.searchsorted(measure, measure)
+        last    = np.searchsorted(measure, measure, 'right') - 1
+        index   = np.arange(len(heads))
+        prev    = np.maximum.accumulate(np.where(short, -1, index))
+        next_   = np.minimum.accumulate(np.where(short, len(heads), index)[::-1])[::-1]
+        src     = np.where(prev >= first, prev, np.where(next_ <= last, next_, first))
+        keep    = bar[heads] | np.concatenate(([True], value[src][1:] != value[src][:-1]))
+        value   = value[src][keep]
+        heads   = heads[keep]
+        lens    = np.diff(np.append(heads, len(midi)))
+
+    # 音符列の構造化配列 (全ての窓の分をまとめて作り，窓ごとに分ける)
+    notes = np.zeros(len(heads), dtype=x2v.Melody.MELODY_DTYPE)
+    notes['time']     = heads % n_time
+    notes['duration'] = lens
+    notes['midi']     = value
+    pitched = value >= 0
+    written = value - 12 if yamaha else value
+    notes['step']     = np.where(pitched, PC_STEPS[written % 12], 'R')
+    notes['alter']    = np.where(pitched, PC_ALTERS[written % 12], 0)
+    notes['octave']   = np.where(pitched, written // 12 - 1, 0)
+    # 付点 (2/3が付点のない音符の長さ) と3連符 (1拍3連と2拍3連のみ)
+    plain = r * 4 // 2 ** np.arange(7)
+    plain = plain[r * 4 % 2 ** np.arange(7) == 0]
+    notes['dot']      = ~np.in1d(lens, plain) & (lens * 2 % 3 == 0) & np.in1d(lens * 2 // 3, plain)
+    notes['time_mod'] = (r % 3 == 0) & ((lens == r // 3) | (lens == r * 2 // 3)) & ~np.in1d(lens, plain)
+
+    bounds = np.searchsorted(heads // n_time, np.arange(n + 1))
+    music  = []
+    for i in range(n):
+        piece = x2v.PieceInfo()
+        piece.set_divisions(1, r)
+        m_meters = measures[kinds[i]]
+        for number, m_meter in enumerate(m_meters, 1):
+            if number == 1 or m_meter != m_meters[number - 2]:
+                piece.set_time(number, *m_meter)
+        piece.measure_num = len(m_meters)
+        piece.length      = n_time
+        music.append((piece, x2v.Melody.from_records(notes[bounds[i]:bounds[i+1]])))
+    return music
+
+
+def _is_meter(meter):
+    return len(meter) == 2 and all(isinstance(v, (int, long, np.integer)) for v in meter)
+
+
+# 窓の拍子を小節ごとの ((拍子の分子, 拍子の分母), ...) にする
+# meter: (拍子の分子, 拍子の分母) または小節ごとのそのリスト (1つなら窓の全小節で同じ)
+def _measure_meters(meter, r, n_time):
+    meters = [meter] if _is_meter(meter) else list(meter)
+    meters = tuple((int(beats), int(beat_type)) for beats, beat_type in meters)
+    m_lens = [r * 4 * beats // beat_type for beats, beat_type in meters]
+    if any(r * 4 * beats % beat_type for beats, beat_type in meters):
+        raise ValueError("Measure length of {} is not a multiple of 1/{} quarter notes".format(meters, r))
+    if len(meters) == 1:
+        if n_time % m_lens[0]:
+            raise ValueError("Window length {} is not a multiple of the measure length of {}/{}".format(
+                             n_time, *meters[0]))
+        return meters * (n_time // m_lens[0])
+    if sum(m_lens) != n_time:
+        raise ValueError("Window length {} does not match the meters {}".format(n_time, meters))
+    return meters
+
+
+def decode_shard(out_dir, shard, batch=1024, index=None, meter=(4, 4), **kwargs):
+    """Decode every window of a shard (ShardWriter or EventShardWriter) in row order
+
+    batch個の窓ずつ読み込んでdecode_rollsでまとめて音符列に戻す
+    各窓の拍子は索引 (shard_index.csv) から読む (拍子の列がない古い索引ではmeterとする)
+    index -- read_shard_indexの返り値 (Noneなら読み込む．多数のshardを戻す場合は一度読んで渡す)
+    その他の引数はdecode_rollsと同じ (声部ごとのチャンネルはshardの配列の次元から判断する)
+
+    yield: (曲名, 開始小節, 終了小節, 曲情報 [PieceInfo], 音符列 [xml2vec.Melody])"""
+
+    if index is None:
+        index = read_shard_index(out_dir)
+    rows = sorted((row, (name, start, end, meters or meter))
+                  for name, start, end, i, row, meters in index if i == shard)
+    rows = [entry for _, entry in rows]
+
+    if os.path.exists(os.path.join(out_dir, ShardWriter.SHARD_NAME.format(shard))):
+        windows = open_shard(out_dir, shard)
+        n, voices = len(windows), windows.ndim == 4
+        read = lambda begin, end: windows[begin:end]
+    else:
+        events = load_event_shard(out_dir, shard)
+        n, voices = len(events['indptr']) - 1, len(events['shape']) == 3
+        read = lambda begin, end: densify_events(events, np.arange(begin, end))
+    if n != len(rows):
+        raise ValueError("{} windows in shard {} but {} rows in the index".format(n, shard, len(rows)))
+
+    for begin in range(0, n, batch):
+        end   = min(begin + batch, n)
+        batch_rows = rows[begin:end]
+        music = decode_rolls(read(begin, end), meter=[meters for _, _, _, meters in batch_rows],
+                             voices=voices, **kwargs)
+        for (name, start, stop, _), (piece, melody) in itertools.izip(batch_rows, music):
+            yield name, start, stop, piece, melody
+
+
+def convert_melody_into_array(melody, piece_info, name, out_dir, **kwargs):
+    """Convert Melody into Numpy array and save each window as NAME_START-END.npy
 
     args:
-    melody       -- 音符列を格納したリスト
+    melody     -- 音符列 [xml2vec.Melody またはNoteのリスト]
+    piece_info -- 曲情報 [PieceInfo]
+    name       -- ファイル名
+    out_dir    -- 保存先パス
+    その他の引数はiter_melody_windowsと同じ"""
+
+    for start, end, melody_arr in iter_melody_windows(melody, piece_info, **kwargs):
+        # ファイル名: 元のファイル名_区間の開始小節-区間の終了小節.npy
+        file_name = name + '_' + str(start) + '-' + str(end) + '.npy'
+        save_as_array(melody_arr, file_name, out_dir)
+
+
+def iter_melody_windows(melody, piece_info,
+                        r=24, pitch_extent=(36, 96), cut_num=4, rest_limit=1, yamaha=False, voices=0,
+                        meters=((4, 4),), span=False, chords=None, chord_step=1, with_meters=False):
+    """Convert Melody into Numpy arrays of cut_num measures
+
+    args:
+    melody       -- 音符列 [xml2vec.Melody またはNoteのリスト]
     piece_info   -- 曲情報 [PieceInfo]
-    name         -- ファイル名
-    out_dir      -- 保存先パス
     r            -- 正規化時の基準値 (4分音符の長さ) [int] (default=24)
+                    piece_info.divisionsで割り切れない場合はxml2vec.normalize_musicで
+                    先にdivisionsをrにしておくこと
     pitch_extent -- 使用する音域の下限と上限のMIDI Note number (default=(36, 96))
     cut_num      -- 切り取る単位 (小節数) [int] (default=24)
     rest_limit   -- 切り取る小節内で，全休符を許す小節数の上限 (default=1)
-    yamaha       -- Trueに設定した場合，MIDI note numberをYAMAHA式で計算する"""
+    yamaha       -- Trueに設定した場合，MIDI note numberをYAMAHA式で計算する
+    voices       -- 多声の場合，声部ごとのチャンネルの数 (声部vは(v-1) % voices番目) 
+                    0なら全声部を1つにまとめる (default=0)
+    meters       -- 対象とする拍子 [(拍子の分子, 拍子の分母), ...] Noneなら全ての拍子 (default=4/4のみ)
+    span         -- Trueなら拍子の変更をまたぐ窓も作る (対象の拍子が続く限り) (default=False)
+    chords       -- コード進行 {時刻:xml2vec.Chord} (指定すると窓と同じ区間のコードの特徴量も返す)
+    chord_step   -- コードの特徴量の間隔 (1なら窓の時刻ごと，rなら4分音符ごと) (default=1)
+    with_meters  -- Trueなら窓の小節ごとの拍子も返す (shardの索引に書き込むため)
+
+    小節の表 (PieceInfo.measures) から区間 (拍子の変わらない小節の並び．spanなら対象の拍子の小節の並び) 
+    を求め，区間ごとに全体を1つの配列に書き込み，各窓はその読み込み専用のビューとして返す
+    (同じ区間の窓はメモリを共有するので，書き換える場合はコピーすること)
+    窓の長さ (時間方向) は拍子によって変わる
+    melodyが多声 (Melody.POLY_DTYPE) の場合は重なっている音も全て書き込み，
+    どの声部も鳴っていない小節を全休符の小節とみなす
+
+    yield: (区間の開始小節, 区間の終了小節, メロディ配列 (時間, 音高) [numpy.ndarray])
+           (voices > 0 なら (時間, 音高, 声部))
+           with_metersの場合はメロディ配列の次に小節ごとの拍子 [(拍子の分子, 拍子の分母), ...]
+           chordsを指定した場合は最後にコードの特徴量 (窓の長さ / chord_step,) [numpy.ndarray (CHORD_DTYPE)]
+           (窓の先頭からchord_stepごとの時刻のコード．読み込み専用のビュー)"""
     
-    measure_num = piece_info.measure_num
-    length      = piece_info.length
     div         = piece_info.divisions[1]
     l_note      = pitch_extent[0]
     h_note      = pitch_extent[1] - 1
-    cut_num     = cut_num
-    rate = r / div                   
+    if r % div:
+        raise ValueError("divisions={} does not divide r={}, normalize the music first".format(div, r))
+    rate = r // div
 
-    cur_time  = 0
-    beats     = 4
-    btype     = 4
-    next_time = 0
-    
-    index = sorted(piece_info.time.keys())
+    # 音符列を開始時刻，長さ，MIDI note number (休符は-1)の配列にしておく
+    if not isinstance(melody, x2v.Melody):
+        melody = x2v.Melody(melody)
+    poly = 'voice' in melody.array.dtype.names
+    if voices and not poly:
+        raise ValueError("Voice channels require a polyphonic melody")
+    onsets, durations, midi_nums = melody_to_arrays(melody, yamaha)
+    if voices:
+        channels = (melody.array['voice'].astype(np.int64) - 1) % voices
 
-    for i in range(len(index)):
-        
-        # 最後の拍子変更
-        if i == len(index) - 1:
-            # 最後の小節までの長さ
-            m_num = measure_num - index[i] + 1
-        # それ以外
+    # 小節の表と，各小節が対象の拍子かどうか
+    table   = piece_info.measures()
+    numbers = table.number
+    starts  = table.start
+    lengths = table.length
+    if meters is None:
+        allowed = np.ones(len(numbers), dtype=np.bool_)
+    else:
+        allowed = np.zeros(len(numbers), dtype=np.bool_)
+        for m_beats, m_btype in meters:
+            allowed |= (table.beats == m_beats) & (table.beat_type == m_btype)
+    # 弱起の小節は使わない
+    if piece_info.upbeat:
+        allowed[0] = False
+
+    # 曲全体のコードの特徴量 (窓の時刻の単位で)
+    if chords is not None:
+        track = encode_chords(chords, table.end * rate, rate)
+        track.flags.writeable = False
+
+    # 区間の先頭 (対象かどうかが変わる小節．spanでなければ拍子の指定のある小節も)
+    head = np.ones(len(numbers), dtype=np.bool_)
+    head[1:] = allowed[1:] != allowed[:-1]
+    if not span:
+        head |= table.time_change
+    bounds = np.append(np.flatnonzero(head), len(numbers))
+
+    # 窓に付ける小節番号
+    # 弱起がある場合，最初の拍子の区間では1小節目を0とする (以前からのファイル名との互換のため)
+    labels = numbers.copy()
+    if piece_info.upbeat and table.time_change[0]:
+        later = numbers[table.time_change & (numbers > 0)]
+        labels[numbers < (later[0] if len(later) else numbers[-1] + 1)] -= 1
+
+    for a, b in zip(bounds[:-1], bounds[1:]):
+
+        # 区間の小節数がcut_num以上かつ対象の拍子ならメロディを配列に変換
+        m_num = b - a
+        if not allowed[a] or m_num < cut_num:
+            continue
+
+        # 区間の開始時刻と終了時刻，各小節の開始時刻と長さ (区間の先頭から)
+        cur_time  = starts[a]
+        next_time = starts[b-1] + lengths[b-1]
+        m_starts  = starts[a:b] - cur_time
+        m_lens    = lengths[a:b]
+
+        # cur_timeからはじまる音符があるか (多声の場合は休符を含まないので調べない)
+        k = np.searchsorted(onsets, cur_time)
+        if not poly and (k == len(onsets) or onsets[k] != cur_time):
+            raise ValueError("The note which starts on time:{} does not exist.".format(cur_time))
+
+        # 区間内の音符 (時刻は区間の先頭から)
+        first, last = np.searchsorted(onsets, [cur_time, next_time])
+        sec_onsets = onsets[first:last] - cur_time
+        sec_durs   = durations[first:last]
+        sec_midi   = midi_nums[first:last]
+        rests      = sec_midi < 0
+        in_extent  = (sec_midi >= l_note) & (sec_midi <= h_note)
+        pitched    = ~rests & in_extent
+
+        # 区間全体を1つの配列に書き込む
+        shape = ((next_time - cur_time) * rate, (h_note-l_note)+1)
+        if voices:
+            roll = np.zeros(shape + (voices,), dtype=np.int8)
+            fill_roll(roll, sec_onsets[pitched] * rate, sec_durs[pitched] * rate,
+                      sec_midi[pitched] - l_note, channels[first:last][pitched])
         else:
-            # 次に拍子が変わるまでの小節数
-            m_num = index[i+1] - index[i]
-
-            # アウフタクトがあれば
-        if index[i] == 0:
-            cur_time += piece_info.upbeat_l            
-            m_num -= 1
-                        
-        # 変更した拍子が続く小節数がcut_num以上かつ4/4拍子ならメロディを配列に変換
-        save_list = True
-        last_k = 0
-        if m_num >= cut_num and piece_info.time[index[i]] == [4, 4]:
-
-            beats, btype = piece_info.time[index[i]]            
-            m_len = int(div * (4.0 / btype) * beats)    
-            # 次に拍子が変わる時刻（曲の終了時刻）
-            next_time = cur_time + m_num * m_len
-            
-            # cur_timeからはじまる音符を探す
-            for j in range(last_k, len(melody)):
-                if melody[j].time == cur_time:
-                    k = j
-                    break
-            else:
-                print "Error! The note which starts on time:{} does not exist.".format(cur_time)
-                quit()
-
-            count = 0 # 開始位置からの小節数
-            while cur_time < next_time - m_len * (cut_num - 1):
-
-                # メロディを格納する配列
-                melody_arr = np.zeros((m_len * rate * cut_num, (h_note-l_note)+1), dtype=np.int8)
-                
-                # 4小節ごとに切り取る
-                c = 0
-                tmp_dur = 0
-                h_rest_num = 0
-                save_list = True
-                while tmp_dur < m_len * cut_num:                                        
-                   
-                    # 休符でなければ
-                    if melody[k].step != 'R':
-                        # 所定の音域内にあるかチェック
-                        assert h_note >= melody[k].get_midi_num() >= l_note, \
-                            "The note is not in expected pitch extent."
-                        # 現在の時刻の，音階に対応する要素を1とする
-                        for j in range(melody[k].duration * rate):                                            
-                            melody_arr[tmp_dur * rate + j][melody[k].get_midi_num() - l_note] = 1                
-                            
-                    # 休符の場合
-                    else:
-                        # 全休符の場合
-                        if melody[k].duration == m_len:
-                            # 全休符を数える
-                            h_rest_num += 1 
-                                                                                 
-                    # インクリメント
-                    tmp_dur += melody[k].duration
-                    k += 1
-                    c += 1
-                    last_k = k
-                    
-                    # 2小節目の最初の音符のインデックスを記録しておく                
-                    if tmp_dur == m_len:
-                        # 次はこの位置から切り取る
-                        next_k = k 
-                        
-                    # 全休符が設定値より多ければその区間は使わない
-                    if h_rest_num > rest_limit:
-                        save_list = False
-                        break
-                
-                # メロディを保存
-                if save_list:
-                    # ファイル名: 元のファイル名_区間の開始小節-区間の終了小節.npy
-                    file_name = name + '_' + str(index[i]+count) + '-' + str(index[i]+count+cut_num) + '.npy'
-                    save_as_array(melody_arr, file_name, out_dir)
-    
-                # 開始位置を1小節進める
-                k = next_k
-                cur_time += m_len
-                # 開始位置からの小節数をインクリメント
-                count += 1
-
-            # 現在時刻を次に拍子が変わる時刻へ 
-            cur_time += m_len * (cut_num - 1)
-                
+            roll = np.zeros(shape, dtype=np.int8)
+            fill_roll(roll, sec_onsets[pitched] * rate, sec_durs[pitched] * rate,
+                      sec_midi[pitched] - l_note)
+        roll.flags.writeable = False
+
+        # 小節ごとの全休符の有無から，各窓(開始位置からの小節数)の全休符の数を求める
+        # 全休符が設定値より多い窓は使わない
+        w_num = m_num - cut_num + 1
+        if poly:
+            sounding = roll.reshape(shape[0], -1).any(axis=1)
+            whole = (~np.logical_or.reduceat(sounding, m_starts * rate)).astype(np.int64)
         else:
-            # 現在時刻を次に拍子が変わる時刻まで進める
-            # 次に拍子が変わる時刻（または曲の終了時刻）
-            beats, btype = piece_info.time[index[i]]
-            next_time = cur_time + m_num * int(div * (4.0 / btype) * beats)
-            cur_time = next_time        
-    
+            whole = np.zeros(m_num, dtype=np.int64)
+            m_index = np.searchsorted(m_starts, sec_onsets, 'right') - 1
+            whole[m_index[rests & (sec_durs == m_lens[m_index])]] = 1
+        whole_sum = np.concatenate(([0], np.cumsum(whole)))
+        save_list = whole_sum[cut_num:] - whole_sum[:w_num] <= rest_limit
+
+        # 所定の音域内にあるかチェック
+        check_pitch_extent(sec_onsets[~rests & ~in_extent], m_starts, whole, save_list,
+                           cut_num, rest_limit)
+
+        # 1小節ずつずらしたcut_num小節の窓をビューとして返す
+        offsets = np.append(m_starts, next_time - cur_time) * rate
+        for count in np.flatnonzero(save_list):
+            window = (labels[a+count], labels[a+count]+cut_num,
+                      roll[offsets[count]:offsets[count+cut_num]])
+            if with_meters:
+                rows    = slice(a + count, a + count + cut_num)
+                window += (zip(table.beats[rows].tolist(), table.beat_type[rows].tolist()),)
+            if chords is not None:
+                origin  = cur_time * rate
+                window += (track[origin+offsets[count]:origin+offsets[count+cut_num]:chord_step],)
+            yield window
+
+
+def check_pitch_extent(out_onsets, m_starts, whole, save_list, cut_num, rest_limit):
+    """Raise AssertionError if a note out of the pitch extent is in a window
+
+    使わない窓の中では，設定値を超えた全休符より後の音符は調べない
+    (窓の先頭から音符を順に調べ，全休符が設定値を超えた時点で打ち切るのと同じ)
+
+    args:
+    out_onsets -- 音域外の音符の開始時刻 (区間の先頭から)
+    m_starts   -- 各小節の開始時刻 (区間の先頭から)
+    whole      -- 小節ごとの全休符の有無
+    save_list  -- 窓ごとの，使うかどうか"""
+
+    # 音域外の音符はまずないので1つずつ調べる
+    rest_measures = np.flatnonzero(whole)
+    for onset in out_onsets:
+        m = np.searchsorted(m_starts, onset, 'right') - 1
+        # この音符を含む窓
+        for count in range(max(0, m - cut_num + 1), min(m, len(save_list) - 1) + 1):
+            # 打ち切られる位置 (設定値を超えた全休符の小節の先頭)
+            if not save_list[count]:
+                limit = m_starts[rest_measures[np.searchsorted(rest_measures, count) + rest_limit]]
+            if save_list[count] or onset < limit:
+                raise AssertionError("The note is not in expected pitch extent.")
+
+
+def melody_to_arrays(melody, yamaha=False):
+    """Convert Melody into arrays of onsets, durations and MIDI note numbers
+
+    args:
+    melody -- 音符列 [xml2vec.Melody またはNoteのリスト]
+    yamaha -- Trueにした場合  Midi note number をYAMAHA式で計算する
+
+    return: 開始時刻, 長さ, MIDI note number (休符は-1) [numpy.ndarray]"""
+
+    # Noteのリストの場合
+    if not isinstance(melody, x2v.Melody):
+        melody = x2v.Melody(melody)
+
+    onsets    = melody.array['time'].astype(np.int64)
+    durations = melody.array['duration'].astype(np.int64)
+    midi_nums = melody.array['midi'].astype(np.int64)
+    # YAMAHA式は国際式より1オクターブ上
+    if yamaha:
+        midi_nums[midi_nums >= 0] += 12
+
+    return onsets, durations, midi_nums
+
+
+def fill_roll(roll, starts, lengths, pitches, channels=None):
+    """Set roll[starts[i]:starts[i]+lengths[i], pitches[i]] = 1 for all i at once
+
+    同時に鳴る音がいくつあってもよい (多声の場合)
+
+    args:
+    roll     -- (時間, 音高)の配列 [numpy.ndarray] (channelsを指定する場合は(時間, 音高, 声部))
+    starts   -- 各音の開始位置 (rollの行)
+    lengths  -- 各音の長さ (行数)
+    pitches  -- 各音の音高 (rollの列)
+    channels -- 各音の声部のチャンネル"""
+
+    index = (run_indices(starts, lengths), np.repeat(pitches, lengths))
+    if channels is not None:
+        index += (np.repeat(channels, lengths),)
+    roll[index] = 1
+
+
+def run_indices(starts, lengths):
+    """Concatenate ranges [starts[i], starts[i]+lengths[i]) into one array
+
+    i番目の区間のj番目の値は starts[i] + j"""
+
+    offsets = np.cumsum(lengths) - lengths
+    return np.arange(lengths.sum()) + np.repeat(starts - offsets, lengths)
+
                     
 def get_pitch_extent(melody, yamaha=False):
     """Find highest and lowest note numbers from melody
 
     args:
-        melody -- 音符列を格納したリスト
+        melody -- 音符列 [xml2vec.Melody またはNoteのリスト]
         yamaha -- Trueにした場合  Midi note number をYAMAHA式で計算する
 
-    return: highest midi note number[int], lowest midi note number[int]"""
+    return: highest midi note number[int], lowest midi note number[int]
+            (音符がなければ 0, 127)"""
 
-    highest = 0
-    lowest   = 127
-    
-    for note in melody:
+    if not isinstance(melody, x2v.Melody):
+        melody = x2v.Melody(melody)
+
+    # 列midiは国際式 (休符は-1)．YAMAHA式は1オクターブ上
+    midi = melody.array['midi'][melody.array['step'] != 'R'].astype(np.int64)
+    if not len(midi):
+        return 0, 127
+    if yamaha:
+        midi += 12
+    return int(midi.max()), int(midi.min())
+
+
+# --statsのヒストグラムの範囲
+# pitch    -- MIDIのnote number 0〜127
+# duration -- 音符の長さ (--divisionsを4分音符の長さとする．最後のビンは2全音符以上)
+# interval -- 隣り合う音符の音程 (半音) -127〜127 (index = 音程 + 127)
+# meter    -- 拍子ごとの小節数 [拍子の分子 (最後のビンは32以上), log2(拍子の分母) (1〜32分)]
+# key      -- 調 (fifths) ごとの小節数 -7〜7 (index = fifths + 7)
+# kind     -- コードの種類 (xml2vec.Chord.KINDS) ごとのコードの数
+STATS_METER_BEATS = 33
+STATS_METER_TYPES = 6
+STATS_HISTOGRAMS  = ('pitch', 'duration', 'interval', 'meter', 'key', 'kind')
+
+
+def piece_stats(info, melody, chords, r=24):
+    """Compute statistics of one piece
+
+    音符列の列 (Melody.array) と小節の表 (PieceInfo.measures()) からまとめて計算する
+    --header_onlyで曲情報のみを読んだ場合は，melodyとchordsが空なので音符とコードの統計は0になる
+
+    args:
+    info   -- 曲情報 [xml2vec.PieceInfo]
+    melody -- 音符列 [xml2vec.Melody] (正規化する前の時刻)
+    chords -- コード進行 {時刻:xml2vec.Chord}
+    r      -- 4分音符の長さ (durationのヒストグラムの単位)
+
+    return: {列名:値} (値はスカラーまたはヒストグラム (STATS_HISTOGRAMSの各列) [numpy.ndarray])，
+            コード進行に現れたコード (xml2vec.Chord.get_key()) のリスト，その数の配列 [numpy.ndarray]
+    コードは親プロセスで全曲共通の語彙に登録し直す (ワーカーごとにCHORD_VOCABのidが違うため)"""
+
+    array   = melody.array
+    pitched = array['step'] != 'R'
+    midi    = array['midi'][pitched].astype(np.int64)
+    table   = info.measures()
+    divisions = info.divisions[1]
+
+    # 音符の長さ (rを4分音符の長さとして丸める)
+    longest  = 8 * r
+    duration = np.rint(array['duration'][pitched] * (float(r) / divisions)).astype(np.int64)
+
+    # 拍子と調は小節ごとに数える
+    beats  = np.clip(table.beats, 0, STATS_METER_BEATS - 1)
+    b_type = np.clip(np.log2(np.maximum(table.beat_type, 1)).astype(np.int64), 0, STATS_METER_TYPES - 1)
+    meter  = np.bincount(beats * STATS_METER_TYPES + b_type,
+                         minlength=STATS_METER_BEATS * STATS_METER_TYPES)
+    key    = np.bincount(np.clip(table.key + 7, 0, 14), minlength=15)
+
+    # コードは種類ごとに数え，異なるコードごとの数も返す
+    ids = x2v.CHORD_VOCAB.encode(chords)['id']
+    used, counts = np.unique(ids, return_counts=True)
+    kind = np.bincount(chord_feature_table()['kind'][ids].astype(np.int64),
+                       minlength=len(x2v.Chord.KINDS))
+
+    # 曲の長さ (秒) は音符を読んでいない場合は分からない
+    seconds = float(table.seconds(table.end)) if info.length else np.nan
+    highest, lowest = get_pitch_extent(melody)
+
+    # 最初の拍子，調，テンポ (小節がない楽譜でも最初の指定かデフォルト値がある)
+    (beats, beat_type), part_key = info.time[min(info.time)], info.key[1]
+    fifths, tempo = part_key[min(part_key)], info.tempo[min(info.tempo)][2]
+
+    stats = {'m_num':info.measure_num, 'divisions':divisions, 'upbeat':bool(info.upbeat),
+             'beats':int(beats), 'beat_type':int(beat_type), 'fifths':int(fifths),
+             'tempo':int(tempo), 'time_changes':int(table.time_change.sum()),
+             'key_changes':int(table.key_change.sum()), 'tempo_changes':int(table.tempo_change.sum()),
+             'length':info.length, 'seconds':seconds, 'highest':highest, 'lowest':lowest,
+             'notes':len(midi), 'rests':int(len(array) - len(midi)), 'chords':len(ids),
+             'pitch':np.bincount(midi, minlength=128)[:128],
+             'duration':np.bincount(np.clip(duration, 0, longest), minlength=longest + 1),
+             'interval':np.bincount(np.diff(midi) + 127, minlength=255),
+             'meter':meter.reshape(STATS_METER_BEATS, STATS_METER_TYPES),
+             'key':key, 'kind':kind}
+    return stats, [x2v.CHORD_VOCAB.chord(i).get_key() for i in used], counts
+
+
+def save_stats(path, names, stats, chords, r=24):
+    """Save statistics of pieces as a columnar table (.npz)
+
+    列ごとの配列として保存するので，np.load(path)['pitch'] のように再パースせずに引ける
+    曲ごとの列はnamesの順 (スカラーは(曲数,)，ヒストグラムは(曲数, ビン数...)) で，
+    ヒストグラムには全曲の合計 (total_<列名>) も加える
+    コードは全曲共通の語彙にまとめ，chord_symbols (コード名) とchord_counts (全曲での数) として保存する
+
+    args:
+    path   -- 出力先 (.npz)
+    names  -- ファイル名のリスト
+    stats  -- piece_statsが返した{列名:値}のリスト (namesの順)
+    chords -- 全曲で現れたコードの数 {xml2vec.Chord.get_key():数}
+    r      -- durationのヒストグラムの単位 (4分音符の長さ．列rとして保存する)"""
+
+    columns = {'name':np.array(names, dtype=str), 'kinds':np.array(x2v.Chord.KINDS),
+               'r':np.array(r)}
+    for key in (stats[0] if stats else {}):
+        columns[key] = np.array([s[key] for s in stats])
+        if key in STATS_HISTOGRAMS:
+            columns['total_' + key] = columns[key].sum(axis=0)
+
+    # 多い順に並べる．コード名はChord.get_symbol() (記号を含むのでunicodeの配列)
+    vocab = x2v.ChordVocabulary()
+    keys  = sorted(chords, key=lambda k: -chords[k])
+    columns['chord_symbols'] = np.array([vocab.symbol(i) for i in vocab.translate(keys)], dtype=unicode)
+    columns['chord_counts']  = np.array([chords[k] for k in keys], dtype=np.int64)
+
+    np.savez_compressed(path, **columns)
+
+
+def convert_file(job):
+    """Extract melody from one MusicXML file and convert it into arrays
+
+    main()から(プロセスプールのワーカーとしても)呼ばれる
+    失敗してもバッチ全体を止めないよう，例外は捕まえてメッセージとして返す
+
+    args:
+    job -- (ディレクトリ, ファイル名, コマンドライン引数, ファイルの内容 (先読みしていなければNone),
+            先読みにかかった秒数 (先読みしていなければNone)) のタプル
+
+    return: (ファイル名, 曲情報の行[dict] (--output_infoがなければNone), エラーメッセージ (成功時はNone),
+             保存する窓のリスト [(開始小節, 終了小節, 配列 (時間, 音高), 小節ごとの拍子[, コードの特徴量]), ...] (--lookの場合はNone),
+             統計 (piece_statsの返り値．--statsがなければNone), 計測結果[dict] (--profileがなければNone))
+    窓の保存は親プロセスでまとめて行う"""
+
+    root, xml, args, data, read_seconds = job
+
+    # --profileの場合は段階ごとの時間などを計測する
+    # (先読みした場合は，先読みのスレッドでの読み込みの時間をreadとする)
+    profile  = x2v.Profile() if args.profile else None
+    if profile is not None and read_seconds is not None:
+        profile.seconds['read'] = read_seconds
+    previous = x2v.set_profile(profile)
+    try:
+        return (xml,) + _convert_file(root, xml, args, data, profile) + (_profile_record(xml, profile),)
+    except Exception as e:
+        record = _profile_record(xml, profile)
+        error  = "{}: {}".format(type(e).__name__, e)
+        if record is not None:
+            record['error'] = error
+        return xml, None, error, None, None, record
+    finally:
+        x2v.set_profile(previous)
+
+
+def _convert_file(root, xml, args, data, profile):
+    path = os.path.join(root, xml)
+
+    # 曲情報とメロディ (--chordsの場合はコード進行も) を抽出
+    # --header_onlyの場合は曲情報のみ (音符とコードは空)
+    if args.header_only:
+        print "scanning piece information of %s ..." % xml
+        info   = x2v.parse_header(data) if data is not None else x2v.load_header(path)
+        melody = x2v.Melody()
+        chords = {}
+    else:
+        info, melody, chords = extract_melody(path, args.parser, open_cache(args), args.part, args.poly,
+                                              data, chords=True)
+
+    # 統計 (正規化する前の音符列とコード進行から．--chordsによらずコードも数える)
+    stats = None
+    if args.stats != '':
+        with x2v.stage('stats'):
+            stats = piece_stats(info, melody, chords, args.divisions)
+
+    if args.chords == 'none':
+        chords = None
+    if profile is not None:
+        profile.count('read_bytes', len(data) if data is not None else os.path.getsize(path))
+        profile.count('notes', int(np.count_nonzero(melody.array['step'] != 'R')))
+        profile.count('measures', info.measure_num)
+
+    # 曲情報を出力する場合
+    row = None
+    if args.output_info != '':
+        # 音域
+        highest, lowest = get_pitch_extent(melody)
+        row = {'name':xml, 'm_num':info.measure_num, 'divisions':info.divisions[1],
+               'time':info.time, 'tempo':info.tempo, 'key':info.key[1],
+               'highest':highest, 'lowest':lowest}
+
+    windows = None
+    if not args.look:
+        # 全ての時刻をargs.divisionsを4分音符の長さとする値に直す
+        # (割り切れない時刻はargs.quantizeに従って丸める)
+        with x2v.stage('normalize'):
+            info, melody, chords = x2v.normalize_music((info, melody, chords or {}), args.divisions,
+                                                       args.quantize)
+        if args.chords == 'none':
+            chords = None
+        with x2v.stage('window'):
+            windows = list(iter_melody_windows(melody, info, r=args.divisions, voices=args.voices,
+                                               meters=args.meters, span=args.span_meters, chords=chords,
+                                               chord_step=args.divisions if args.chords == 'beat' else 1,
+                                               with_meters=True))
+        if profile is not None:
+            profile.count('windows', len(windows))
+
+    return row, None, windows, stats
+
+
+def _profile_record(xml, profile):
+    if profile is None:
+        return None
+    record = profile.record()
+    record['file'] = xml
+    record['pid']  = os.getpid()
+    return record
+
+
+def timed_write(record, func, nbytes):
+    """Wrap an output write so that its time and bytes are added to a --profile record
+
+    書き込みはAsyncWriterのスレッドで行われることがあるので，recordはAsyncWriterのclose後に読むこと
+    nbytes -- 書き込む配列のバイト数 (written_bytesに加える．.npyのヘッダーなどは含まない)"""
+
+    seconds = record['seconds']
+    def write(*args):
+        begin = time.time()
+        func(*args)
+        seconds['save'] = seconds.get('save', 0.0) + time.time() - begin
+        record['written_bytes'] = record.get('written_bytes', 0) + nbytes
+    return write
+
+
+def write_profile(path, records, wall):
+    """Write --profile records as JSON lines and print their summary
+
+    args:
+    path    -- 出力先 (1行に1ファイルの計測結果)
+    records -- convert_fileが返した計測結果のリスト (xmlsの順)
+    wall    -- 全体の経過時間 (秒)"""
+
+    with open(path, 'w') as f:
+        for record in records:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+
+    # 段階ごとの合計時間 (並列の場合は各プロセスの時間の合計なので，wallより長くなりうる)
+    stages = {}
+    for record in records:
+        for name, seconds in record['seconds'].items():
+            stages[name] = stages.get(name, 0.0) + seconds
+    total = sum(stages.values())
+
+    def file_seconds(record):
+        return sum(record['seconds'].values())
+
+    print "Profile of {} files ({:.2f} s wall, {:.2f} s in stages):".format(len(records), wall, total)
+    for name, seconds in sorted(stages.items(), key=lambda item: -item[1]):
+        print "  {:<10} {:9.3f} s {:6.1%}".format(name, seconds, seconds / total if total else 0.0)
+    for key in ('read_bytes', 'written_bytes', 'notes', 'measures', 'windows'):
+        print "  {:<14} {}".format(key, sum(record.get(key, 0) for record in records))
+    if records:
+        print "  max RSS        {:.1f} MB".format(max(record['rss_mb'] for record in records))
+        print "  slowest files:"
+        for record in sorted(records, key=file_seconds, reverse=True)[:5]:
+            print "    {} {:.3f} s".format(record['file'], file_seconds(record))
+        print "  files using most memory:"
+        for record in sorted(records, key=lambda record: -record['rss_growth_mb'])[:5]:
+            print "    {} +{:.1f} MB".format(record['file'], record['rss_growth_mb'])
+    print "Profile saved in %s" % path
+
+
+def parse_meters(text):
+    """Parse --meters such as '4/4,3/4' into [(4, 4), (3, 4)] ('all' into None)"""
+
+    if text == 'all':
+        return None
+    meters = []
+    for m in text.split(','):
+        beats, btype = m.split('/')
+        meters.append((int(beats), int(btype)))
+    return meters
+
+
+class Prefetcher:
+    """Read files ahead on background threads
+
+    ファイルの内容 (バイト列) をthreads個のスレッドで先読みし，pathsの順に (パス, 内容, 読み込みの秒数) を返すイテレータ
+    読み込んだが処理の済んでいない (doneが呼ばれていない) ファイルは，変換中のものも含めて最大ahead個まで
+    (それ以上は先読みしないので，メモリ使用量は大きなファイルahead個分に収まる)
+    並列に変換する場合は，aheadを並列数 + 先読みする数にしないと変換の並列数がaheadで頭打ちになる
+    処理中にディスクやネットワークの読み込みを待たなくて済む
+    """
+
+    def __init__(self, paths, ahead=4, threads=2):
+        self.paths   = paths
+        self.slots   = threading.Semaphore(ahead)
+        self.pool    = ThreadPool(threads)
+        self.stopped = False
+
+    def __iter__(self):
+        for path, (data, seconds) in itertools.izip(self.paths, self.pool.imap(Prefetcher.read,
+                                                                                 self._acquire())):
+            yield path, data, seconds
+
+    # 空きができるまで待ってから次のパスを渡す (ThreadPoolのタスク供給スレッドで動く)
+    def _acquire(self):
+        for path in self.paths:
+            self.slots.acquire()
+            if self.stopped:
+                return
+            yield path
+
+    # 読めなかった場合の内容はNone (変換時にもう一度読んで，そのファイルの失敗として扱う)
+    @staticmethod
+    def read(path):
+        begin = time.time()
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None, None
+        return data, time.time() - begin
+
+    # ファイル1つの処理が済んだら呼ぶ
+    def done(self):
+        self.slots.release()
+
+    # 途中で終了する場合も，空きを待っているタスク供給スレッドを止めてから終了する
+    def close(self):
+        self.stopped = True
+        self.slots.release()
+        self.pool.close()
+        self.pool.join()
+
+
+class AsyncWriter:
+    """Run output writes on a background thread through a bounded queue
+
+    submitした書き込み (関数と引数) を1つのスレッドで順に実行する
+    キューにmax_pending個たまっている間はsubmitが待つ (書き込みが追いつかない場合にメモリを使いすぎないように)
+    書き込みで起きた例外は次のsubmitかcloseで送出する
+    """
+
+    def __init__(self, max_pending=64):
+        self.queue  = Queue.Queue(max_pending)
+        self.error  = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            func, args = job
+            if self.error is None:
+                try:
+                    func(*args)
+                except Exception as e:
+                    self.error = e
+
+    def submit(self, func, *args):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((func, args))
+
+    # 全ての書き込みが終わるまで待つ
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def open_cache(args):
+    """Return xml2vec.MusicCache specified by --cache_dir (None if not specified)
+
+    プロセスごとに1つのMusicCacheを使い回す (putごとのtrimの判定に書き込んだサイズを数えるため)"""
+
+    if args.cache_dir == '':
+        return None
+    key = (args.cache_dir, args.cache_size)
+    if key not in _CACHES:
+        _CACHES[key] = x2v.MusicCache(args.cache_dir, args.cache_size << 20)
+    return _CACHES[key]
+
+# {(--cache_dir, --cache_size):xml2vec.MusicCache} (このプロセスで開いたもの)
+_CACHES = {}
 
-        if note.step == 'R':
-            continue
-        
-        midi_num = note.get_midi_num(yamaha)
-        
-        if midi_num > highest:
-            highest = midi_num
-            
-        if midi_num < lowest:
-            lowest = midi_num
-        
-    return highest, lowest
-            
 
 def main():
 
@@ -228,6 +1225,9 @@ def main():
                         help='Directry of output files')
     parser.add_argument('--divisions', type=int, default=24,
                         help='Divisions used in length normalization (default=24)')    
+    parser.add_argument('--quantize', choices=x2v.QUANTIZE, default='nearest',
+                        help="""Rounding of ticks which are not on the grid of DIVISIONS (default=nearest)
+                        'strict' skips such files""")
     parser.add_argument('--output_info', default='',
                         help="""Output file with information of input musical pieces
                         File name is 'OUTPUT_INFO.csv', and it is saved in OUT_DIR
@@ -235,13 +1235,81 @@ def main():
                         ['name', 'm_num', 'divisions', 'time', 'tempo', 'key', 'highest', 'lowest']""")
     parser.add_argument('--look', action="store_true", default=False,
                         help="Just looks over xmls and output information if this argument is set")
+    parser.add_argument('--parser', choices=x2v.PARSERS, default='bs4',
+                        help="""Parser used in extraction (default=bs4)
+                        'iterparse' reads MusicXML incrementally with constant memory""")
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='Number of worker processes (default=1)')
+    parser.add_argument('--cache_dir', default='',
+                        help="""Directory of the cache of extracted melodies
+                        Files whose contents are cached are not parsed again""")
+    parser.add_argument('--cache_size', type=int, default=1024,
+                        help='Size limit of the cache in MB, least recently used entries are removed (default=1024)')
+    parser.add_argument('--format', choices=('npy', 'shard', 'events'), default='npy',
+                        help="""Output format (default=npy)
+                        npy: one NAME_START-END.npy file per window
+                        shard: windows are appended into shard_NNNNN.npy files of SHARD_SIZE windows,
+                        and shard_index.csv maps (name, start) to (shard, row)
+                        events: same as shard, but windows are stored as sparse note events
+                        in shard_NNNNN.npz files (see densify_events)""")
+    parser.add_argument('--shard_size', type=int, default=4096,
+                        help='Number of windows per shard file (default=4096)')
+    parser.add_argument('--part', default=None,
+                        help='ID or name of the part to convert (default=first part)')
+    parser.add_argument('--poly', action="store_true", default=False,
+                        help="""Convert all voices and chord notes of the part into a multi-hot piano roll
+                        instead of the top voice only""")
+    parser.add_argument('--voices', type=int, default=0,
+                        help="""With --poly, split the piano roll into VOICES channels (voice v goes to
+                        channel (v-1) %% VOICES), arrays become (voice, pitch, time) (default=0, no channels)""")
+
+    parser.add_argument('--meters', default='4/4',
+                        help="""Comma-separated time signatures to cut windows from, e.g. '4/4,3/4,6/8',
+                        or 'all' (default=4/4). Window length depends on the time signature""")
+    parser.add_argument('--span_meters', action="store_true", default=False,
+                        help="Allow windows to span time signature changes between the target meters")
+    parser.add_argument('--chords', choices=('none', 'tick', 'beat'), default='none',
+                        help="""Also store chord features (root one-hot, kind, bass, degree) aligned with
+                        each window in the same shard, for every tick or every quarter note
+                        (default=none, requires --format shard or events)""")
+    parser.add_argument('--prefetch', type=int, default=4,
+                        help="""Number of files read ahead on background threads while converting,
+                        in addition to the JOBS files being converted
+                        (default=4, 0 reads each file when it is converted)""")
+    parser.add_argument('--write_queue', type=int, default=64,
+                        help="""Number of pending output writes done on a background thread
+                        (default=64, 0 writes synchronously)""")
+    parser.add_argument('--profile', default='',
+                        help="""Record time of each stage, bytes read and written, numbers of notes,
+                        measures and windows and peak RSS for each file, write them into PROFILE
+                        as JSON lines and print the summary""")
+    parser.add_argument('--stats', default='',
+                        help="""Save per-piece and corpus-wide histograms of pitch, duration, interval,
+                        meter, key and chord kind and per-piece metadata into STATS as a columnar
+                        NumPy .npz table (see save_stats). Use with --look to skip windows""")
+    parser.add_argument('--header_only', action="store_true", default=False,
+                        help="""With --look, read only piece information (time, key, tempo, divisions and
+                        number of measures of the first part) without notes and chords, which is much
+                        faster. Highest and lowest notes and note and chord statistics are empty""")
 
     args = parser.parse_args()
+    if args.voices and not args.poly:
+        parser.error("--voices requires --poly")
+    if args.chords != 'none' and args.format == 'npy':
+        parser.error("--chords requires --format shard or events")
+    if args.header_only and not args.look:
+        parser.error("--header_only requires --look")
+    if args.header_only and args.part is not None:
+        parser.error("--header_only reads the first part only")
+    try:
+        args.meters = parse_meters(args.meters)
+    except ValueError:
+        parser.error("invalid --meters: %s" % args.meters)
 
     # データ読み込み
     if args.in_dir != '':
-        all_files = os.listdir(args.in_dir)
-        xmls = [f for f in all_files if ('xml' in f)]
+        all_files = sorted(os.listdir(args.in_dir))
+        xmls = [f for f in all_files if x2v.is_score_file(f)]
         root = args.in_dir 
     elif args.in_file != '':
         root, fname = os.path.split(args.in_file)
@@ -252,26 +1320,115 @@ def main():
 
     # 曲情報リスト
     infos = []
+    # 失敗したファイル [(ファイル名, エラーメッセージ), ...]
+    failures = []
+    # --profileの計測結果
+    records = []
+    # --statsの曲名と統計，全曲で現れたコードの数 {xml2vec.Chord.get_key():数}
+    stats_names, stats, chord_counts = [], [], {}
+    started = time.time()
 
     # メロディを読み込んで配列に変換
-    for xml in xmls:
-
-        # 曲情報とメロディを抽出
-        info, melody = extract_melody(os.path.join(root,  xml))
-
-        # 曲情報を出力する場合
-        if args.output_info != '':
-            # 音域
-            highest, lowest = get_pitch_extent(melody)
-            # 曲情報リストに情報を追加
-            infos.append({'name':xml, 'm_num':info.measure_num, 'divisions':info.divisions[1],
-                          'time':info.time, 'tempo':info.tempo, 'key':info.key[1],
-                          'highest':highest, 'lowest':lowest})
-
-        # args.divisionsを割り切れるdivisionsを持つファイルのみ処理
-        if args.divisions % info.divisions[1] == 0 and not args.look:
-            name, _ = os.path.splitext(xml)
-            convert_melody_into_array(melody, info, name, args.out_dir)
+    # 並列の場合も結果はxmlsの順に受け取る
+    # (プロセスプールはスレッドを起動する前に作る)
+    pool = multiprocessing.Pool(args.jobs) if args.jobs > 1 else None
+
+    # 先読みする場合は読み込み済みの内容を渡す
+    # (変換中のファイルもPrefetcherの枠を使うので，並列数の分だけ枠を広げる)
+    if args.prefetch > 0:
+        prefetcher = Prefetcher([os.path.join(root, xml) for xml in xmls], args.jobs + args.prefetch)
+        jobs = ((root, xml, args, data, seconds)
+                for xml, (_, data, seconds) in itertools.izip(xmls, prefetcher))
+    else:
+        prefetcher = None
+        jobs = ((root, xml, args, None, None) for xml in xmls)
+
+    if pool is not None:
+        results = pool.imap(convert_file, jobs)
+    else:
+        results = itertools.imap(convert_file, jobs)
+
+    # shardに書き込む場合
+    shards = None
+    if args.format != 'npy' and not args.look:
+        writer = {'shard':ShardWriter, 'events':EventShardWriter}[args.format]
+        shards = writer(args.out_dir, args.shard_size)
+
+    # 書き込みは別スレッドで行う
+    output = AsyncWriter(args.write_queue) if args.write_queue > 0 else None
+    def write(func, *func_args):
+        if output is not None:
+            output.submit(func, *func_args)
+        else:
+            func(*func_args)
+
+    try:
+        for xml, row, error, windows, piece, record in results:
+            if prefetcher is not None:
+                prefetcher.done()
+            if record is not None:
+                records.append(record)
+            if error is not None:
+                print "Error! Failed to convert {}: {}".format(xml, error)
+                failures.append((xml, error))
+                continue
+            if row is not None:
+                infos.append(row)
+            if piece is not None:
+                values, keys, counts = piece
+                stats_names.append(xml)
+                stats.append(values)
+                for key, count in itertools.izip(keys, counts):
+                    chord_counts[key] = chord_counts.get(key, 0) + int(count)
+            if windows:
+                name = x2v.score_name(xml)
+                for window in windows:
+                    start, end, melody_arr, meters = window[:4]
+                    # --chordsの場合はコードの特徴量も同じ行に書き込む
+                    chord_arr = window[4] if len(window) > 4 else None
+                    if shards is not None:
+                        func, func_args = shards.add, (name, start, end, to_piano_roll(melody_arr),
+                                                       chord_arr, meters)
+                    else:
+                        # ファイル名: 元のファイル名_区間の開始小節-区間の終了小節.npy
+                        file_name = name + '_' + str(start) + '-' + str(end) + '.npy'
+                        func, func_args = save_as_array, (melody_arr, file_name, args.out_dir)
+                    if record is not None:
+                        nbytes = melody_arr.nbytes + (chord_arr.nbytes if chord_arr is not None else 0)
+                        func = timed_write(record, func, nbytes)
+                    write(func, *func_args)
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if output is not None:
+        output.close()
+    if shards is not None:
+        shards.close()
+
+    # 計測結果の出力 (書き込みの時間は全ての書き込みが終わってから集計する)
+    if args.profile != '':
+        write_profile(args.profile, records, time.time() - started)
+
+    # 統計の出力
+    if args.stats != '':
+        save_stats(args.stats, stats_names, stats, chord_counts, args.divisions)
+        print "Statistics of {} pieces ({} notes, {} chords) saved in {}".format(
+            len(stats), sum(s['notes'] for s in stats), sum(chord_counts.values()), args.stats)
+
+    # キャッシュの大きさを制限内に収める
+    cache = open_cache(args)
+    if cache is not None:
+        cache.trim()
+
+    # 失敗したファイルの一覧
+    if failures:
+        print "{} of {} files failed:".format(len(failures), len(xmls))
+        for xml, error in failures:
+            print "  {}: {}".format(xml, error)
         
     # 曲情報の出力
     if args.output_info != '':
@@ -13,8 +13,29 @@ MusicXMLから曲情報と主旋律とコード進行を抽出
 
 from bs4 import BeautifulSoup
 import xml.etree.ElementTree as ET # 最初からこれ一つに統一すればよかった…
+try:
+    import xml.etree.cElementTree as cET # iterparseにはC実装を使う
+except ImportError:
+    cET = ET
 import datetime
 import sys
+import heapq
+import itertools
+import multiprocessing
+from collections import OrderedDict
+from fractions import Fraction
+import os
+import hashlib
+import zipfile
+import gzip
+import time
+import resource
+import copy
+from contextlib import closing, contextmanager
+import cPickle as pickle
+from cStringIO import StringIO
+
+import numpy as np
 
 #曲情報クラス
 class PieceInfo:
@@ -35,6 +56,8 @@ class PieceInfo:
     length      -- 拍数 * divisions [int]
     upbeat      -- 冒頭の弱起（アウフタクト）の有無 [bool]
     upbeat_l    -- 弱起の長さ
+
+    全小節の開始時刻，長さ，拍子，調，テンポはmeasures()で表 (MeasureTable) として得られる
     """
     
     # デフォルト値
@@ -65,27 +88,33 @@ class PieceInfo:
         # 弱起の有無と長さ
         self.upbeat      = False
         self.upbeat_l    = 0
+        # 小節の表 {パートID:MeasureTable} (measuresで作る．値を設定したら作り直す)
+        self._measures   = {}
         
     # 調の設定
     # part:パートid[int], measure:小節番号[int], fifth:調を表す値[int]
     # fifthに関してはREADME参照
     def set_key(self, part, measure, fifth):
         self.key[part][measure] = fifth
+        self._measures = {}
 
     # テンポの設定
     # measure[int], value[int]
     def set_tempo(self, measure, bpm, b_unit, s_tempo):
         self.tempo[measure] = [bpm, b_unit, s_tempo]
+        self._measures = {}
 
     # 拍子の設定
     # measure[int], beats[int], beat_type[int]
     def set_time(self, measure, beats, beat_type):
         self.time[measure] = [beats, beat_type]
+        self._measures = {}
 
     # divisionsの設定
     # part[int], value[int]
     def set_divisions(self, part, value):
         self.divisions[part] = value
+        self._measures = {}
 
     # upbeatの設定
     # 必ず楽譜要素抽出の最初に行う
@@ -100,9 +129,119 @@ class PieceInfo:
         self.time        = {0:[PieceInfo.BEATS, PieceInfo.BEAT_TYPE]} 
         # {パートID:値, ...}
         self.divisions   = {0:PieceInfo.DIVISIONS}
+        self._measures   = {}
 
     def set_ub_length(self, length):
         self.upbeat_l = length
+        self._measures = {}
+
+    # 小節の表
+    # 抽出が終わった後に呼ぶこと (初回に作って以降は同じものを返す)
+    # part: パートID[int] (調とdivisionsに用いる)
+    def measures(self, part=1):
+        if part not in self._measures:
+            self._measures[part] = MeasureTable(self, part)
+        return self._measures[part]
+
+
+# 小節の表
+class MeasureTable:
+    """Immutable table of every measure of a piece
+
+    PieceInfoの {小節番号:値} なる辞書から，全小節の値を1回だけまとめて求めた表
+    (PieceInfo.measures()で得る)
+    列は全て小節ごとの読み込み専用のnumpy.ndarray．弱起がある場合は0小節目を含む
+
+    instance variables:
+    number       -- 小節番号
+    start        -- 開始時刻 (divisionsを4分音符の長さとする整数)
+    length       -- 長さ
+    beats        -- 拍子の分子
+    beat_type    -- 拍子の分母
+    key          -- 調 (fifths)
+    bpm          -- 楽譜に表記するテンポ
+    beat_unit    -- テンポを示す音符の単位 [str]
+    sound_tempo  -- 再生時のBPM (4分音符)
+    time_change  -- 拍子の指定がある小節か [bool]
+    key_change   -- 調の指定がある小節か [bool]
+    tempo_change -- テンポの指定がある小節か [bool]
+    divisions    -- 4分音符の長さ [int]
+    end          -- 曲の終了時刻 [int]
+    """
+
+    def __init__(self, piece_info, part=1):
+        first = 0 if piece_info.upbeat else 1
+        self.number = np.arange(first, piece_info.measure_num + 1)
+        self.divisions = piece_info.divisions[part]
+
+        # 各小節の値 (その小節以前で最後に指定されたもの)
+        # (小節がない場合も (0, 2) の形にする)
+        meter = self._carry(piece_info.time).reshape(-1, 2)
+        self.beats, self.beat_type = meter[:, 0], meter[:, 1]
+        self.key = self._carry(piece_info.key[part])
+        tempo = self._carry(piece_info.tempo, object)
+        self.bpm         = np.array([t[0] for t in tempo], dtype=np.int64).reshape(-1)
+        self.beat_unit   = np.array([t[1] for t in tempo], dtype=object).reshape(-1)
+        self.sound_tempo = np.array([t[2] for t in tempo], dtype=np.int64).reshape(-1)
+
+        # 指定がある小節
+        self.time_change  = np.in1d(self.number, list(piece_info.time))
+        self.key_change   = np.in1d(self.number, list(piece_info.key[part]))
+        self.tempo_change = np.in1d(self.number, list(piece_info.tempo))
+
+        # 4分音符の長さ * (4 / 拍子の分母) * 拍子の分子
+        self.length = (self.divisions * (4.0 / self.beat_type) * self.beats).astype(np.int64)
+        if piece_info.upbeat and len(self.length):
+            self.length[0] = piece_info.upbeat_l
+        self.start = np.cumsum(self.length) - self.length
+        self.end   = int(self.start[-1] + self.length[-1]) if len(self.length) else 0
+
+        # 各小節の開始時刻 (秒) と1単位時間の秒数
+        self._tick_sec  = 60.0 / (self.sound_tempo * float(self.divisions))
+        self._start_sec = np.cumsum(self.length * self._tick_sec) - self.length * self._tick_sec
+
+        for name in ("number", "beats", "beat_type", "key", "bpm", "beat_unit", "sound_tempo",
+                     "time_change", "key_change", "tempo_change", "length", "start",
+                     "_tick_sec", "_start_sec"):
+            getattr(self, name).flags.writeable = False
+
+    # {小節番号:値}なる辞書から，各小節の値 (その小節以前で最後に指定されたもの) の配列を作る
+    def _carry(self, values, dtype=np.int64):
+        keys  = sorted(values)
+        table = np.empty(len(keys), dtype=object)
+        table[:] = [values[k] for k in keys]
+        # 最初の指定より前の小節は最初の値とする
+        carried = table[np.maximum(np.searchsorted(keys, self.number, "right") - 1, 0)]
+        if dtype is object:
+            return carried
+        return np.array(list(carried), dtype=dtype)
+
+    def __len__(self):
+        return len(self.number)
+
+    # 時刻t (スカラーまたは配列) を含む小節の行番号を返す (曲の範囲外なら-1)
+    # 二分探索なのでO(log 小節数)
+    def index_at(self, t):
+        t = np.asarray(t)
+        i = np.searchsorted(self.start, t, "right") - 1
+        return np.where((t >= 0) & (t < self.end), i, -1)
+
+    # 時刻t (スカラーまたは配列) を含む小節の番号を返す
+    def measure_at(self, t):
+        i = self.index_at(t)
+        if np.any(i < 0):
+            raise ValueError("Time out of the piece")
+        return self.number[i]
+
+    # 時刻 (スカラーまたは配列) を曲の先頭からの秒数に変換する
+    # テンポの変更は小節の先頭でのみ起こるとする．曲の範囲外は最初，最後の小節のテンポで延長する
+    # (小節がない場合はデフォルトのテンポとする)
+    def seconds(self, t):
+        t = np.asarray(t)
+        if not len(self.start):
+            return t * (60.0 / (PieceInfo.S_TEMPO * float(self.divisions)))
+        i = np.clip(np.searchsorted(self.start, t, "right") - 1, 0, len(self.start) - 1)
+        return self._start_sec[i] + (t - self.start[i]) * self._tick_sec[i]
     
     
 # 音符クラス
@@ -146,7 +285,7 @@ class Note:
 
     # durationと引数divisionsから音符の見た目の種類を返す
     # 64分音符から2倍全音符まで対応
-    # 連符は2拍3連と1拍3連のみ対応 それ以外はエラーを返す
+    # 連符は2拍3連と1拍3連のみ対応 それ以外はValueErrorを送出する
     def get_note_type(self, divisions):
 
         # 3連符
@@ -160,8 +299,7 @@ class Note:
                 return "eighth"
             # それ以外
             else:
-                print "Error! Cannot use tuplet except quarter-note triplet and eigths-note triplet"
-                quit() # 終了
+                raise ValueError("Cannot use tuplet except quarter-note triplet and eigths-note triplet")
 
         # 普通の音符の時
         rate = float(self.duration) / divisions
@@ -182,10 +320,86 @@ class Note:
         elif rate >= 4.0 and rate < 16.0:   # 倍全音符以上
             return "breve"
         else:
-            print "Error! Cannnot process the notes whose duration are %d with divisions=%d" % self.duration, divisions
-            quit()
-        
-            
+            raise ValueError("Cannnot process the notes whose duration are %d with divisions=%d"
+                             % (self.duration, divisions))
+
+
+# 音符列クラス
+class Melody:
+    """Series of Notes stored in columns
+
+    音符列をNumPyの構造化配列(MELODY_DTYPE)として格納するクラス
+    Noteのリストと同じようにlen，添字，forで扱える (取り出すとNoteになる)
+    列 (melody.array["time"] など) を使えば音符列全体をまとめて計算できる
+
+    instance variables:
+    array -- 音符列 [numpy.ndarray (MELODY_DTYPE)]
+             time, duration, midi (休符は-1), step, alter, octave, dot, time_mod
+             多声の場合 (extract_partsでpoly=True) はPOLY_DTYPE (列voiceが加わる)
+             その場合は同時に鳴る音があり，休符は含まない (index_at, note_atは使えない)
+    """
+
+    # 各列の型
+    MELODY_DTYPE = np.dtype([("time", np.int32), ("duration", np.int32), ("midi", np.int16),
+                             ("step", "S1"), ("alter", np.int8), ("octave", np.int8),
+                             ("dot", np.bool_), ("time_mod", np.bool_)])
+    # 多声の場合 (声部の番号を加える)
+    POLY_DTYPE = np.dtype(MELODY_DTYPE.descr + [("voice", np.int8)])
+
+    # コンストラクタ
+    # notes: Noteのイテレータ
+    def __init__(self, notes=()):
+        self.array = np.array([Melody.record(n) for n in notes], dtype=Melody.MELODY_DTYPE)
+
+    # 構造化配列 (またはdtypeの列の順に並べたタプルのリスト)から生成
+    # dtype: MELODY_DTYPE (省略時) またはPOLY_DTYPE
+    @staticmethod
+    def from_records(records, dtype=None):
+        melody = Melody()
+        melody.array = np.asarray(records, dtype=dtype or Melody.MELODY_DTYPE)
+        return melody
+
+    # Noteを構造化配列の1行分のタプルにする
+    @staticmethod
+    def record(note):
+        midi = -1 if note.step == "R" else note.get_midi_num()
+        return (note.time, note.duration, midi, note.step, note.alter, note.octave,
+                note.dot, note.time_mod)
+
+    def __len__(self):
+        return len(self.array)
+
+    # 添字ならNote，スライスならMelodyを返す
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return Melody.from_records(self.array[i])
+        r = self.array[i]
+        return Note(str(r["step"]), int(r["alter"]), int(r["octave"]), int(r["duration"]),
+                    bool(r["dot"]), int(r["time"]), bool(r["time_mod"]))
+
+    def __iter__(self):
+        for i in range(len(self.array)):
+            yield self[i]
+
+    # 時刻t (スカラーまたは配列) に鳴っている音符のインデックスを返す (なければ-1)
+    # 二分探索なのでO(log 音符数) (時刻ごとの表は作らないので，メモリは曲の長さによらない)
+    def index_at(self, t):
+        t    = np.asarray(t)
+        time = self.array["time"]
+        if not len(time):
+            return np.full(t.shape, -1, dtype=np.intp)
+        # tより前に始まった最後の音符が，tまでに終わっていなければその音符
+        idx  = np.searchsorted(time, t, side="right") - 1
+        last = np.maximum(idx, 0)
+        end  = time[last].astype(np.int64) + self.array["duration"][last]
+        return np.where((idx >= 0) & (t < end), idx, -1)
+
+    # 時刻tに鳴っている音符を返す (なければNone)
+    def note_at(self, t):
+        i = int(self.index_at(t))
+        return self[i] if i >= 0 else None
+
+
 #コードクラス
 class Chord:
     """Chord Description
@@ -205,6 +419,18 @@ class Chord:
     #臨時記号とxx_alt変数の対応を示した辞書
     #とりあえずダブルシャープとダブルフラットまで対応
     accidental = {-2:u"♭♭", -1:u"♭", 0:u"", 1:u"♯", 2:u"♯♯"}
+
+    # MusicXMLの<kind>の値 (番号を配列などで用いる．0番目のnoneはコードなし(N.C.)も表す)
+    KINDS = ("none", "major", "minor", "augmented", "diminished", "dominant",
+             "major-seventh", "minor-seventh", "diminished-seventh", "augmented-seventh",
+             "half-diminished", "major-minor", "major-sixth", "minor-sixth",
+             "dominant-ninth", "major-ninth", "minor-ninth",
+             "dominant-11th", "major-11th", "minor-11th",
+             "dominant-13th", "major-13th", "minor-13th",
+             "suspended-second", "suspended-fourth",
+             "Neapolitan", "Italian", "French", "German", "pedal", "power", "Tristan", "other")
+    # テンションの種類 (番号を配列などで用いる．0番目はテンションなし)
+    DEGREE_TYPES = ("", "add", "alter", "subtract")
     
             
     # テンション・ノート設定
@@ -215,6 +441,7 @@ class Chord:
         self.dr_step = step #テンションは度数表記なのでstepも整数
         self.dr_alt = alt
         self.dr_type = dtype
+        self._symbol = None
 
     # 分数コードのベース音設定
     # step:階名[char], alt:臨時記号[int]
@@ -222,6 +449,7 @@ class Chord:
         
         self.bs_step = step
         self.bs_alt= alt
+        self._symbol = None
     
     # コンストラクタ
     # step:階名[char], alt:臨時記号[int]
@@ -237,9 +465,36 @@ class Chord:
         #ベース
         self.set_bass("", 0) 
 
-    # コード表記の文字列を返す
+    # 根音のピッチクラス (Cを0とする半音単位) を返す
+    def get_root_num(self):
+        return (Note.step2num[self.rt_step] + self.rt_alt) % 12
+
+    # ベース音のピッチクラスを返す (分数コードでなければ根音)
+    def get_bass_num(self):
+        if not self.bs_step:
+            return self.get_root_num()
+        return (Note.step2num[self.bs_step] + self.bs_alt) % 12
+
+    # コードの種類のKINDSでの番号を返す (KINDSにない場合はother)
+    def get_kind_num(self):
+        if self.ch_kind in Chord.KINDS:
+            return Chord.KINDS.index(self.ch_kind)
+        return Chord.KINDS.index("other")
+
+    # コードを区別する値の組 (ChordVocabularyのキー)
+    def get_key(self):
+        return (self.rt_step, self.rt_alt, self.ch_kind, self.ch_text,
+                self.dr_step, self.dr_alt, self.dr_type, self.bs_step, self.bs_alt)
+
+    # コード表記の文字列を返す (一度作ったら覚えておく)
     # Return value: コードの文字列表現[string]
     def get_symbol(self):
+        symbol = getattr(self, "_symbol", None)
+        if symbol is None:
+            symbol = self._symbol = self._make_symbol()
+        return symbol
+
+    def _make_symbol(self):
         symbol = self.rt_step + Chord.accidental[self.rt_alt] + self.ch_text
 
         if self.dr_step:#テンション・ノートがあれば
@@ -252,225 +507,1018 @@ class Chord:
         return symbol
 
 
+# コード進行の配列 (時刻順)
+PROGRESSION_DTYPE = np.dtype([("time", np.int32), ("id", np.int32)])
+
+# コードの語彙
+class ChordVocabulary:
+    """Interned chord vocabulary
+
+    同じ内容 (Chord.get_keyが同じ) のコードに1つの番号 (id) と1つの共有のChordのインスタンスを割り当てる
+    コーパス全体でもコードの種類はわずかなので，抽出したコード進行のChordはCHORD_VOCABで共有のものにする
+    (共有のChordは書き換えないこと)
+    コード進行 {時刻:Chord} は (時刻, id) の配列 (PROGRESSION_DTYPE) にできるので，まとめて計算できる
+    idは語彙 (プロセス) ごとに登録順に付けるので，他のプロセスの語彙のidはkeysとtranslateで読み替える
+    """
+
+    def __init__(self):
+        self.ids     = {} # {キー:id}
+        self.chords  = [] # idごとの共有のChord
+
+    def __len__(self):
+        return len(self.chords)
+
+    # chordのidを返す (初めてのコードならchordを共有のインスタンスとして登録する)
+    def intern(self, chord):
+        key = chord.get_key()
+        i = self.ids.get(key)
+        if i is None:
+            i = self.ids[key] = len(self.chords)
+            self.chords.append(chord)
+        return i
+
+    # idの共有のChord
+    def chord(self, i):
+        return self.chords[i]
+
+    # idのコード表記 (共有のChordが覚えている)
+    def symbol(self, i):
+        return self.chords[i].get_symbol()
+
+    # idごとのキーのリスト (他のプロセスに渡してtranslateで読み替える)
+    def keys(self):
+        return [chord.get_key() for chord in self.chords]
+
+    # 他の語彙のキーのリストをこの語彙のidの配列にする (ないものは登録する)
+    def translate(self, keys):
+        ids = np.empty(len(keys), dtype=np.int32)
+        for j, key in enumerate(keys):
+            i = self.ids.get(key)
+            if i is None:
+                chord = Chord(key[0], key[1], key[2], key[3])
+                chord.set_degree(key[4], key[5], key[6])
+                chord.set_bass(key[7], key[8])
+                i = self.intern(chord)
+            ids[j] = i
+        return ids
+
+    # コード進行 {時刻:Chord} を (時刻, id) の配列にする
+    def encode(self, chords):
+        times = sorted(chords)
+        progression = np.empty(len(times), dtype=PROGRESSION_DTYPE)
+        progression["time"] = times
+        progression["id"]   = [self.intern(chords[t]) for t in times]
+        return progression
+
+    # (時刻, id) の配列をコード進行 {時刻:共有のChord} に戻す
+    def decode(self, progression):
+        return dict((int(t), self.chords[i]) for t, i in progression.tolist())
+
+    # コード進行 {時刻:Chord} を語彙によらない形にする (ファイルへの保存や他のプロセスへの受け渡し用)
+    # return: (時刻, 番号) の配列 (PROGRESSION_DTYPE)，番号ごとのキーのリスト
+    #         (番号はこのコード進行に現れたコードだけに振り直したもの)
+    def pack(self, chords):
+        progression = self.encode(chords)
+        used, local = np.unique(progression["id"], return_inverse=True)
+        progression["id"] = local
+        return progression, [self.chords[i].get_key() for i in used]
+
+    # packの返り値をこの語彙のコード進行 {時刻:共有のChord} に戻す
+    def unpack(self, progression, keys):
+        progression = progression.copy()
+        progression["id"] = self.translate(keys)[progression["id"]]
+        return self.decode(progression)
+
+# プロセス全体で共有するコードの語彙
+CHORD_VOCAB = ChordVocabulary()
+
+# 共有のChordを返す
+def intern_chord(chord):
+    return CHORD_VOCAB.chord(CHORD_VOCAB.intern(chord))
+
+
 # MusicXMLからメロディとコードを抽出
 def extract_music(soup):
     """Extract Melody and Chords data from MusicXML file
 
     MusicXMLを読み込んだsoupを入力し，そこから曲情報とメロディとコードを抽出してきます
     重音の場合は一番上のみ抽出します
-    return (曲情報[PieceInfo, メロディ[Noteのリスト], コード{時刻:Chordなる辞書}])
+    各小節の中身は1回だけ辿り，タグ名ごとの処理(_MAIN_HANDLERS, _SUB_HANDLERS)に振り分けます
+    return (曲情報[PieceInfo, メロディ[Melody], コード{時刻:Chordなる辞書}])
     """
 
-    melody = []      # 旋律 [Noteのインスタンス, ...]
+    melody = []      # 旋律 [Melody.MELODY_DTYPEの1行分のタプル, ...]
     chords = {}      # コード進行 {時刻:コードのインスタンス, ....}
-    cur_time = 0     # 現在の時刻
-    tmp_duration = 0 # 音符の長さ
     piece = PieceInfo() # 曲情報
-    
+
+    # 楽譜の最上段のパート（主旋律であると想定）
+    # それ以外のパートからはコードのみ拾ってくる
+    # 主旋律のパートを指定したい場合や全パートのメロディが欲しい場合はextract_parts
+    _walk_bs4(soup, lambda part_id: _PartWalker(piece, melody, chords, part_id == "P1"))
+
+    return (piece, Melody.from_records(melody), chords)
+
+# 全パートのメロディを抽出
+def extract_parts(soup, select=None, poly=False):
+    """Extract Melodies of every part from MusicXML file in one traversal
+
+    extract_musicと同様にsoupを入力し，selectで指定したパートそれぞれから
+    曲情報(調，divisionsなど)とメロディを抽出します．コードは全パートから拾います
+    select -- パートIDまたはパート名(part-list中のpart-name)のリスト (Noneなら全パート)
+    poly   -- Trueなら重なっている音，全ての声部を抽出します (backup，forwardに従って時刻を戻す，進める)
+              メロディはMelody.POLY_DTYPEになり，休符は含みません
+    return (パートID順のOrderedDict {パートID:(曲情報[PieceInfo], メロディ[Melody]), ...},
+            コード{時刻:Chordなる辞書})
+    """
+
+    names = {}
+    for sp in soup.find_all("score-part"):
+        pn = sp.find("part-name")
+        names[sp["id"]] = _text_bs4(pn) if pn is not None else None
+
+    parts = _PartCollector(select, names, poly)
+    _walk_bs4(soup, parts.walker)
+    return parts.result()
+
+# soupの各パートの小節を順に辿る
+# walker_for: パートIDを受け取って_PartWalkerを返す関数
+def _walk_bs4(soup, walker_for):
     # パートごとに
     for p in soup.find_all("part"):
+        walker = walker_for(p["id"])
+
+        # 小節ごとに
+        for m in p.find_all("measure"):
+            walker.start_measure(m["number"], m.get("implicit"))
+            # 属性，テンポ，コード，音符，巻き戻し
+            walker.walk(_contents_bs4(m, walker.handlers))
+
+        # 1パート分の処理完了
+        walker.end_part()
+
+
+# 要素の部分木を1回だけ辿り，{タグ名:(テキスト, 属性), ...}なる辞書にする
+# 同じタグ名が複数ある場合は最初のもの (find()と同じ)
+def _flatten_et(elem):
+    flat = {}
+    for e in elem.iter():
+        if e.tag not in flat:
+            flat[e.tag] = (e.text, e.attrib)
+    return flat
+
+# 小節の子要素のうち処理対象のものを (タグ名, 平坦化した部分木) として返す
+def _contents_et(measure, handlers):
+    for c in measure:
+        if c.tag in handlers:
+            yield c.tag, _flatten_et(c)
+
+# BeautifulSoup版 (文字列ノードのnameはNone)
+# NavigableStringは木全体への参照を持つのでunicodeにしておく
+def _flatten_bs4(tag):
+    flat = {tag.name:(_text_bs4(tag), tag.attrs)}
+    for e in tag.descendants:
+        if e.name is not None and e.name not in flat:
+            flat[e.name] = (_text_bs4(e), e.attrs)
+    return flat
+
+def _text_bs4(tag):
+    text = tag.string
+    return None if text is None else unicode(text)
+
+# HTMLとして読み込んだ場合に備え，処理対象でない要素の中も辿る (find_all()と同じ)
+def _contents_bs4(measure, handlers):
+    for c in measure.children:
+        if c.name in handlers:
+            yield c.name, _flatten_bs4(c)
+        elif c.name is not None:
+            for content in _contents_bs4(c, handlers):
+                yield content
+
+
+# 属性 (調，divisions，拍子)
+def _on_attributes(w, flat):
+    if "key" in flat and "fifths" in flat: # 調
+        w.piece.set_key(1, w.cur_num, int(flat["fifths"][0]))
+    if "divisions" in flat: # divisions
+        w.piece.set_divisions(1, int(flat["divisions"][0]))
+    if "time" in flat and "beats" in flat: # 拍子
+        w.piece.set_time(w.cur_num, int(flat["beats"][0]), int(flat["beat-type"][0]))
+
+# テンポ (directionのうちmetronome, soundのみ対象)
+def _on_direction(w, flat):
+    s_tempo = None
+    if "sound" in flat and "tempo" in flat["sound"][1]:
+        s_tempo = int(flat["sound"][1]["tempo"])
+        bpm     = s_tempo   # もしmetronomeがなかったらsound["tempo"]
+        b_unit  = "quarter" # から表記の値を決める
+    if "metronome" in flat:
+        bpm    = int(flat["per-minute"][0])
+        b_unit = flat["beat-unit"][0]
+        if s_tempo is None: # もしsoundがなかったら
+            s_tempo = bpm
+    # テンポの指定がないdirection (強弱記号など) は無視
+    if s_tempo is None:
+        return
+    w.piece.set_tempo(w.cur_num, bpm, b_unit, s_tempo)
+
+# コード
+def _on_harmony(w, flat):
+    # 根音
+    rt_step = flat["root-step"][0]
+    rt_alt  = int(flat["root-alter"][0]) if "root-alter" in flat else 0
+    # 種類
+    h_kind = flat["kind"][0]
+    h_text = flat["kind"][1].get("text", "")
+
+    # 基本要素でコードインスタンス生成
+    chord = Chord(rt_step, rt_alt, h_kind, h_text)
+    # テンション
+    if "degree" in flat:
+        chord.set_degree(int(flat["degree-value"][0]), int(flat["degree-alter"][0]),
+                         flat["degree-type"][0])
+    # 分数コードのベース音
+    if "bass" in flat:
+        bs_alt = int(flat["bass-alter"][0]) if "bass-alter" in flat else 0
+        chord.set_bass(flat["bass-step"][0], bs_alt)
+
+    # 次の音符の開始時刻からのずれ <offset>
+    offset = int(flat["offset"][0]) if "offset" in flat else 0
+    # 同じ内容のコードは1つのインスタンスを共有する
+    w.chords[w.cur_time + offset] = intern_chord(chord)
+
+# 音符の音程 (階名, 変化記号, オクターブ)．休符ならNone
+# 打楽器の音符 <unpitched> は五線上の表示位置 (display-step, display-octave) を音程とする
+def _note_pitch(flat):
+    if "pitch" in flat:
+        return (flat["step"][0], int(flat["alter"][0]) if "alter" in flat else 0,
+                int(flat["octave"][0]))
+    if "unpitched" in flat and "display-step" in flat:
+        return flat["display-step"][0], 0, int(flat["display-octave"][0])
+    return None
+
+# 音符 (重なっている音は一番下以外無視，durationを持たない音符は無視)
+# 複数声部ある場合はvoice=1以外無視
+def _on_note(w, flat):
+    if "chord" in flat or "duration" not in flat:
+        return
+    if "voice" in flat and int(flat["voice"][0]) != 1:
+        return
+
+    # 長さ
+    note_dur = int(flat["duration"][0])
+
+    # 音程のある音符 (打楽器の音符は表示位置)
+    pitch = _note_pitch(flat)
+    if pitch is not None:
+        note_step, note_alt, note_oct = pitch
+    # 休符
+    else:
+        note_step = "R" # 休符の階名はRとする
+        note_oct  = 0
+        note_alt  = 0
 
-        # 楽譜の頭
-        cur_time = 0
+    # 付点の有無，連符かどうか
+    dot      = "dot" in flat
+    note_mod = "time-modification" in flat
 
-        # 楽譜の最上段のパート（主旋律であると想定）                        
-        # 主旋律はこのパートっていう指定ができるようにしてもいいかもしれない
-        if p["id"] == "P1": 
+    # MIDI note number (休符は-1)
+    if note_step == "R":
+        midi = -1
+    else:
+        midi = 12 * (note_oct + 1) + Note.step2num[note_step] + note_alt
+
+    # 音符情報をリストに追加して現在時刻を音符の長さ分だけ進める
+    # (Melody.MELODY_DTYPEの列の順)
+    w.melody.append((w.cur_time, note_dur, midi, note_step, note_alt, note_oct, dot, note_mod))
+    w.cur_time += note_dur
+
+# 主旋律以外のパートの音符 (現在時刻を取得するため)
+def _on_sub_note(w, flat):
+    if "chord" not in flat and "duration" in flat:
+        w.cur_time += int(flat["duration"][0])
+
+# 巻き戻し
+def _on_backup(w, flat):
+    w.cur_time -= int(flat["duration"][0])
+
+# 早送り (多声の場合のみ)
+def _on_forward(w, flat):
+    w.cur_time += int(flat["duration"][0])
+    w.max_time = max(w.max_time, w.cur_time)
+
+# 多声の場合の音符 (重なっている音，全ての声部を抽出，休符は時刻を進めるのみ)
+# <chord/>のある音符は直前の音符と同時に始まる
+def _on_poly_note(w, flat):
+    if "duration" not in flat: # 装飾音符
+        return
+    note_dur = int(flat["duration"][0])
+
+    if "chord" in flat:
+        onset = w.last_onset
+    else:
+        onset = w.cur_time
+        w.last_onset = onset
+        w.cur_time  += note_dur
+        w.max_time   = max(w.max_time, w.cur_time)
+
+    # 休符 (打楽器の音符は表示位置を音程とする)
+    pitch = _note_pitch(flat)
+    if pitch is None:
+        return
+    note_step, note_alt, note_oct = pitch
+    midi      = 12 * (note_oct + 1) + Note.step2num[note_step] + note_alt
+    voice     = int(flat["voice"][0]) if "voice" in flat else 1
+
+    # (Melody.POLY_DTYPEの列の順)
+    w.melody.append((onset, note_dur, midi, note_step, note_alt, note_oct,
+                     "dot" in flat, "time-modification" in flat, voice))
+
+
+# タグ名と処理の対応表
+# 主旋律のパート (単音しか扱わないので巻き戻しは無視する)
+_MAIN_HANDLERS = {"attributes":_on_attributes, "direction":_on_direction,
+                  "harmony":_on_harmony, "note":_on_note}
+# それ以外のパート (コードのみ拾ってくる)
+_SUB_HANDLERS  = {"harmony":_on_harmony, "note":_on_sub_note, "backup":_on_backup}
+# 多声のパート (全ての声部と重なっている音を抽出する)
+_POLY_HANDLERS = {"attributes":_on_attributes, "direction":_on_direction,
+                  "harmony":_on_harmony, "note":_on_poly_note,
+                  "backup":_on_backup, "forward":_on_forward}
+# 曲情報のみ (音符は読まないので時刻は進まない)
+_HEADER_HANDLERS = {"attributes":_on_attributes, "direction":_on_direction}
+
+
+# 1パート分の抽出の状態
+class _PartWalker(object):
+    """Walks measures of one part and dispatches their contents
+
+    main=True の場合はそのパートから曲情報とメロディとコードを，
+    main="header" の場合は曲情報 (調，拍子，テンポ，divisions，小節数) のみを，
+    それ以外の場合はコードのみを抽出する
+    poly=True (mainの場合のみ) ではメロディとして全ての声部と重なっている音を抽出する
+    """
 
-            # 0小節目の処理に用いるフラグ
-            impl=False
-            
-            # 小節ごとに
-            for m in p.find_all("measure"):
-
-                cur_num = int(m["number"]) # 現在の小節番号
-
-                # 0小節目の処理
-                if impl:
-                    piece.set_ub_length(cur_time)
-                    impl = False
-                if cur_num == 0 and "implicit" in m.attrs:
-                    if m["implicit"] == "yes":
-                        piece.set_upbeat(flag=True)
-                        impl=True
-                
-                # 属性，テンポ，コード，音符，巻き戻し
-                for content in m.find_all({"attributes", "direction", "harmony", "note", "backup"}):
-
-                    # 巻き戻し
-                    # 単音しか扱わないので現在は無視する
-                    # if content.name == "backup":
-                    #     cur_time -= int(content.duration.string)
-                    
-                    # 属性
-                    if content.name == "attributes":
-                        if content.find("key"): # 調
-                            piece.set_key(1, cur_num, int(content.key.fifths.string))
-                        if content.find("divisions"): # divisions
-                            piece.set_divisions(1, int(content.divisions.string))
-                        if content.find("time"): # 拍子
-                            piece.set_time(cur_num, int(content.time.beats.string),
-                                           int(content.time.find("beat-type").string))
-                            
-                    # テンポ (directionのうちmetronome, soundのみ対象)
-                    if content.name == "direction":
-                        flg = 0
-                        if content.find("sound"):
-                            if "tempo" in content.sound.attrs:
-                                s_tempo = int(content.sound["tempo"])
-                                bpm     = s_tempo   # もしmetronomeがなかったらsound["tempo"]
-                                b_unit  = "quarter" # から表記の値を決める
-                                flg = 1
-                                
-                        if content.find("direction-type").find("metronome"):
-                            tmp = content.find("direction-type").metronome
-                            bpm     = int(tmp.find("per-minute").string)
-                            b_unit  = tmp.find("beat-unit").string
-                            if not flg: # もしsoundがなかったら
-                                s_tempo = bpm
-                        # セット
-                        piece.set_tempo(cur_num, bpm, b_unit, s_tempo)
-                            
-                        
-                    # コード
-                    if content.name == "harmony":
-                        # 根音
-                        rt_step = content.root.find("root-step").string
-                        if content.root.find("root-alter"):
-                            rt_alt = int(content.root.find("root-alter").string)
-                        else:
-                            rt_alt = 0
-                             
-                        # 種類
-                        h_kind = content.kind.string
-                        h_text = content.kind["text"]
-
-                        # 基本要素でコードインスタンス生成
-                        chords[cur_time] = Chord(rt_step, rt_alt, h_kind, h_text)
-                            
-                        # テンション
-                        if content.degree:
-                            dr_step = int(content.degree.find("degree-value").string)
-                            dr_alt  = int(content.degree.find("degree-alter").string)
-                            dr_type = content.degree.find("degree-type").string
-                            chords[cur_time].set_degree(dr_step, dr_alt, dr_type)
-                            
-                        # 分数コードのベース音
-                        if content.bass:
-                            bs_step = content.bass.find("bass-step").string
-                            if content.bass.find("bass-alter"):
-                                bs_alt = int(content.bass.find("bass-alter").string)
-                            else:
-                                bs_alt = 0
-
-                            chords[cur_time].set_bass(bs_step, bs_alt)
-
-                    # 音符 (重なっている音は一番下以外無視，durationを持たない音符は無視)
-                    # 複数声部ある場合はvoice=1以外無視                    
-                    if content.name == "note" and not content.chord and content.duration \
-                       and (not content.voice or int(content.find("voice").string)==1):
-
-                        # 長さ
-                        note_dur = int(content.duration.string)
-                        
-                        # 音程のある音符
-                        if content.pitch:
-                            note_step = content.pitch.step.string
-                            note_oct  = int(content.pitch.octave.string)
-                            if content.pitch.alter:
-                                note_alt = int(content.pitch.alter.string)
-                            else:
-                                note_alt = 0
-
-                        # 休符
-                        if content.rest:
-                            note_step = "R" # 休符の階名はRとする
-                            note_oct  = 0
-                            note_alt  = 0
-
-                        # 付点の有無
-                        if content.find("dot"):
-                            dot = True
-                        else:
-                            dot = False
-                            
-                        # 連符かどうか
-                        if content.find("time-modification"):
-                            note_mod = True
-                        else:
-                            note_mod = False
-                            
-                        # 音符情報をリストに追加
-                        melody.append(Note(note_step, note_alt, note_oct, note_dur, dot, cur_time, note_mod))
-                        
-                        #現在時刻を音符の長さ分だけ進める
-                        cur_time += note_dur
-
-                        # 音符1個分の処理完了
-                    # 1 content分の処理完了
-                
-                # 1小節分の処理完了
-            # 1パート分の処理完了
-            
-            # 小節数を記録
-            piece.measure_num = cur_num
-            # 曲の長さ (拍数 × divisions)を記録
-            piece.length = cur_time
-            
-        #それ以外のパート
-        #コードのみ拾ってくる
+    def __init__(self, piece, melody, chords, main, poly=False):
+        self.piece    = piece
+        self.melody   = melody
+        self.chords   = chords
+        self.main     = main
+        if main == "header":
+            self.handlers = _HEADER_HANDLERS
+        elif main:
+            self.handlers = _POLY_HANDLERS if poly else _MAIN_HANDLERS
         else:
+            self.handlers = _SUB_HANDLERS
+        self.cur_time = 0     # 現在の時刻
+        self.cur_num  = 0     # 現在の小節番号
+        self.impl     = False # 0小節目の処理に用いるフラグ
+        self.max_time   = 0 # 小節内で到達した最も遅い時刻 (多声の場合のみ)
+        self.last_onset = 0 # 直前の音符の開始時刻 (多声の場合のみ)
+
+    # 小節の開始
+    # number:小節番号[str], implicit:implicit属性の値[str or None]
+    def start_measure(self, number, implicit):
+        if not self.main:
+            return
+        self.cur_num = int(number)
+        # 多声の場合，巻き戻した後の声部が小節の最後まで続かなくても次の小節は小節の終わりから
+        self.cur_time = max(self.cur_time, self.max_time)
+
+        # 0小節目の処理
+        if self.impl:
+            self.piece.set_ub_length(self.cur_time)
+            self.impl = False
+        if self.cur_num == 0 and implicit == "yes":
+            self.piece.set_upbeat(flag=True)
+            self.impl = True
+
+    # 小節の中身の処理
+    # contents: (タグ名, 平坦化した部分木)のイテレータ
+    def walk(self, contents):
+        handlers = self.handlers
+        for tag, flat in contents:
+            handlers[tag](self, flat)
+
+    # パートの終了
+    def end_part(self):
+        if self.main:
+            # 小節数と曲の長さ (拍数 × divisions)を記録
+            self.piece.measure_num = self.cur_num
+            self.piece.length      = max(self.cur_time, self.max_time)
+
+
+# extract_partsの結果を集める
+class _PartCollector(object):
+    """Creates a walker per part and collects the selected parts
+
+    selectに含まれるパートはメロディも，それ以外はコードのみを抽出する
+    names: {パートID:パート名} (iterparseではパートより前のpart-listを読みながら埋まる)
+    poly: Trueなら全ての声部と重なっている音を抽出する
+    """
+
+    def __init__(self, select, names, poly=False):
+        self.select = None if select is None else set(select)
+        self.names  = names
+        self.poly   = poly
+        self.parts  = OrderedDict() # {パートID:(曲情報, メロディのタプルのリスト)}
+        self.chords = {}
+
+    # パートIDを受け取って_PartWalkerを返す
+    def walker(self, part_id):
+        if self.select is None or part_id in self.select or self.names.get(part_id) in self.select:
+            piece, melody = PieceInfo(), []
+            self.parts[part_id] = (piece, melody)
+            return _PartWalker(piece, melody, self.chords, True, self.poly)
+        return _PartWalker(None, None, self.chords, False)
+
+    def result(self):
+        parts = OrderedDict()
+        for part_id, (piece, melody) in self.parts.items():
+            if self.poly:
+                # 声部ごとに抽出されるので時刻順 (同時刻は声部，音高の順) に並べ直す
+                melody = Melody.from_records(melody, Melody.POLY_DTYPE)
+                melody.array = melody.array[np.lexsort((melody.array["midi"], melody.array["voice"],
+                                                        melody.array["time"]))]
+            else:
+                melody = Melody.from_records(melody)
+            parts[part_id] = (piece, melody)
+        return (parts, self.chords)
+
+
+# MusicXMLから逐次的にメロディとコードを抽出
+def extract_music_stream(source):
+    """Extract Melody and Chords data from MusicXML file incrementally
+
+    MusicXMLのファイル名(またはファイルオブジェクト)を入力し，iterparseで
+    読み込みながら曲情報とメロディとコードを抽出します
+    処理の済んだ<measure>は順次破棄するので，楽譜の大きさによらずメモリ使用量は一定です
+    return extract_musicと同じ (曲情報[PieceInfo], メロディ[Melody], コード{時刻:Chordなる辞書})
+    """
+
+    melody = []         # 旋律 [Melody.MELODY_DTYPEの1行分のタプル, ...]
+    chords = {}         # コード進行 {時刻:コードのインスタンス, ....}
+    piece = PieceInfo() # 曲情報
+
+    _walk_stream(source, lambda part_id: _PartWalker(piece, melody, chords, part_id == "P1"), {})
+
+    return (piece, Melody.from_records(melody), chords)
 
-             for m in p.find_all("measure"):
-                
-                for content in m.find_all({"harmony", "note", "backup"}):
-
-                    #巻き戻し
-                    if content.name == "backup":
-                        cur_time -= int(content.duration.string)
-                    
-                    #コード
-                    if content.name == "harmony":
-                        #根音
-                        rt_step = content.root.find("root-step").string
-                        if content.root.find("root-alter"):
-                            rt_alt = int(content.root.find("root-alter").string)
-                        else:
-                            rt_alt = 0
-                            
-                        #種類
-                        h_kind = content.kind.string
-                        h_text = content.kind["text"]
-
-                        #基本要素でコードインスタンス生成
-                        chords[cur_time] = Chord(rt_step, rt_alt, h_kind, h_text)
-                            
-                        #テンション
-                        if content.degree:
-                            dr_step = int(content.degree.find("degree-value").string)
-                            dr_alt  = int(content.degree.find("degree-alter").string)
-                            dr_type = content.degree.find("degree-type").string
-                            chords[cur_time].set_degree(dr_step, dr_alt, dr_type)
-                            
-                        #分数コードのベース音
-                        if content.bass:
-                            bs_step = content.bass.find("bass-step").string
-                            if content.bass.find("bass-alter"):
-                                bs_alt = int(content.bass.find("bass-alter").string)
-                            else:
-                                bs_alt = 0
-
-                            chords[cur_time].set_bass(bs_step, bs_alt)
-
-                    #音符（現在時刻を取得するため）
-                    if content.name == "note" and not content.chord and content.duration:
-                        tmp_duration = int(content.duration.string)
-                        cur_time += tmp_duration
-
-                            
+# 全パートのメロディを逐次的に抽出
+def extract_parts_stream(source, select=None, poly=False):
+    """Extract Melodies of every part from MusicXML file incrementally
+
+    extract_music_streamと同様にiterparseで1回だけ読み込み，extract_partsと同じ結果を返します
+    """
+
+    names = {}
+    parts = _PartCollector(select, names, poly)
+    _walk_stream(source, parts.walker, names)
+    return parts.result()
+
+# 曲情報のみを抽出
+def scan_header(source):
+    """Extract piece information only, without reading notes and chords
+
+    extract_music_streamと同様にiterparseで読み込むが，最初のパートの調，拍子，テンポ，divisions，
+    小節数のみを抽出し，2つ目のパートの開始で読み込みをやめる (音符の処理をしないので非常に速い)
+    音符を読まないので，曲の長さ (length) と弱起の長さ (upbeat_l) は0のまま
+    (measures()の拍子，調，テンポの列は使えるが，開始時刻と長さの列は使えない)
+    return 曲情報[PieceInfo]
+    """
+
+    piece = PieceInfo()
+    parts = []
+    def walker_for(part_id):
+        parts.append(part_id)
+        if len(parts) > 1:
+            return None
+        return _PartWalker(piece, None, None, "header")
+
+    _walk_stream(source, walker_for, {})
+    return piece
+
+# MusicXMLファイル (.mxl，gzip圧縮も可) の曲情報のみを抽出
+def load_header(xml_file):
+    """Load MusicXML file and extract piece information only (see scan_header)"""
+
+    with stage("extract"), closing(open_score(xml_file)) as f:
+        return scan_header(f)
+
+# 読み込み済みのMusicXML (バイト列) の曲情報のみを抽出
+def parse_header(data):
+    """Extract piece information only from MusicXML data (see scan_header)"""
+
+    with stage("extract"):
+        return scan_header(decompress_score(StringIO(data)))
+
+# iterparseで各パートの小節を順に辿る
+# walker_for: パートIDを受け取って_PartWalkerを返す関数 (Noneを返したらそこで読み込みをやめる)
+# names: part-listのパート名を書き込む辞書 {パートID:パート名}
+def _walk_stream(source, walker_for, names):
+
+    part   = None # 処理中の<part>
+    walker = None # 処理中のパートの状態
+
+    for event, elem in cET.iterparse(source, events=("start", "end")):
+
+        if event == "start":
+            # パートの開始
+            if elem.tag == "part":
+                part   = elem
+                walker = walker_for(elem.get("id"))
+                if walker is None:
+                    return
+            # 小節の開始 (属性のみ参照できる)
+            elif elem.tag == "measure" and walker is not None:
+                walker.start_measure(elem.get("number"), elem.get("implicit"))
+
+        # 小節の終了
+        elif elem.tag == "measure" and walker is not None:
+            walker.walk(_contents_et(elem, walker.handlers))
+            # 処理の済んだ小節を破棄
+            elem.clear()
+            part.remove(elem)
+
+        # パートの終了
+        elif elem.tag == "part":
+            walker.end_part()
+            walker = None
+            elem.clear()
+
+        # パート名
+        elif elem.tag == "score-part":
+            names[elem.get("id")] = elem.findtext("part-name")
+
+
+# 抽出に用いるパーサ
+PARSERS = ("bs4", "iterparse")
+
+# 抽出器のバージョン
+# 抽出結果が変わるような変更をしたら上げる (MusicCacheの古い結果を使わないように)
+EXTRACTOR_VERSION = 3
+
+# 読み込めるファイルの拡張子 (.mxlは圧縮MusicXML，.gzはgzipで圧縮したMusicXML)
+SCORE_EXTENSIONS = (".xml", ".musicxml", ".mxl", ".xml.gz", ".musicxml.gz")
+
+# 読み込めるファイルかどうか (拡張子で判断する)
+def is_score_file(name):
+    return name.lower().endswith(SCORE_EXTENSIONS)
+
+# ファイル名から拡張子 (SCORE_EXTENSIONSのいずれか) を除いた曲名
+def score_name(name):
+    for ext in sorted(SCORE_EXTENSIONS, key=len, reverse=True):
+        if name.lower().endswith(ext):
+            return name[:-len(ext)]
+    return os.path.splitext(name)[0]
+
+# MusicXMLファイル (.mxl，gzip圧縮も可) を開く
+def open_score(xml_file):
+    """Open MusicXML file as a stream of uncompressed MusicXML
+
+    .mxl, .gzのファイルは展開しながら読み出すファイルオブジェクトを返す
+    (一時ファイルには展開しない)．圧縮されているかどうかは中身の先頭で判断する
+    """
+    return decompress_score(open(xml_file, "rb"))
+
+# ファイルオブジェクト (seekできるもの) の中身が圧縮されていれば展開しながら読み出すものにする
+def decompress_score(f):
+    """Wrap a raw score file object so that it yields uncompressed MusicXML"""
+
+    magic = f.read(4)
+    f.seek(0)
+
+    # gzip
+    if magic[:2] == "\x1f\x8b":
+        return _ScoreStream(gzip.GzipFile(fileobj=f, mode="rb"), f)
+
+    # .mxl (zip) META-INF/container.xmlに書かれた楽譜ファイルを開く
+    if magic == "PK\x03\x04":
+        archive = zipfile.ZipFile(f)
+        try:
+            return _ScoreStream(archive.open(_mxl_rootfile(archive)), archive, f)
+        except:
+            archive.close()
+            f.close()
+            raise
+
+    return f
+
+# 展開しながら読み出すファイルオブジェクト
+# GzipFile(fileobj=...)やZipFile.openの返り値は閉じても元のファイルを閉じないので，
+# closeで元のファイル (とzipのアーカイブ) もまとめて閉じる
+class _ScoreStream:
+    """Decompressing stream that closes the underlying files too"""
+
+    def __init__(self, stream, *owners):
+        self._stream = stream
+        self._owners = owners
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def __iter__(self):
+        return iter(self._stream)
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            for owner in self._owners:
+                owner.close()
+
+# .mxlの中の楽譜ファイルの名前
+def _mxl_rootfile(archive):
+    try:
+        container = cET.fromstring(archive.read("META-INF/container.xml"))
+    except KeyError: # container.xmlがない場合はMETA-INF以外の最初のXML
+        for name in archive.namelist():
+            if not name.startswith("META-INF/") and is_score_file(name):
+                return name
+        raise ValueError("No MusicXML file in the archive")
+
+    # 最初のMusicXMLのrootfile (media-typeがなければMusicXMLとみなす)
+    for elem in container.getiterator():
+        if elem.tag.split("}")[-1] == "rootfile" and \
+           elem.get("media-type", MXL_MEDIA_TYPE) == MXL_MEDIA_TYPE:
+            return elem.get("full-path")
+    raise ValueError("No MusicXML rootfile in META-INF/container.xml")
+
+MXL_MEDIA_TYPE = "application/vnd.recordare.musicxml+xml"
+
+
+# MusicXMLファイルを読み込んで曲情報とメロディとコードを抽出
+# xml_file: MusicXMLのパス (.mxl，gzip圧縮も可)
+# parser: "bs4"ならBeautifulSoup，"iterparse"ならextract_music_streamを用いる
+# cache: MusicCache (指定すると同じ内容のファイルは2回目以降パースを省略する)
+def load_music(xml_file, parser="bs4", cache=None):
+    """Load MusicXML file and extract piece information, melody and chords"""
+
+    if parser not in PARSERS:
+        raise ValueError("Unknown parser: %s" % parser)
+
+    # iterparseでは読み込み，解析，抽出を区別できないので全てextractとして計測する
+    if cache is None and parser == "iterparse":
+        with stage("extract"), closing(open_score(xml_file)) as f:
+            return extract_music_stream(f)
+
+    # キャッシュを使う場合は内容のハッシュを求めるために全体を読み込む
+    with stage("read"):
+        data = open(xml_file, "rb").read()
+    return parse_music(data, parser, cache)
+
+# 読み込み済みのMusicXML (ファイルの中身のバイト列．.mxl，gzip圧縮も可) から曲情報とメロディとコードを抽出
+# cache: load_musicと同じ (キーは圧縮されたままの中身から求める)
+def parse_music(data, parser="bs4", cache=None):
+    """Extract piece information, melody and chords from MusicXML data"""
+
+    if cache is not None:
+        with stage("cache"):
+            key   = cache.key(data)
+            music = cache.get(key)
+        if music is None:
+            music = parse_music(data, parser)
+            with stage("cache"):
+                cache.put(key, music)
+        return music
+
+    if parser == "iterparse":
+        with stage("extract"):
+            return extract_music_stream(decompress_score(StringIO(data)))
+    elif parser == "bs4":
+        with stage("parse"):
+            soup = BeautifulSoup(decompress_score(StringIO(data)).read(), "lxml")
+        with stage("extract"):
+            return extract_music(soup)
+    else:
+        raise ValueError("Unknown parser: %s" % parser)
+
+
+# MusicXMLファイルを読み込んで全パート(またはselectで指定したパート)のメロディを抽出
+# parser: load_musicと同じ, select: パートIDまたはパート名のリスト
+# poly: Trueなら重なっている音，全ての声部を抽出する
+def load_parts(xml_file, parser="bs4", select=None, poly=False):
+    """Load MusicXML file and extract melodies of each part"""
+
+    if parser == "iterparse":
+        with stage("extract"), closing(open_score(xml_file)) as f:
+            return extract_parts_stream(f, select, poly)
+    with stage("read"):
+        data = open(xml_file, "rb").read()
+    return parse_parts(data, parser, select, poly)
+
+# 読み込み済みのMusicXML (バイト列) から各パートのメロディを抽出
+def parse_parts(data, parser="bs4", select=None, poly=False):
+    """Extract melodies of each part from MusicXML data"""
+
+    if parser == "iterparse":
+        with stage("extract"):
+            return extract_parts_stream(decompress_score(StringIO(data)), select, poly)
+    elif parser == "bs4":
+        with stage("parse"):
+            soup = BeautifulSoup(decompress_score(StringIO(data)).read(), "lxml")
+        with stage("extract"):
+            return extract_parts(soup, select, poly)
+    else:
+        raise ValueError("Unknown parser: %s" % parser)
+
+# MusicXMLファイルを読み込んで1つのパートの曲情報とメロディとコードを抽出
+# part: パートIDまたはパート名, cache: load_musicと同じ
+# return load_musicと同じ (曲情報, メロディ, コード)
+def load_part(xml_file, part="P1", parser="bs4", poly=False, cache=None):
+    """Load MusicXML file and extract piece information, melody and chords of one part"""
+
+    if cache is None:
+        return _one_part(load_parts(xml_file, parser, [part], poly), part)
+    with stage("read"):
+        data = open(xml_file, "rb").read()
+    return parse_part(data, part, parser, poly, cache)
+
+# 読み込み済みのMusicXML (バイト列) から1つのパートの曲情報とメロディとコードを抽出
+def parse_part(data, part="P1", parser="bs4", poly=False, cache=None):
+    """Extract piece information, melody and chords of one part from MusicXML data"""
+
+    if cache is None:
+        return _one_part(parse_parts(data, parser, [part], poly), part)
+
+    # パートと多声かどうかごとに別のキャッシュにする
+    variant = "-" + hashlib.sha1(repr((part, bool(poly)))).hexdigest()[:8]
+    with stage("cache"):
+        key   = cache.key(data, variant)
+        music = cache.get(key)
+    if music is None:
+        music = _one_part(parse_parts(data, parser, [part], poly), part)
+        with stage("cache"):
+            cache.put(key, music)
+    return music
+
+# extract_partsの結果から最初のパートを取り出す
+def _one_part(result, part):
+    parts, chords = result
+    if not parts:
+        raise ValueError("No such part: %s" % part)
+    piece, melody = parts.values()[0]
     return (piece, melody, chords)
 
 
+# 時刻を目標の分解能に直すときの丸め方
+# nearest: 最も近い値 (ちょうど中間なら後ろ), floor: 切り捨て, ceil: 切り上げ,
+# strict: 割り切れない時刻があればValueError
+QUANTIZE = ("nearest", "floor", "ceil", "strict")
+
+# 時刻 (スカラーまたは配列) にratio[Fraction]を掛け，quantizeに従って整数に丸める
+def rescale_ticks(ticks, ratio, quantize="nearest"):
+    """Multiply ticks by a rational ratio exactly and round them onto the integer grid"""
+
+    num, den = ratio.numerator, ratio.denominator
+    scaled = np.asarray(ticks, dtype=np.int64) * num
+
+    if quantize == "nearest":
+        return (2 * scaled + den) // (2 * den)
+    elif quantize == "floor":
+        return scaled // den
+    elif quantize == "ceil":
+        return -(-scaled // den)
+    elif quantize == "strict":
+        if np.any(scaled % den):
+            raise ValueError("Some ticks are not on the grid of the target divisions")
+        return scaled // den
+    else:
+        raise ValueError("Unknown quantize: %s" % quantize)
+
+# 曲情報，メロディ，コードの全ての時刻を，divisionsを4分音符の長さとする値に直す
+def normalize_music(music, divisions=24, quantize="nearest"):
+    """Rescale every tick of (piece_info, melody, chords) to the given divisions
+
+    元のdivisionsとの比は有理数(Fraction)のまま計算し，割り切れない時刻はquantize(QUANTIZEのいずれか)
+    に従って丸める．音符は開始時刻と終了時刻をそれぞれ丸めるので，隙間なく並んだ音符は丸めた後も隙間なく並ぶ
+    丸めた結果長さが0になった音符は除き，同じ時刻に丸められたコードは最初のものを残す
+    divisionsが同じ場合は入力をそのまま返す
+
+    music -- (曲情報[PieceInfo], メロディ[Melody], コード{時刻:Chord}) (load_musicなどの返り値)
+    return: musicと同じ形の新しいタプル
+    """
+
+    piece, melody, chords = music
+    if not isinstance(melody, Melody):
+        melody = Melody(melody)
+
+    ratio = Fraction(divisions, piece.divisions[1])
+    if ratio == 1:
+        return (piece, melody, chords)
+
+    # 曲情報 (divisions，弱起の長さ，曲の長さ)
+    # 拍子，調，テンポの辞書は入れ子なので，元の曲情報と共有しないよう深くコピーする
+    info = copy.deepcopy(dict((k, v) for k, v in piece.__dict__.items() if not k.startswith("_")))
+    new_piece = PieceInfo()
+    new_piece.__dict__.update(info)
+    new_piece.divisions = dict((part, divisions) for part in piece.divisions)
+    new_piece.upbeat_l  = int(rescale_ticks(piece.upbeat_l, ratio, quantize))
+    new_piece.length    = int(rescale_ticks(piece.length, ratio, quantize))
+
+    # メロディ (開始時刻と終了時刻を丸めて長さを求める)
+    notes  = melody.array.copy()
+    onset  = rescale_ticks(notes["time"], ratio, quantize)
+    offset = rescale_ticks(notes["time"].astype(np.int64) + notes["duration"], ratio, quantize)
+    notes["time"]     = onset
+    notes["duration"] = offset - onset
+    new_melody = Melody.from_records(notes[notes["duration"] > 0], notes.dtype)
+
+    # コード
+    new_chords = {}
+    times = sorted(chords)
+    for t, new_t in zip(times, rescale_ticks(times, ratio, quantize).tolist()):
+        new_chords.setdefault(new_t, chords[t])
+
+    return (new_piece, new_melody, new_chords)
+
+
+# 抽出結果のキャッシュ
+class MusicCache:
+    """On-disk cache of extracted (PieceInfo, Melody, chords)
+
+    MusicXMLの内容のハッシュとEXTRACTOR_VERSIONをキーとして，
+    抽出結果をcache_dir/キー.pkl にバイナリ(pickle)で保存する
+    メロディは構造化配列のまま，コード進行は (時刻, 番号) の配列と番号ごとのコードのキー (ChordVocabulary.pack)
+    として保存するので，読み込みはパースに比べて非常に速い
+    合計サイズがmax_bytesを超えたら，最後に使われたのが古いものから削除する (trim)
+    (最後に使われた時刻はファイルの更新時刻で表す)
+    putのたびに合計サイズの見積もりを増やし，max_bytesを超えるか，前回のtrimから
+    max_bytesのTRIM_FRACTIONだけ書き込んだらtrimする (他のプロセスが書き込んだ分はtrimで数え直す)
+    """
+
+    TRIM_FRACTION = 0.125
+
+    def __init__(self, cache_dir, max_bytes=1 << 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        # 前回のtrimで数えた合計サイズと，それ以降にこのインスタンスで書き込んだサイズ
+        self._total   = None
+        self._written = 0
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError: # 他のプロセスが先に作った場合
+                if not os.path.isdir(cache_dir):
+                    raise
+
+    # data: MusicXMLの内容[str], variant: 同じ内容から異なる結果を抽出する場合に区別する文字列
+    def key(self, data, variant=""):
+        return hashlib.sha1(data).hexdigest() + "-v%d" % EXTRACTOR_VERSION + variant
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + ".pkl")
+
+    # キャッシュにあれば (曲情報, メロディ, コード) を，なければNoneを返す
+    # 読めないもの (壊れたファイル，古い形式など) はどんな例外でもないものとして扱う (putで上書きされる)
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                info, melody, progression, chord_keys = pickle.load(f)
+            piece = PieceInfo()
+            piece.__dict__.update(info)
+            melody = Melody.from_records(melody, melody.dtype)
+            chords = CHORD_VOCAB.unpack(progression, chord_keys)
+        except Exception:
+            return None
+
+        # 使われた時刻を更新 (trimで既に削除されていても構わない)
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return (piece, melody, chords)
+
+    def put(self, key, music):
+        piece, melody, chords = music
+        if not isinstance(melody, Melody):
+            melody = Melody(melody)
+
+        # 書き込み途中のファイルを他のプロセスが読まないよう，一時ファイルから置き換える
+        path = self.path(key)
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        # 小節の表 (_measures) は保存しない
+        info = dict((k, v) for k, v in piece.__dict__.items() if not k.startswith("_"))
+        progression, chord_keys = CHORD_VOCAB.pack(chords)
+        with open(tmp_path, "wb") as f:
+            pickle.dump((info, melody.array, progression, chord_keys), f, pickle.HIGHEST_PROTOCOL)
+            size = f.tell()
+        os.rename(tmp_path, path)
+
+        self._written += size
+        if self._total is None or self._total + self._written > self.max_bytes or \
+           self._written > self.max_bytes * MusicCache.TRIM_FRACTION:
+            self.trim()
+
+    # 合計サイズがmax_bytes以下になるまで古いものから削除する
+    # (他のプロセスが同時に削除したファイルは数えない)
+    def trim(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".pkl"):
+                try:
+                    st = os.stat(os.path.join(self.cache_dir, name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            total -= size
+
+        self._total   = total
+        self._written = 0
+
+
+# 処理段階ごとの計測
+class Profile:
+    """Per-stage wall time and counters for processing one file
+
+    stage(name)で囲んだ区間の経過時間をnameごとに合計し，count(name, n)で数量 (バイト数，音符数など) を数える
+    set_profileで現在のProfileにすると，xml2vecの読み込み (read)，解析 (parse)，抽出 (extract)，
+    キャッシュ (cache) の各段階がモジュールのstage()を通して計測される
+    メモリは各段階の終わりに現在の常駐メモリ (current_rss_mb) を調べ，このファイルの処理中の最大値を記録する
+    (プロセス全体の最大値ru_maxrssは前のファイルの最大値が残るので，その増分のみ記録する)
+    """
+
+    def __init__(self):
+        self.seconds = OrderedDict()
+        self.counts  = OrderedDict()
+        self.rss_start    = current_rss_mb()
+        self.rss_max      = self.rss_start
+        self.maxrss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0.0) + time.time() - start
+            self.rss_max = max(self.rss_max, current_rss_mb())
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    # 計測結果 (JSONにできる辞書)
+    # rss_mb:             各段階の終わりの常駐メモリの最大値
+    # rss_growth_mb:      rss_mbの処理開始時からの増分 (このファイルで増えたメモリ)
+    # peak_rss_growth_mb: プロセスの最大常駐メモリ (ru_maxrss．単位はLinuxではKB) の処理開始時からの増分
+    #                     (段階の途中の一時的な最大値も含むが，それまでの最大値を超えた分のみ)
+    def record(self):
+        record = dict(self.counts)
+        record["seconds"] = dict(self.seconds)
+        record["rss_mb"]             = self.rss_max
+        record["rss_growth_mb"]      = self.rss_max - self.rss_start
+        record["peak_rss_growth_mb"] = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                                        - self.maxrss_start) / 1024.0
+        return record
+
+# 現在の常駐メモリ (MB)
+# /proc/self/statusのVmRSS (Linux)．読めない場合はプロセスの最大常駐メモリ
+def current_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+# 計測しない場合のstage
+class _NoStage:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NO_STAGE = _NoStage()
+
+# 現在のProfile (Noneなら計測しない．プロセスごと)
+_profile = None
+
+# 現在のProfileを設定し，それまでのProfileを返す (元に戻すときに使う)
+def set_profile(profile):
+    global _profile
+    previous, _profile = _profile, profile
+    return previous
+
+# 現在のProfileの段階nameとして計測するwith文のコンテキスト (計測しない場合は何もしない)
+def stage(name):
+    if _profile is None:
+        return _NO_STAGE
+    return _profile.stage(name)
+
+
 # 既定のヘッダーを返すだけ
 def WriteHeader():
     """Make MusicXML Header"""
@@ -667,8 +1715,9 @@ def WriteNote(measure, note_info, divisions, m_length):
         nrm_n.text = "2"
 
 # 小節にコードを書き込む
-# measure[xml.etree.ElementTree.SubElement], chord[Chord]
-def WriteChord(measure, chord):
+# measure[xml.etree.ElementTree.SubElement], chord[Chord],
+# offset[int] (次の音符の開始時刻からのずれ，0なら書かない)
+def WriteChord(measure, chord, offset=0):
 
     # <harmony>タグ生成
     harmony = ET.SubElement(measure, "harmony", {"print-frame":"no"})
@@ -713,6 +1762,11 @@ def WriteChord(measure, chord):
         if chord.bs_alt:
             bs_alt = ET.SubElement(bass, "bass-alter")
             bs_alt.text = str(chord.bs_alt)
+
+    # 音符の途中から始まるコード <offset>
+    if offset:
+        ofs = ET.SubElement(harmony, "offset")
+        ofs.text = str(offset)
         
         
 # 5線譜上の情報を書き込んでいく
@@ -723,7 +1777,7 @@ def WriteScore(score, piece_info, melody, chords):
     Keyword arguments:
     score      -- XMLを構成するTreeの頂点 [xml.etree.ElementTree.Element]
     piece_info -- 曲情報 [PieceInfo]
-    melody     -- 旋律 [list]
+    melody     -- 旋律 [Melody またはNoteのリスト]
     chords     -- コード進行 [dictionary of Chord]
     """
     
@@ -732,63 +1786,124 @@ def WriteScore(score, piece_info, melody, chords):
 
         # <part>タグ生成
         part = ET.SubElement(score, "part", {"id":"P%d" % p})
-        
-        # 現在時刻 (時刻の単位は4分音符の長さをdivisionsの値とした整数)
-        cur_time = 0
-        # 小節の開始時刻
-        next_m_time = 0
-        # 音符のインデックス
-        i = 0
-        
+
         # 小節ごと
-        for m in range(0, piece_info.measure_num + 1):
+        for measure in IterMeasures(piece_info, melody, chords, p):
+            part.append(measure)
+
+
+# パートpの小節を1つずつ生成する
+# 入力は楽譜情報, メロディ，コード，パートid
+# 時刻順イベント列の種類 (同時刻ではこの順に並ぶ)
+EV_MEASURE = 0 # 小節の開始 (調，拍子，テンポの変更を含む)
+EV_CHORD   = 1 # コード
+EV_NOTE    = 2 # 音符
+
+def make_timeline(piece_info, melody, chords, p):
+    """Build the time-sorted event list of part p
+
+    小節の開始(調，拍子，テンポの変更)，コード，音符を1本の時刻順のリストにまとめる
+    音符の途中から始まるコードはその音符の直前に置き，音符の開始時刻からのずれ(offset)を持たせる
+    IterMeasuresはこれを先頭から1回なめるだけで小節を生成する
+
+    return: (時刻, 種類, 順番, 内容) のリスト
+            内容は 小節: (小節番号, implicit, 長さ, divisionsを書くか (0, 1小節目), 調, 拍子, テンポ) (変更がなければNone)
+                   コード: (Chord, offset)
+                   音符: melodyのインデックス
+    """
+
+    if not isinstance(melody, Melody):
+        melody = Melody(melody)
+
+    # 小節の開始
+    table = piece_info.measures(p)
+    measures = []
+    for j, m in enumerate(table.number.tolist()):
+        # 調，拍子，テンポの変更
+        key   = int(table.key[j]) if table.key_change[j] else None
+        time  = [int(table.beats[j]), int(table.beat_type[j])] if table.time_change[j] else None
+        tempo = None
+        if table.tempo_change[j]:
+            tempo = [int(table.bpm[j]), table.beat_unit[j], int(table.sound_tempo[j])]
+        ub_flag = m == 0 # implicit=yesな0小節目
+        measures.append((int(table.start[j]), EV_MEASURE, m,
+                         (m, ub_flag, int(table.length[j]), m in (0, 1), key, time, tempo)))
+    end = table.end # 曲の終わり (これ以降のイベントは書き込まない)
+
+    # 音符
+    note_times = melody.array["time"]
+    notes = [(t, EV_NOTE, i, i) for i, t in enumerate(note_times.tolist()) if t < end]
+
+    # コード
+    # 鳴っている音符 (小節をまたぐ場合は小節) の開始時刻に置く
+    ch_times = np.array(sorted(t for t in chords if 0 <= t < end), dtype=np.int64)
+    idx = melody.index_at(ch_times)
+    anchor = np.where(idx >= 0, note_times[np.maximum(idx, 0)], ch_times) if len(note_times) else ch_times
+    if len(table):
+        anchor = np.maximum(anchor, table.start[table.index_at(ch_times)])
+    harmonies = [(a, EV_CHORD, t, (chords[t], t - a))
+                 for t, a in zip(ch_times.tolist(), anchor.tolist())]
+
+    # 3つの時刻順の列を併合
+    return list(heapq.merge(measures, harmonies, notes))
+
+
+def IterMeasures(piece_info, melody, chords, p):
+    """Generate <measure> elements of part p one by one
+
+    make_timelineで作った時刻順のイベント列を先頭から順に処理する
+    WriteScoreとWriteScoreStreamから用いる
+    yield: 小節 [xml.etree.ElementTree.Element]
+    """
+
+    tmp_div = piece_info.divisions[p]
+    # 現在時刻 (時刻の単位は4分音符の長さをdivisionsの値とした整数)
+    cur_time = 0
+    measure = None
+
+    for ev_time, ev_kind, _, ev in make_timeline(piece_info, melody, chords, p):
+
+        # 小節の開始
+        if ev_kind == EV_MEASURE:
+            # 前の小節の処理完了
+            if measure is not None:
+                yield measure
 
-            # 0小節目の有無
-            ub_flag = False
-            if m == 0 and not piece_info.upbeat: # implicit=yesな0小節目がない
-                continue # 1小節目から
-            elif m == 0 and piece_info.upbeat: # implicit=yesな0小節目がある
-                ub_flag = True # 0小節目を書き込む
+            m, ub_flag, m_length, first, key, time, tempo = ev
 
             # m小節目を生成 <measure>
             if ub_flag:
-                measure = ET.SubElement(part, "measure", {"number":str(m), "implicit":"yes"})
+                measure = ET.Element("measure", {"number":str(m), "implicit":"yes"})
             else:
-                measure = ET.SubElement(part, "measure", {"number":str(m)})
-            
+                measure = ET.Element("measure", {"number":str(m)})
 
             # 調の変更，拍子，の変更があるか，最初の小節であれば
-            if m in piece_info.key[p] or m in piece_info.time \
-               or (m == 0 or (not ub_flag and m == 1)):
+            if key is not None or time or first:
 
                 # <attributes>タグを生成
                 attributes = ET.SubElement(measure, "attributes")
-                
+
                 # <divisions>の設定 (最初の小節のみ)
-                if m == 0 or (not ub_flag and m == 1):
-                    tmp_div = piece_info.divisions[p]
+                if first:
                     divisions = ET.SubElement(attributes, "divisions")
                     divisions.text = str(tmp_div)
-                    
-                    
+
                 # 調の変更 <key>
-                if m in piece_info.key[p]:
-                    key = ET.SubElement(attributes, "key")
-                    fifths = ET.SubElement(key, "fifths")
-                    fifths.text = str(piece_info.key[p][m])
+                if key is not None:
+                    key_elem = ET.SubElement(attributes, "key")
+                    fifths = ET.SubElement(key_elem, "fifths")
+                    fifths.text = str(key)
 
                 # 拍子の変更 <time>
-                if m in piece_info.time:
-                    tmp_beats = piece_info.time[m][0]
-                    tmp_btype = piece_info.time[m][1]
-                    time = ET.SubElement(attributes, "time")
-                    beats = ET.SubElement(time, "beats")
-                    beat_type = ET.SubElement(time, "beat-type")
-                    beats.text = str(tmp_beats)
-                    beat_type.text = str(tmp_btype)
+                if time:
+                    time_elem = ET.SubElement(attributes, "time")
+                    beats = ET.SubElement(time_elem, "beats")
+                    beat_type = ET.SubElement(time_elem, "beat-type")
+                    beats.text = str(time[0])
+                    beat_type.text = str(time[1])
 
             # テンポの指定，変更があれば
-            if m in piece_info.tempo:
+            if tempo:
                 # タグを生成
                 direction = ET.SubElement(measure, "direction", {"placement":"above"}) # 表示位置はaboveで固定
                 dir_type  = ET.SubElement(direction, "direction-type")
@@ -797,58 +1912,186 @@ def WriteScore(score, piece_info, melody, chords):
                 metronome = ET.SubElement(dir_type, "metronome", {"parentheses":"no"})
                 b_unit    = ET.SubElement(metronome, "beat-unit")
                 per_min   = ET.SubElement(metronome, "per-minute")
-                b_unit.text  = piece_info.tempo[m][1]
-                per_min.text = str(piece_info.tempo[m][0])
+                b_unit.text  = tempo[1]
+                per_min.text = str(tempo[0])
 
                 # sound (再生用のテンポ)
-                sound = ET.SubElement(direction, "sound", {"tempo":str(piece_info.tempo[m][2])})
-                
+                sound = ET.SubElement(direction, "sound", {"tempo":str(tempo[2])})
 
-            # この小節の長さ
-            # implicit=yesの0小節目の場合
-            if ub_flag:
-                m_length = piece_info.upbeat_l
-            # それ以外    
-            # 4分音符の長さ * (4 / 拍子の分母) * 拍子の分子
-            else:
-                m_length = int (tmp_div * (4.0 / tmp_btype) * tmp_beats)
-                
-            # 次の小節の開始時刻
-            next_m_time += m_length
-                
-            # 次の小節の開始時刻まで
-            while cur_time < next_m_time:
-
-                # コード
-                # 現在時刻から始まるコードがあれば
-                if cur_time in chords:
-                    # コードの情報を書き込む
-                    WriteChord(measure, chords[cur_time])
-
-                # 音符
-                # melodyのi番目の音符がこの時刻から始まる音符なら(必ずそうなるはず)
-                if cur_time ==  melody[i].time:
-                    # 音符の情報を書き込む
-                    WriteNote(measure, melody[i], tmp_div, m_length)
-
-                    # デバッグ用
-                    #print "measure: %d" % m
-                    #print "cur_time:%d, melody[%d].time:%d" % (cur_time, i, melody[i].time)
-                    
-                    # 現在時刻を音符の長さ分進める
-                    cur_time += melody[i].duration
-                    
-                    # インデックスをインクリメント
-                    i += 1
-
-                # もし違かったら
+        # コード
+        elif ev_kind == EV_CHORD:
+            chord, offset = ev
+            WriteChord(measure, chord, offset)
+
+        # 音符
+        else:
+            note = melody[ev]
+            # 音符は隙間なく並んでいるはず
+            if cur_time != note.time:
+                raise ValueError("Note time error, cur_time:%d, melody[%d].time:%d"
+                                 % (cur_time, ev, note.time))
+
+            # 音符の情報を書き込む
+            WriteNote(measure, note, tmp_div, m_length)
+
+            # 現在時刻を音符の長さ分進める
+            cur_time += note.duration
+
+    # 最後の小節の処理完了
+    if measure is not None:
+        yield measure
+
+
+# 要素を改行，インデントを施した文字列のリストにして out に追加する
+# xml2xml.finalize (minidomのtoprettyxml) と同じ書式
+def _format_element(elem, level, out):
+
+    pad  = "  " * level
+    attr = "".join(' %s="%s"' % (k, _escape(v)) for k, v in sorted(elem.attrib.items()))
+
+    if len(elem):
+        out.append("%s<%s%s>\n" % (pad, elem.tag, attr))
+        for child in elem:
+            _format_element(child, level + 1, out)
+        out.append("%s</%s>\n" % (pad, elem.tag))
+    elif elem.text:
+        out.append("%s<%s%s>%s</%s>\n" % (pad, elem.tag, attr, _escape(elem.text), elem.tag))
+    else:
+        out.append("%s<%s%s/>\n" % (pad, elem.tag, attr))
+
+# minidomと同じエスケープ
+def _escape(text):
+    text = text.replace("&", "&amp;").replace("<", "&lt;")
+    return text.replace("\"", "&quot;").replace(">", "&gt;")
+
+# 要素をインデントを施してファイルに書き込む
+# f:ファイルオブジェクト, elem:ElementTreeのElement, level:インデントの深さ
+def WriteElement(f, elem, level=0):
+    out = []
+    _format_element(elem, level, out)
+    f.write(u"".join(out).encode("utf-8"))
+
+
+# 楽譜全体を逐次ファイルに書き込む
+def WriteScoreStream(f, piece_info, melody, chords):
+    """MusicXMLを小節ごとにファイルに書き込む
+
+    WriteIdentification, WriteDefaults, WritePartList, WriteScoreで木を作って
+    xml2xml.finalizeで文字列にするのと同じ内容を，木全体を作らずに書き込む
+    (ヘッダーのみWriteHeaderのものを用いる)
+    同時にメモリ上にあるのは1小節分の要素のみ
+
+    Keyword arguments:
+    f          -- 書き込み先 [ファイルオブジェクト]
+    piece_info -- 曲情報 [PieceInfo]
+    melody     -- 旋律 [Melody またはNoteのリスト]
+    chords     -- コード進行 [dictionary of Chord]
+    """
+
+    # ヘッダー，識別情報，デフォルト設定，パートリスト (どの楽譜でも同じ)
+    f.write(ScoreHead())
+
+    # パートごと
+    for p in range(1, piece_info.part_num + 1):
+        f.write('  <part id="P%d">\n' % p)
+        for measure in IterMeasures(piece_info, melody, chords, p):
+            WriteElement(f, measure, 2)
+        f.write("  </part>\n")
+
+    f.write("</score-partwise>\n")
+
+# ScoreHeadの結果 {(日付, ソフトウェア名): 書き出したバイト列}
+_score_heads = {}
+
+# 楽譜の先頭 (ヘッダーから</part-list>まで) をUTF-8のバイト列で返す
+# WriteIdentification, WriteDefaults, WritePartListの内容は楽譜によらないので，
+# 書き出した結果を覚えておいて使い回す (日付が変わったら作り直す)
+def ScoreHead():
+
+    key  = (datetime.date.today(), sys.argv[0])
+    head = _score_heads.get(key)
+    if head is None:
+        score = ET.Element("score-partwise")
+        WriteIdentification(score)
+        WriteDefaults(score)
+        WritePartList(score)
+
+        out = [WriteHeader() + "\n", "<score-partwise>\n"]
+        for elem in score:
+            _format_element(elem, 1, out)
+        head = u"".join(out).encode("utf-8")
+
+        _score_heads.clear()
+        _score_heads[key] = head
+    return head
+
+# 楽譜全体をMusicXML (UTF-8のバイト列) にする (WriteScoreStreamと同じ内容)
+def RenderScore(piece_info, melody, chords):
+    f = StringIO()
+    WriteScoreStream(f, piece_info, melody, chords)
+    return f.getvalue()
+
+# 多数の楽譜をMusicXMLファイルに書き込む
+def WriteScores(musics, paths, jobs=1, batch=256):
+    """Write many scores into MusicXML files, in parallel if jobs > 1
+
+    楽譜の先頭 (ScoreHead) は一度だけ作って全ての楽譜で使い回し，
+    小節以降はjobs個のプロセスで並列に書き込む
+    musicsは一度にbatch個ずつ読み出すので，生成モデルの出力などを逐次渡してもメモリ使用量は増えない
+
+    書き込めない楽譜 (対応していない長さの音符など) があっても残りの楽譜は書き込み，
+    失敗した楽譜のファイルは残さない
+
+    Keyword arguments:
+    musics -- (曲情報[PieceInfo], 旋律[Melody またはNoteのリスト], コード進行[dictionary of Chord]) のイテレータ
+    paths  -- musicsと同じ順の書き込み先のパスのイテレータ
+    jobs   -- 並列に書き込むプロセスの数
+    batch  -- 一度にプロセスに割り当てる楽譜の数
+
+    return: 書き込んだ楽譜の数, 失敗した楽譜のリスト [(パス, エラーメッセージ), ...]
+    """
+
+    tasks = itertools.izip(paths, musics)
+
+    # プロセスを作る前に作っておけば各プロセスで作り直さずに済む
+    ScoreHead()
+
+    pool     = multiprocessing.Pool(jobs) if jobs > 1 else None
+    mapper   = pool.map if pool is not None else map
+    count    = 0
+    failures = []
+    finished = False
+    try:
+        while True:
+            chunk = list(itertools.islice(tasks, batch))
+            if not chunk:
+                break
+            for (path, _), error in itertools.izip(chunk, mapper(_write_score_file, chunk)):
+                if error is None:
+                    count += 1
                 else:
-                    # エラーを返す
-                    print "Error! Note time error"
-                    print "cur_time:%d, melody[%d].time:%d" % (cur_time, i, melody[i].time)                 
-                    quit()
-            # while ここまで
-
-        # 1小節分の処理完了
-    # 1パートの処理完了
-                
+                    failures.append((path, error))
+        finished = True
+    finally:
+        # 途中で例外 (KeyboardInterruptなど) が起きた場合はワーカーを止める
+        if pool is not None:
+            if finished:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+    return count, failures
+
+# WriteScoresの1つの楽譜 (プロセスプールのワーカーとしても呼ばれる)
+# 例外は捕まえてメッセージとして返す (成功時はNone)
+def _write_score_file(task):
+    path, (piece_info, melody, chords) = task
+    try:
+        with open(path, "wb") as f:
+            WriteScoreStream(f, piece_info, melody, chords)
+    except Exception as e:
+        if os.path.exists(path):
+            os.remove(path)
+        return "{}: {}".format(type(e).__name__, e)
+    return None
+            
@@ -9,10 +9,10 @@ xml2vecとvec2xmlのテスト用
 import sys
 import time
 import re
+import argparse
 import xml2vec as x2v
 import xml.etree.ElementTree as ET
 from xml.dom import minidom
-from bs4 import BeautifulSoup
 
 
 # mainで作ったMusicXMLにヘッダを追加して，改行，インデントを施す
@@ -32,19 +32,25 @@ if __name__ == "__main__":
     ###### 読み込み ######
 
     #引数の取得
-    argvs = sys.argv
-    argc = len(argvs)
-    if (argc != 3):
-        print "Usage: python %s input-name.xml output-name.xml" % argvs[0]
-        quit()
-
-    # MusicXMLを読み込む
-    print "loading %s ..." % argvs[1]
-    soup = BeautifulSoup(open(argvs[1], "r").read(), "lxml")
-
-    # 曲情報，メロディ，コードの抽出
-    print "extracting melody and chords from %s ..." % argvs[1]
-    piece_info, melody, chords = x2v.extract_music(soup)
+    parser = argparse.ArgumentParser(description='Read MusicXML and write MusicXML with only melody part')
+    parser.add_argument('input', help='Input MusicXML file')
+    parser.add_argument('output', help='Output MusicXML file')
+    parser.add_argument('--parser', choices=x2v.PARSERS, default='bs4',
+                        help="""Parser used in extraction (default=bs4)
+                        'iterparse' reads MusicXML incrementally with constant memory""")
+    parser.add_argument('--cache_dir', default='',
+                        help='Directory of the cache of extracted melodies and chords')
+    parser.add_argument('--stream', action='store_true', default=False,
+                        help="""Write MusicXML measure by measure without building the whole tree
+                        (bounded memory, same output except for the XML declaration)""")
+    args = parser.parse_args()
+
+    # MusicXMLを読み込んで曲情報，メロディ，コードを抽出
+    print "loading and extracting melody and chords from %s ..." % args.input
+    cache = x2v.MusicCache(args.cache_dir) if args.cache_dir else None
+    piece_info, melody, chords = x2v.load_music(args.input, args.parser, cache)
+    if cache is not None:
+        cache.trim()
 
     
     ###### デバッグ用 ######
@@ -60,6 +66,14 @@ if __name__ == "__main__":
     
     ###### MusicXML生成 ######
 
+    # 木全体を作らずに小節ごとに書き込む
+    if args.stream:
+        print "writing score"
+        with open(args.output, "w") as f:
+            x2v.WriteScoreStream(f, piece_info, melody, chords)
+        print "Process Completed"
+        sys.exit()
+
     # 根ノード 
     score = ET.Element("score-partwise")
 
@@ -79,7 +93,7 @@ if __name__ == "__main__":
     print "writing melody and chords"
     x2v.WriteScore(score, piece_info, melody, chords)
 
-    f = open(argvs[2], "w")
+    f = open(args.output, "w")
     f.write(finalize(score).encode('utf-8'))
 
     print "Process Completed"